@@ -0,0 +1,242 @@
+# aggregate.py
+
+# This file computes aggregate statistics over many habit databases, e.g.
+# one 'habits.db' per user. The databases are summarized in parallel by a
+# pool of worker processes; every worker handles a chunk of databases and
+# returns one merged partial summary, which keeps the traffic between the
+# processes small. Partial summaries are merged as they arrive. Databases
+# are only ever opened read-only.
+#
+#   python aggregate.py users/ --workers 8
+#   python aggregate.py users/*.db --active-days 30 --json
+
+import argparse
+import glob
+import json
+import os
+import sqlite3
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import closing
+from datetime import datetime, timedelta
+from itertools import islice
+from urllib.parse import quote
+
+# Databases summarized by one worker task
+CHUNK_SIZE = 32
+
+# Oldest schema version that can be summarized: version 6 has every table the
+# summary reads. Older databases are upgraded the next time the app opens them.
+MIN_SCHEMA_VERSION = 6
+
+
+class Summary:
+    """
+    Aggregate statistics of one or more databases. Summaries of different
+    databases can be merged, in any order, into the summary of all of them.
+    """
+    def __init__(self):
+        self.databases = 0                # Databases summarized
+        self.habits = 0                   # Habits in all databases
+        self.completions = 0              # Completions in all databases
+        self.active_habits = 0            # Habits completed within the active period
+        self.periodicities = Counter()    # Canonical periodicity -> number of habits
+        self.longest_streak = (0, None, None)  # (streak, database, habit name)
+        self.failed = []                  # (database, error message) of unreadable databases
+
+    def merge(self, other):
+        """
+        Adds the statistics of another summary to this one.
+
+        Returns:
+            Summary: This summary, for chaining.
+        """
+        self.databases += other.databases
+        self.habits += other.habits
+        self.completions += other.completions
+        self.active_habits += other.active_habits
+        self.periodicities.update(other.periodicities)
+        # Ties go to the first database by path, so the result doesn't depend on merge order
+        streak, database, _ = other.longest_streak
+        if streak > self.longest_streak[0] or (
+                streak == self.longest_streak[0] and database is not None
+                and (self.longest_streak[1] is None or database < self.longest_streak[1])):
+            self.longest_streak = other.longest_streak
+        self.failed.extend(other.failed)
+        return self
+
+    def to_dict(self):
+        """
+        Returns the summary as a JSON-ready dictionary.
+        """
+        streak, database, name = self.longest_streak
+        return {
+            "databases": self.databases,
+            "habits": self.habits,
+            "completions": self.completions,
+            "active_habits": self.active_habits,
+            "periodicities": dict(self.periodicities.most_common()),
+            "longest_streak": {"streak": streak, "database": database, "habit": name},
+            "failed": [{"database": database, "error": error} for database, error in self.failed],
+        }
+
+
+def summarize_database(path, active_since):
+    """
+    Summarizes a single database. It is opened read-only and never changed
+    (no migration, no WAL switch), and only the habits table and counts over
+    the completions are read; no completion history is loaded.
+
+    Args:
+        path (str): The database file.
+        active_since (str): ISO timestamp; habits completed since then count as active.
+
+    Returns:
+        Summary: The statistics of the database (or its error, if it can't be read).
+    """
+    summary = Summary()
+    try:
+        with closing(sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if not MIN_SCHEMA_VERSION <= version <= _schema_version():
+                summary.failed.append((path, f"unsupported schema version {version}"))
+                return summary
+            habits = conn.execute("SELECT name, periodicity, longest_streak FROM habits ORDER BY id").fetchall()
+            completions = conn.execute("""
+                SELECT (SELECT COUNT(*) FROM completions)
+                     + (SELECT COALESCE(SUM(removed), 0) FROM compacted_completions)
+            """).fetchone()[0]
+            active = conn.execute("SELECT COUNT(DISTINCT habit_id) FROM completions WHERE ts >= ?",
+                                  (active_since,)).fetchone()[0]
+    except Exception as error:  # One unreadable file must not stop the whole run
+        summary.failed.append((path, str(error) or type(error).__name__))
+        return summary
+
+    summary.databases = 1
+    summary.habits = len(habits)
+    summary.completions = completions
+    summary.active_habits = active
+    summary.periodicities.update(periodicity for _, periodicity, _ in habits)
+    for name, _, longest in habits:  # The first habit with the longest streak, by id
+        if longest > summary.longest_streak[0]:
+            summary.longest_streak = (longest, path, name)
+    return summary
+
+
+def _schema_version():
+    """
+    Returns the newest schema version this code reads (see storage.SCHEMA_VERSION).
+    """
+    # Imported here, so the parent process only needs it if it summarizes itself
+    from storage import SCHEMA_VERSION
+    return SCHEMA_VERSION
+
+
+def summarize_chunk(paths, active_since):
+    """
+    Summarizes several databases into one summary. Runs in a worker process.
+    """
+    summary = Summary()
+    for path in paths:
+        summary.merge(summarize_database(path, active_since))
+    return summary
+
+
+def _chunks(paths, size):
+    """
+    Splits the paths into lists of at most 'size' paths.
+    """
+    paths = iter(paths)
+    while chunk := list(islice(paths, size)):
+        yield chunk
+
+
+def iter_partials(paths, workers=None, active_days=7, chunk_size=CHUNK_SIZE):
+    """
+    Summarizes databases in parallel and yields the partial summaries as soon
+    as they are ready. At most a few chunks per worker are queued at a time,
+    so even a very long list of paths doesn't pile up in memory.
+
+    Args:
+        paths (iterable): The database files.
+        workers (int, optional): Worker processes. Defaults to the number of CPUs;
+            0 summarizes everything in the current process.
+        active_days (int, optional): Habits completed within this many days count as active.
+        chunk_size (int, optional): Databases per worker task.
+
+    Yields:
+        Summary: The summary of one chunk of databases.
+    """
+    active_since = (datetime.now() - timedelta(days=active_days)).isoformat()
+    chunks = _chunks(paths, chunk_size)
+    if workers == 0:
+        for chunk in chunks:
+            yield summarize_chunk(chunk, active_since)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        limit = 4 * workers  # Tasks in flight
+        pending = set()
+        for chunk in chunks:
+            pending.add(executor.submit(summarize_chunk, chunk, active_since))
+            if len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in wait(pending).done:
+            yield future.result()
+
+
+def aggregate(paths, workers=None, active_days=7, chunk_size=CHUNK_SIZE):
+    """
+    Summarizes many databases in parallel and merges the results (see iter_partials()).
+
+    Returns:
+        Summary: The statistics of all databases.
+    """
+    total = Summary()
+    for partial in iter_partials(paths, workers, active_days, chunk_size):
+        total.merge(partial)
+    return total
+
+
+def find_databases(locations):
+    """
+    Expands directories (to the '*.db' files in them) and glob patterns into database paths.
+    """
+    for location in locations:
+        if os.path.isdir(location):
+            yield from sorted(glob.glob(os.path.join(location, "*.db")))
+        else:
+            yield from sorted(glob.glob(location)) or [location]
+
+
+def main(argv=None):
+    """
+    Command-line entry point: prints the summary of the given databases.
+    """
+    parser = argparse.ArgumentParser(description="Aggregate statistics over many habit databases")
+    parser.add_argument("locations", nargs="+", help="Database files, directories or glob patterns")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: number of CPUs)")
+    parser.add_argument("--active-days", type=int, default=7,
+                        help="Habits completed within this many days count as active")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Databases per worker task")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = aggregate(find_databases(args.locations), args.workers,
+                        args.active_days, args.chunk_size).to_dict()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    streak = summary["longest_streak"]
+    print(f"Databases: {summary['databases']} ({len(summary['failed'])} failed)")
+    print(f"Habits: {summary['habits']} ({summary['active_habits']} active)")
+    print(f"Completions: {summary['completions']}")
+    print(f"Periodicities: {summary['periodicities']}")
+    print(f"Longest streak: {streak['streak']} ({streak['habit']} in {streak['database']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,19 @@
 # This file contains functions for analyzing habit data, such as
 # filtering habits and calculating streaks.
 
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; only the batch analytics need it
+    np = None
+
+import metrics
+from periods import DAY, normalize_periodicity
+
+
 def get_all_habits(habits):
     """
     Retrieves the names of all habits.
@@ -17,7 +30,9 @@ def get_all_habits(habits):
 
 def filter_by_periodicity(habits, periodicity):
     """
-    Filters habits by a given periodicity ('daily' or 'weekly').
+    Filters habits by a given periodicity ('daily', 'weekly', 'monthly' or
+    'every N days'). Different spellings of the same periodicity match,
+    e.g. 'every 1 day' finds daily habits.
 
     Args:
         habits (list): List of Habit objects.
@@ -26,11 +41,24 @@ def filter_by_periodicity(habits, periodicity):
     Returns:
         list: A list of names of habits matching the given periodicity.
     """
-    return [habit.name for habit in habits if habit.periodicity == periodicity]
+    key = _periodicity_key(periodicity)
+    return [habit.name for habit in habits if _periodicity_key(habit.periodicity) == key]
+
+
+@lru_cache(maxsize=256)
+def _periodicity_key(periodicity):
+    """
+    Returns the canonical form of a periodicity for comparisons, or the text
+    itself if it is not a supported periodicity.
+    """
+    try:
+        return normalize_periodicity(periodicity)
+    except ValueError:
+        return periodicity
 
 def get_longest_streak_all(habits):
     """
-    Finds the longest streak among all habits.
+    Finds the longest streak ever reached among all habits.
 
     Args:
         habits (list): List of Habit objects.
@@ -38,20 +66,352 @@ def get_longest_streak_all(habits):
     Returns:
         int: The highest streak value among all habits, or 0 if no habits.
     """
-    return max((habit.get_streak() for habit in habits), default=0)
+    return max((habit.get_longest_streak() for habit in habits), default=0)
 
 def get_longest_streak_for(habits, habit_name):
     """
-    Finds the current streak for a specific habit by name.
+    Finds the longest streak ever reached by a specific habit, by name.
 
     Args:
-        habits (list): List of Habit objects.
+        habits (list or HabitManager): List of Habit objects, or a HabitManager
+            to look the habit up by name without scanning all habits.
         habit_name (str): The name of the habit to check.
 
     Returns:
-        int: The streak value of the specified habit, or 0 if not found.
+        int: The longest streak of the specified habit, or 0 if not found.
     """
+    if hasattr(habits, "get_habit"):
+        habit = habits.get_habit(habit_name)
+        return habit.get_longest_streak() if habit else 0
+
     for habit in habits:
         if habit.name == habit_name:
-            return habit.get_streak()
+            return habit.get_longest_streak()
     return 0  # Habit not found
+
+
+# --- Batch analytics ---
+# The functions below work on all habits at once with NumPy. The completions
+# of all habits are packed into flat int64 columns, and the streaks of every
+# habit are then found with array operations instead of a loop per habit.
+
+# Column layout used by the batch functions: habit i owns the timestamps
+# stamps[offsets[i]:offsets[i + 1]], sorted chronologically, and the matching
+# period indices in the same positions of 'periods' (see periods.py).
+# 'periodicities' holds the canonical periodicity of each habit.
+HabitColumns = namedtuple("HabitColumns", ["names", "periodicities", "offsets", "stamps", "periods"])
+
+# How each habit's period indices are calculated from its days (see _period_indices())
+_BY_DAYS, _BY_MONTHS, _UNSUPPORTED = range(3)
+
+
+def load_columns(habits):
+    """
+    Packs the completions of all habits into flat NumPy columns.
+
+    Args:
+        habits (list): List of Habit objects.
+
+    Returns:
+        HabitColumns: Habit names, plus int64 arrays of offsets into single arrays
+        holding every habit's sorted completion timestamps and their period indices.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+    """
+    if np is None:
+        raise ImportError("The batch analytics need NumPy (pip install numpy)")
+    names = []
+    periodicities = []
+    stamps = []
+    kinds = []    # _BY_DAYS, _BY_MONTHS or _UNSUPPORTED per habit
+    origins = []  # Day number where period 0 starts, for _BY_DAYS
+    lengths = []  # Days per period, for _BY_DAYS
+    for habit in habits:
+        names.append(habit.name)
+        periodicities.append(_periodicity_key(habit.periodicity))
+        stamps.append(habit.stamps)
+        bucket = habit.bucketer()
+        if bucket is None:
+            kind, origin, length = _UNSUPPORTED, 0, 1
+        elif bucket.unit == "month":
+            kind, origin, length = _BY_MONTHS, 0, 1
+        else:
+            kind, origin, length = _BY_DAYS, bucket.start(0) // DAY, 7 if bucket.unit == "week" else bucket.length
+        kinds.append(kind)
+        origins.append(origin)
+        lengths.append(length)
+
+    counts = np.fromiter(map(len, stamps), dtype=np.int64, count=len(stamps))
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    flat = np.fromiter(chain.from_iterable(stamps), dtype=np.int64, count=offsets[-1])
+    periods = _period_indices(flat, offsets, counts, np.array(kinds, dtype=np.int64),
+                              np.array(origins, dtype=np.int64), np.array(lengths, dtype=np.int64))
+    return HabitColumns(names, np.array(periodicities, dtype=object), offsets, flat, periods)
+
+
+def _period_indices(stamps, offsets, counts, kinds, origins, lengths):
+    """
+    Maps the timestamps of all habits to period indices like Bucketer.indices(),
+    with the per-habit settings repeated for each of the habit's completions.
+    """
+    days = stamps // DAY
+    kind = np.repeat(kinds, counts)
+    periods = (days - np.repeat(origins, counts)) // np.repeat(lengths, counts)
+    monthly = kind == _BY_MONTHS
+    periods[monthly] = _month_indices(days[monthly])
+    # Without a period every completion is a streak of its own, as in period_indices()
+    unsupported = kind == _UNSUPPORTED
+    positions = np.arange(len(stamps), dtype=np.int64) - np.repeat(offsets[:-1], counts)
+    periods[unsupported] = 2 * positions[unsupported]
+    return periods
+
+
+def _month_indices(days):
+    """
+    Returns year * 12 + month - 1 for an array of day numbers, like periods.month_index().
+    """
+    z = days + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524
+                   - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153  # March = 0
+    month = np.where(shifted_month < 10, shifted_month + 3, shifted_month - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+    return year * 12 + month - 1
+
+
+def _streak_starts(columns):
+    """
+    Returns a boolean array marking the completions that start a streak: the
+    first completion of each habit, and every one more than a period after the
+    one before it.
+    """
+    periods, offsets = columns.periods, columns.offsets
+    starts = np.empty(len(periods), dtype=bool)
+    starts[:1] = True
+    np.greater(np.diff(periods), 1, out=starts[1:])
+    starts[offsets[:-1][offsets[:-1] < offsets[1:]]] = True
+    return starts
+
+
+def batch_completion_counts(columns):
+    """
+    Counts the completions of every habit.
+
+    Args:
+        columns (HabitColumns): Columns created by load_columns().
+
+    Returns:
+        list: The number of completions per habit, in column order.
+    """
+    return np.diff(columns.offsets).tolist()
+
+
+def batch_current_streaks(columns):
+    """
+    Calculates the current streak of every habit, like Habit.get_streak().
+
+    Args:
+        columns (HabitColumns): Columns created by load_columns().
+
+    Returns:
+        list: The current streak per habit, in column order.
+    """
+    periods, offsets = columns.periods, columns.offsets
+    streaks = np.zeros(len(offsets) - 1, dtype=np.int64)
+    nonempty = offsets[:-1] < offsets[1:]
+    if nonempty.any():
+        # The position of the latest streak start at or before each completion
+        positions = np.arange(len(periods), dtype=np.int64)
+        latest = np.maximum.accumulate(np.where(_streak_starts(columns), positions, 0))
+        last = offsets[1:][nonempty] - 1
+        streaks[nonempty] = periods[last] - periods[latest[last]] + 1
+    return streaks.tolist()
+
+
+def batch_longest_streaks(columns):
+    """
+    Calculates the longest streak each habit has ever reached.
+
+    Args:
+        columns (HabitColumns): Columns created by load_columns().
+
+    Returns:
+        list: The longest-ever streak per habit, in column order.
+    """
+    periods, offsets = columns.periods, columns.offsets
+    longest = np.zeros(len(offsets) - 1, dtype=np.int64)
+    nonempty = offsets[:-1] < offsets[1:]
+    if nonempty.any():
+        starts = np.flatnonzero(_streak_starts(columns))
+        ends = np.append(starts[1:], len(periods)) - 1
+        lengths = periods[ends] - periods[starts] + 1
+        # Every habit's first completion starts a streak, so its streaks are consecutive
+        longest[nonempty] = np.maximum.reduceat(lengths, np.searchsorted(starts, offsets[:-1][nonempty]))
+    return longest.tolist()
+
+
+def batch_filter_by_periodicity(columns, periodicity):
+    """
+    Filters habits by a given periodicity, like filter_by_periodicity().
+
+    Args:
+        columns (HabitColumns): Columns created by load_columns().
+        periodicity (str): The periodicity to filter by.
+
+    Returns:
+        list: A list of names of habits matching the given periodicity.
+    """
+    names = columns.names
+    return [names[i] for i in np.flatnonzero(columns.periodicities == _periodicity_key(periodicity))]
+
+
+# --- Cached analytics ---
+# A menu or dashboard asks the same questions again and again while nothing
+# changes. CachedAnalytics answers them from results remembered together with
+# the version of the data they were calculated from (see Habit.version and
+# HabitManager.version), and only recalculates once that version has moved on.
+
+class CachedAnalytics:
+    """
+    Memoized versions of the analytics functions for the habits of a HabitManager.
+    Repeated queries are answered from the cache until a habit is added, deleted
+    or completed, whether through the manager or directly on the habit. Then
+    only the changed habits are recalculated (see HabitManager.changed_since()).
+    Per-habit results for get_longest_streak_for() are kept in a bounded LRU
+    cache; the overall longest streak keeps its own value for every habit, so
+    evictions never force it to recalculate.
+    """
+    def __init__(self, manager, maxsize=1024):
+        """
+        Args:
+            manager (HabitManager): The habits to analyze.
+            maxsize (int, optional): Most per-habit results kept in the cache.
+        """
+        self.manager = manager
+        self.maxsize = maxsize
+        self._longest = OrderedDict()  # Habit name -> (habit version, longest streak), LRU order
+        self._names_version = None     # Manager names_version the index was built for
+        self._names = []               # All habit names, in manager order
+        self._by_periodicity = {}      # Canonical periodicity -> habit names
+        self._overall_version = None   # Manager version the overall longest streak is for
+        self._overall = 0              # Longest streak of all habits
+        self._all_longest = {}         # Habit name -> longest streak, for the overall result
+
+    def _index(self):
+        """
+        Rebuilds the name list and periodicity index if habits were added or deleted.
+        """
+        if self._names_version == self.manager.names_version:
+            metrics.increment("analytics.cache_hits")
+            return
+        metrics.increment("analytics.cache_misses")
+        names = []
+        by_periodicity = {}
+        for habit in self.manager.habits:
+            names.append(habit.name)
+            by_periodicity.setdefault(_periodicity_key(habit.periodicity), []).append(habit.name)
+        self._names = names
+        self._by_periodicity = by_periodicity
+        self._names_version = self.manager.names_version
+
+    def get_all_habits(self):
+        """
+        Retrieves the names of all habits, like get_all_habits().
+
+        Returns:
+            list: A list of habit names.
+        """
+        self._index()
+        return list(self._names)  # A copy, so callers can't change the cache
+
+    def filter_by_periodicity(self, periodicity):
+        """
+        Filters habits by a given periodicity, like filter_by_periodicity().
+
+        Args:
+            periodicity (str): The periodicity to filter by.
+
+        Returns:
+            list: A list of names of habits matching the given periodicity.
+        """
+        self._index()
+        return list(self._by_periodicity.get(_periodicity_key(periodicity), []))
+
+    def get_longest_streak_for(self, habit_name):
+        """
+        Finds the longest streak ever reached by a habit, like get_longest_streak_for().
+
+        Args:
+            habit_name (str): The name of the habit to check.
+
+        Returns:
+            int: The longest streak of the specified habit, or 0 if not found.
+        """
+        if self._overall_version == self.manager.version and habit_name in self._all_longest:
+            metrics.increment("analytics.cache_hits")
+            return self._all_longest[habit_name]  # Nothing changed since the overall result
+        habit = self.manager.get_habit(habit_name)
+        if habit is None:
+            return 0  # Habit not found
+        return self._habit_longest(habit)
+
+    def get_longest_streak_all(self):
+        """
+        Finds the longest streak ever reached among all habits, like get_longest_streak_all().
+
+        Returns:
+            int: The highest streak value among all habits, or 0 if no habits.
+        """
+        manager = self.manager
+        version = manager.version
+        if self._overall_version == version:
+            metrics.increment("analytics.cache_hits")
+            return self._overall
+        metrics.increment("analytics.cache_misses")
+        changed = None if self._overall_version is None else manager.changed_since(self._overall_version)
+        if changed is None:
+            self._all_longest = {habit.name: habit.get_longest_streak() for habit in manager.habits}
+            self._overall = max(self._all_longest.values(), default=0)
+        else:
+            longest = self._overall
+            dropped = False  # Whether the habit holding the longest streak lost it
+            for name in changed:
+                previous = self._all_longest.pop(name, 0)
+                habit = manager.get_habit(name)
+                current = 0
+                if habit is not None:
+                    current = self._all_longest[name] = habit.get_longest_streak()
+                if current > longest:
+                    longest = current
+                elif previous == longest > current:
+                    dropped = True
+            if dropped:
+                longest = max(self._all_longest.values(), default=0)
+            self._overall = longest
+        self._overall_version = version
+        return self._overall
+
+    def _habit_longest(self, habit):
+        """
+        Returns a habit's longest streak from the cache, calculating it if the
+        habit changed since it was cached. Versions are unique across habits, so
+        a re-created habit with the same name never matches an old entry.
+        """
+        version = habit.version
+        cached = self._longest.get(habit.name)
+        if cached is not None and cached[0] == version:
+            metrics.increment("analytics.cache_hits")
+            self._longest.move_to_end(habit.name)
+            return cached[1]
+        metrics.increment("analytics.cache_misses")
+        longest = habit.get_longest_streak()
+        self._longest[habit.name] = (version, longest)
+        self._longest.move_to_end(habit.name)
+        if len(self._longest) > self.maxsize:
+            self._longest.popitem(last=False)  # Drop the least recently used result
+        return longest
@@ -0,0 +1,305 @@
+# async_api.py
+
+# This file contains an asyncio facade for the habit tracker, for services
+# running on an event loop. SQLite and the habit objects are only ever used
+# by one dedicated worker thread, so nothing blocks the event loop and no
+# locks are needed around the habits. Completions arriving close together
+# are written in a single transaction (group commit).
+#
+#   async with AsyncStorageHandler("habits.db") as storage:
+#       manager = AsyncHabitManager(storage)
+#       await manager.load()
+#       await asyncio.gather(*(manager.complete_habit(name) for name in names))
+#       longest = await manager.get_longest_streak_all()
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import analytics
+from habit_manager import HabitManager
+from storage import StorageHandler
+
+# How long (in seconds) completions are collected before they are committed together
+BATCH_WINDOW = 0.005
+
+# Most completions written in one transaction; a full batch is committed right away
+MAX_BATCH = 1000
+
+
+class _GroupCommit:
+    """
+    Collects items submitted within a short window and writes them with a single
+    call of 'write', which receives the list of items and returns one result per
+    item. Every submit() resolves to the result of its own item.
+    """
+    def __init__(self, run, write, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        """
+        Args:
+            run (coroutine function): Runs a function on the worker thread.
+            write (callable): Writes a list of items, returning a list of results.
+            window (float, optional): Seconds to wait for more items.
+            max_batch (int, optional): Items that trigger a write without waiting.
+        """
+        self._run = run
+        self._write = write
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []    # (item, future) pairs waiting for the next write
+        self._timer = None    # Scheduled flush of the pending items
+        self._writes = set()  # Running write tasks, so flush() can wait for them
+
+    async def submit(self, item):
+        """
+        Queues an item and waits until it has been written.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._start_write()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_write)
+        return await future
+
+    def _start_write(self):
+        """
+        Hands the pending items to a new write task.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._write_batch(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write_batch(self, batch):
+        """
+        Writes one batch and passes each result (or the error) to its waiter.
+        """
+        try:
+            results = await self._run(self._write, [item for item, _ in batch])
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def flush(self):
+        """
+        Writes the pending items now and waits until every write has finished.
+        """
+        self._start_write()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+
+class AsyncStorageHandler:
+    """
+    Asynchronous version of StorageHandler. Every database operation runs on a
+    single worker thread and is awaited, so the event loop keeps serving other
+    tasks while habits are loaded or saved.
+    """
+    def __init__(self, db_name="habits.db", batch_window=BATCH_WINDOW):
+        """
+        Prepares the handler; the database itself is opened on the worker thread
+        by the first operation.
+
+        Args:
+            db_name (str, optional): The file name for the database.
+            batch_window (float, optional): Seconds to collect completions for one transaction.
+        """
+        self.db_name = db_name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habit-storage")
+        self._storage = None  # Created on the worker thread, see _storage_handler()
+        self._completions = _GroupCommit(
+            self.run, lambda completions: self._storage_handler().record_completions(completions),
+            window=batch_window)
+
+    def _storage_handler(self):
+        """
+        Returns the StorageHandler, opening it on first use. Only called on the worker thread.
+        """
+        if self._storage is None:
+            self._storage = StorageHandler(db_name=self.db_name)
+        return self._storage
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs a function on the worker thread and returns its result. Everything
+        that touches the database or habits shared with this handler should go
+        through here, so it never runs at the same time as a save.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(function, *args, **kwargs))
+
+    async def load(self, compact=False, lazy=False):
+        """
+        Loads all habits, see StorageHandler.load(). The completions of lazy
+        habits are read on first use, so only use them on the worker thread (run()).
+        """
+        return await self.run(lambda: self._storage_handler().load(compact=compact, lazy=lazy))
+
+    async def save(self, habits):
+        """
+        Saves habits, see StorageHandler.save().
+        """
+        await self.run(lambda: self._storage_handler().save(habits))
+
+    async def save_changes(self, added=(), deleted=(), completed=()):
+        """
+        Saves what changed since the habits were loaded, see StorageHandler.save_changes().
+        """
+        await self.run(lambda: self._storage_handler().save_changes(added, deleted, completed))
+
+    async def record_completion(self, name, timestamp=None):
+        """
+        Stores one completion of a habit, see StorageHandler.record_completion().
+        Completions recorded within the batch window share one transaction.
+        Without a timestamp, the completion is recorded at the current time in
+        the habit's timezone when its transaction runs.
+
+        Returns:
+            bool: True if the habit was found and completed, False otherwise.
+        """
+        return await self._completions.submit((name, timestamp))
+
+    async def flush(self):
+        """
+        Commits the completions that are still waiting for their batch window.
+        """
+        await self._completions.flush()
+
+    async def close(self):
+        """
+        Commits pending completions, closes the database and stops the worker thread.
+        """
+        await self.flush()
+        if self._storage is not None:
+            await self.run(self._storage.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncHabitManager:
+    """
+    Asynchronous version of HabitManager, saving through an AsyncStorageHandler.
+    The habits live on the storage's worker thread: every method runs there, so
+    habits are never changed while they are being saved or analyzed.
+    """
+    def __init__(self, storage, batch_window=BATCH_WINDOW):
+        """
+        Args:
+            storage (AsyncStorageHandler): Where habits are loaded from and saved to.
+            batch_window (float, optional): Seconds to collect completions for one transaction.
+        """
+        self.storage = storage
+        self.manager = HabitManager()  # Only used on the storage's worker thread
+        self._completions = _GroupCommit(storage.run, self._save_completed, window=batch_window)
+
+    async def load(self, compact=False, lazy=False):
+        """
+        Replaces the managed habits with the ones stored in the database.
+        """
+        habits = await self.storage.load(compact=compact, lazy=lazy)
+        await self.storage.run(setattr, self.manager, "habits", habits)
+
+    async def add_habit(self, name, periodicity):
+        """
+        Adds a new habit, see HabitManager.add_habit(). It is stored by the next save().
+        """
+        await self.storage.run(self.manager.add_habit, name, periodicity)
+
+    async def delete_habit(self, name):
+        """
+        Deletes a habit, see HabitManager.delete_habit(). It is removed by the next save().
+        """
+        await self.storage.run(self.manager.delete_habit, name)
+
+    async def get_habit(self, name):
+        """
+        Retrieves a habit by name, or None if it doesn't exist.
+        """
+        return await self.storage.run(self.manager.get_habit, name)
+
+    async def complete_habit(self, name):
+        """
+        Marks a habit as completed and waits until the completion is stored.
+        Completions within the batch window are saved in one transaction.
+
+        Returns:
+            bool: True if the habit was found and completed, False otherwise.
+        """
+        if not await self.storage.run(self.manager.complete_habit, name):
+            return False  # Habit not found
+        await self._completions.submit(name)
+        return True
+
+    def _save_completed(self, names):
+        """
+        Saves the new completions of the named habits in one transaction. Runs on the
+        worker thread. Habits added since the last save() are left for that save.
+        """
+        added = {habit.name for habit in self.manager.get_changes()[0]}
+        habits = {name: self.manager.get_habit(name) for name in names if name not in added}
+        self.storage._storage_handler().save_changes(
+            completed=[habit for habit in habits.values() if habit is not None])
+        return [True] * len(names)
+
+    async def save(self):
+        """
+        Saves every change made since the habits were loaded or last saved.
+        """
+        await self._completions.flush()
+
+        def save_changes():
+            self.storage._storage_handler().save_changes(*self.manager.get_changes())
+            self.manager.clear_changes()
+        await self.storage.run(save_changes)
+
+    async def analyze(self, function, *args):
+        """
+        Runs an analytics function on the habits, e.g.
+        await manager.analyze(analytics.filter_by_periodicity, 'daily').
+
+        Args:
+            function (callable): Takes the list of habits, followed by 'args'.
+
+        Returns:
+            The function's result.
+        """
+        return await self.storage.run(lambda: function(self.manager.habits, *args))
+
+    async def get_all_habits(self):
+        """
+        Returns the names of all habits, see analytics.get_all_habits().
+        """
+        return await self.analyze(analytics.get_all_habits)
+
+    async def filter_by_periodicity(self, periodicity):
+        """
+        Returns the names of habits with a periodicity, see analytics.filter_by_periodicity().
+        """
+        return await self.analyze(analytics.filter_by_periodicity, periodicity)
+
+    async def get_longest_streak_all(self):
+        """
+        Returns the longest streak among all habits, see analytics.get_longest_streak_all().
+        """
+        return await self.analyze(analytics.get_longest_streak_all)
+
+    async def get_longest_streak_for(self, name):
+        """
+        Returns the longest streak of one habit, see analytics.get_longest_streak_for().
+        """
+        return await self.storage.run(analytics.get_longest_streak_for, self.manager, name)
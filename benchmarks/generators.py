@@ -0,0 +1,62 @@
+# benchmarks/generators.py
+
+# Synthetic data for the benchmarks. The histories look like real usage:
+# mostly one completion per period, with the odd extra completion on the
+# same day and occasional gaps that break a streak.
+
+import random
+from datetime import datetime, timedelta
+
+from habit import Habit
+
+# Start of every generated history
+START = datetime(2020, 1, 1, 7, 30)
+
+# Hours between two completions and how often each gap occurs
+_DAILY_GAPS = ([2, 24, 26, 72], [5, 80, 10, 5])
+_WEEKLY_GAPS = ([24, 24 * 7, 24 * 7 + 12, 24 * 21], [5, 80, 10, 5])
+
+
+def make_completions(count, periodicity="daily", seed=0):
+    """
+    Creates a chronological history of ISO completion timestamps.
+
+    Args:
+        count (int): Number of completions.
+        periodicity (str, optional): 'daily' or 'weekly', controls the typical gap.
+        seed (int, optional): Seed for the random gaps, so runs are repeatable.
+
+    Returns:
+        list: ISO timestamp strings.
+    """
+    rng = random.Random(seed)
+    gaps, weights = _DAILY_GAPS if periodicity == "daily" else _WEEKLY_GAPS
+    moment = START
+    completions = []
+    for hours in rng.choices(gaps, weights, k=count):
+        moment += timedelta(hours=hours, minutes=rng.randint(0, 59))
+        completions.append(moment.isoformat())
+    return completions
+
+
+def make_habits(total_completions, per_habit=100, compact=False, seed=0):
+    """
+    Creates habits holding a given total number of completions.
+
+    Args:
+        total_completions (int): Completions across all habits.
+        per_habit (int, optional): Completions per habit; sets the number of habits.
+        compact (bool, optional): Create compact habits (see Habit).
+        seed (int, optional): Seed for the generated histories.
+
+    Returns:
+        list: Habit objects, alternating between daily and weekly habits.
+    """
+    count = max(total_completions // per_habit, 1)
+    habits = []
+    for i in range(count):
+        periodicity = "daily" if i % 2 == 0 else "weekly"
+        completions = make_completions(min(per_habit, total_completions), periodicity, seed + i)
+        habits.append(Habit(f"Habit {i}", periodicity, created_at=START.isoformat(),
+                            completions=completions, compact=compact))
+    return habits
@@ -0,0 +1,78 @@
+# benchmarks/memory.py
+
+# Compares the resident memory of regular and compact Habit objects.
+# Each mode is measured in a fresh Python process, so the numbers don't
+# influence each other. Run it from the main project folder:
+#
+#   python -m benchmarks.memory [--completions 1000000] [--habits 100]
+
+import argparse
+import resource
+import subprocess
+import sys
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux but in bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def current_rss_mb():
+    """
+    Returns the current resident set size of the process in megabytes, falling
+    back to the peak value where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+
+def measure(completions, habits, compact):
+    """
+    Builds the data set in this process and prints the memory it took.
+    """
+    # Import first so module loading isn't counted as data
+    from benchmarks.generators import make_habits
+
+    before = current_rss_mb()
+    data = make_habits(completions, per_habit=completions // habits, compact=compact)
+    after = current_rss_mb()
+    print(f"{after - before:.1f}")
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Habit memory benchmark")
+    parser.add_argument("--completions", type=int, default=1_000_000)
+    parser.add_argument("--habits", type=int, default=100)
+    parser.add_argument("--mode", choices=["regular", "compact"],
+                        help="Measure a single mode in this process (used internally)")
+    args = parser.parse_args()
+
+    if args.mode:
+        measure(args.completions, args.habits, args.mode == "compact")
+        return
+
+    print(f"{args.completions:,} completions across {args.habits} habits")
+    results = {}
+    for mode in ("regular", "compact"):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.memory", "--mode", mode,
+             "--completions", str(args.completions), "--habits", str(args.habits)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        results[mode] = float(output.strip())
+        print(f"{mode:>8}: {results[mode]:8.1f} MB RSS")
+    if results["compact"]:
+        print(f"   ratio: {results['regular'] / results['compact']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# benchmarks/run.py
+
+# Benchmarks for the hot paths of the habit tracker: streak calculation,
+# analytics over all habits, and saving/loading through StorageHandler.
+# Run it from the main project folder:
+#
+#   python -m benchmarks.run                               # default sizes
+#   python -m benchmarks.run --sizes 100,10000,1000000     # up to 10^6 completions
+#   python -m benchmarks.run --save benchmarks/baseline.json
+#   python -m benchmarks.run --compare benchmarks/baseline.json
+#
+# Every case reports throughput (items per second), latency percentiles of its
+# individual operations and the peak memory allocated while it runs.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import analytics
+from benchmarks.generators import make_habits
+from habit_manager import HabitManager
+from journal import CompletionJournal
+from storage import StorageHandler
+
+# Registered benchmark cases, by name
+CASES = {}
+
+
+def case(name):
+    """
+    Registers a benchmark case. A case receives freshly generated habits and a
+    temporary directory, and returns the latencies (in seconds) of the operations
+    it timed together with the number of items those operations processed.
+    """
+    def register(function):
+        CASES[name] = function
+        return function
+    return register
+
+
+def timed(operation):
+    """
+    Runs an operation once and returns how long it took, in seconds.
+    """
+    start = time.perf_counter()
+    operation()
+    return time.perf_counter() - start
+
+
+@case("habit.get_streak")
+def bench_get_streak(habits, tmpdir):
+    latencies = [timed(habit.get_streak) for habit in habits]
+    return latencies, len(habits)
+
+
+@case("habit.rebuild")
+def bench_rebuild(habits, tmpdir):
+    # Assigning the completions forces the full parse/sort/streak pass
+    def rebuild(habit):
+        habit.completions = habit.completions
+        habit.get_streak()
+    latencies = [timed(lambda: rebuild(habit)) for habit in habits]
+    return latencies, sum(habit.completion_count for habit in habits)
+
+
+@case("habit.complete")
+def bench_complete(habits, tmpdir):
+    latencies = [timed(habit.complete) for habit in habits]
+    return latencies, len(habits)
+
+
+@case("analytics.get_longest_streak_all")
+def bench_longest_streak_all(habits, tmpdir):
+    latencies = [timed(lambda: analytics.get_longest_streak_all(habits))]
+    return latencies, len(habits)
+
+
+@case("analytics.batch_longest_streaks")
+def bench_batch_longest_streaks(habits, tmpdir):
+    latencies = [timed(lambda: analytics.batch_longest_streaks(analytics.load_columns(habits)))]
+    return latencies, sum(habit.completion_count for habit in habits)
+
+
+@case("storage.save")
+def bench_save(habits, tmpdir):
+    storage = StorageHandler(db_name=os.path.join(tmpdir, "save.db"))
+    latencies = [timed(lambda: storage.save(habits))]
+    return latencies, sum(habit.completion_count for habit in habits)
+
+
+@case("storage.save_changes")
+def bench_save_changes(habits, tmpdir):
+    storage = StorageHandler(db_name=os.path.join(tmpdir, "changes.db"))
+    storage.save(habits)
+    manager = HabitManager()
+    manager.habits = habits
+    latencies = []
+    for habit in habits[:100]:
+        # A typical save: one habit completed since the last one
+        manager.complete_habit(habit.name)
+        latencies.append(timed(lambda: storage.save_changes(*manager.get_changes())))
+        manager.clear_changes()
+    return latencies, len(latencies)
+
+
+@case("journal.complete")
+def bench_journal_complete(habits, tmpdir):
+    # A completion made durable through the journal instead of a save_changes()
+    with CompletionJournal(os.path.join(tmpdir, "habits.db.journal")) as journal:
+        manager = HabitManager(journal=journal)
+        manager.habits = habits
+        latencies = [timed(lambda: manager.complete_habit(habit.name)) for habit in habits[:100]]
+    return latencies, len(latencies)
+
+
+@case("storage.load")
+def bench_load(habits, tmpdir):
+    storage = StorageHandler(db_name=os.path.join(tmpdir, "load.db"))
+    storage.save(habits)
+    latencies = [timed(storage.load)]
+    return latencies, sum(habit.completion_count for habit in habits)
+
+
+@case("storage.load_snapshot")
+def bench_load_snapshot(habits, tmpdir):
+    storage = StorageHandler(db_name=os.path.join(tmpdir, "snapshot.db"))
+    storage.save(habits)
+    storage.save_snapshot()
+    latencies = [timed(lambda: storage.load(snapshot=True))]
+    return latencies, sum(habit.completion_count for habit in habits)
+
+
+@case("storage.load_lazy")
+def bench_load_lazy(habits, tmpdir):
+    storage = StorageHandler(db_name=os.path.join(tmpdir, "lazy.db"))
+    storage.save(habits)
+    latencies = [timed(lambda: storage.load(lazy=True))]
+    return latencies, len(habits)
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value at the given fraction (0..1) of a sorted list, interpolating linearly.
+    """
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def run_case(name, size, per_habit, repeat):
+    """
+    Runs one case at one size: 'repeat' timed runs, then one run under tracemalloc
+    to measure peak memory (kept separate so tracing doesn't distort the timings).
+
+    Returns:
+        dict: Throughput, latency percentiles (in milliseconds) and peak memory (in KB).
+    """
+    latencies = []
+    total_time = 0.0
+    total_items = 0
+    for _ in range(repeat):
+        habits = make_habits(size, per_habit=per_habit)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_latencies, items = CASES[name](habits, tmpdir)
+        latencies.extend(run_latencies)
+        total_time += sum(run_latencies)
+        total_items += items
+
+    habits = make_habits(size, per_habit=per_habit)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tracemalloc.start()
+        CASES[name](habits, tmpdir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "throughput": total_items / total_time if total_time else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_kb": peak / 1024,
+    }
+
+
+def git_commit():
+    """
+    Returns the current git commit, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how the median latencies compare to a baseline and returns the
+    names of the results that got slower by more than 'threshold' (e.g. 0.2 = 20%).
+    """
+    regressions = []
+    print("\n--- Compared to baseline ---")
+    for key, result in results.items():
+        old = baseline["results"].get(key)
+        if not old or not old["p50_ms"]:
+            continue
+        change = result["p50_ms"] / old["p50_ms"] - 1
+        flag = "REGRESSION" if change > threshold else ""
+        if flag:
+            regressions.append(key)
+        print(f"{key:<48} {change:+8.1%} {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Habit tracker benchmarks")
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="Comma-separated total completion counts (10^2..10^6)")
+    parser.add_argument("--per-habit", type=int, default=100,
+                        help="Completions per habit; the number of habits is size / per-habit")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case and size")
+    parser.add_argument("--cases", help="Comma-separated case names (default: all)")
+    parser.add_argument("--save", metavar="PATH", help="Write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Slowdown of the median latency counted as a regression")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = args.cases.split(",") if args.cases else list(CASES)
+
+    results = {}
+    print(f"{'case':<48} {'items/s':>12} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'peak KB':>10}")
+    for name in names:
+        for size in sizes:
+            result = run_case(name, size, args.per_habit, args.repeat)
+            key = f"{name}@{size}"
+            results[key] = result
+            print(f"{key:<48} {result['throughput']:>12,.0f} {result['p50_ms']:>10.3f} "
+                  f"{result['p95_ms']:>10.3f} {result['p99_ms']:>10.3f} {result['peak_kb']:>10,.0f}")
+
+    if args.save:
+        report = {
+            "meta": {
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "per_habit": args.per_habit,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }
+        with open(args.save, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+        print(f"\nResults saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
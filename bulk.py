@@ -0,0 +1,249 @@
+# bulk.py
+
+# This file contains the bulk import and export of habit data, for moving
+# whole histories in or out of the database (e.g. from another tracker).
+# Both CSV and NDJSON (one JSON object per line) are supported, with one
+# completion per row:
+#
+#   habit,periodicity,created_at,timestamp
+#   Read Book,daily,2024-01-01T08:00:00,2024-01-02T21:15:00
+#
+# 'created_at' is optional. A habit without completions is written as a
+# single row with an empty timestamp. Files are processed in chunks, so
+# memory use does not grow with the size of the file.
+
+import csv
+import json
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+
+from periods import normalize_periodicity
+
+FIELDS = ["habit", "periodicity", "created_at", "timestamp"]
+
+# Number of rows written to the database per transaction
+CHUNK_SIZE = 50_000
+
+
+def detect_format(path):
+    """
+    Guesses the file format from the file extension.
+
+    Args:
+        path (str): Path of the import or export file.
+
+    Returns:
+        str: 'csv' or 'ndjson'.
+
+    Raises:
+        ValueError: If the extension is not recognized.
+    """
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    raise ValueError(f"Unknown file format for '{path}' (expected .csv, .ndjson or .jsonl)")
+
+
+def read_csv(file):
+    """
+    Yields the rows of a CSV file with a header line as tuples in FIELDS order.
+    Columns are matched by the header, so their order in the file doesn't matter.
+    """
+    reader = csv.reader(file)
+    header = next(reader, [])
+    # Missing columns point just past the end of the row, which is padded with ''
+    width = len(header)
+    pick = itemgetter(*(header.index(field) if field in header else width for field in FIELDS))
+    padding = [""] * (width + 1)
+    for values in reader:
+        if len(values) <= width:
+            values += padding[len(values):]
+        yield pick(values)
+
+
+def read_ndjson(file):
+    """
+    Yields the objects of an NDJSON file as tuples in FIELDS order, skipping blank lines.
+    """
+    for line in file:
+        if line.strip():
+            row = json.loads(line)
+            yield tuple(row.get(field) for field in FIELDS)
+
+
+@lru_cache(maxsize=256)
+def _normalize_periodicity(periodicity):
+    """
+    normalize_periodicity(), remembered for the few distinct spellings a file has.
+    """
+    return normalize_periodicity(periodicity)
+
+
+@lru_cache(maxsize=1024)
+def _is_timestamp(value):
+    """
+    Checks a creation date, which repeats on every row of a habit, once.
+    """
+    try:
+        datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _check_timestamp(value, line):
+    """
+    Raises a ValueError naming the row if a timestamp can't be parsed.
+    """
+    try:
+        datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Row {line}: invalid timestamp '{value}'") from None
+
+
+def _validate(row, line, periodicities):
+    """
+    Checks one imported row and returns its (name, periodicity, created_at, timestamp).
+    'periodicities' remembers the periodicity of every habit seen so far in the import.
+
+    Raises:
+        ValueError: If the row is incomplete or contains invalid values.
+    """
+    name, periodicity, created_at, timestamp = row
+    name = (name or "").strip()
+    periodicity = (periodicity or "").strip()
+    created_at = created_at or None
+    timestamp = timestamp or None
+
+    if not name:
+        raise ValueError(f"Row {line}: missing habit name")
+    try:
+        periodicity = _normalize_periodicity(periodicity)
+    except ValueError:
+        raise ValueError(f"Row {line}: invalid periodicity '{periodicity}'") from None
+    if timestamp is not None:
+        _check_timestamp(timestamp, line)
+    if created_at is not None and not _is_timestamp(created_at):
+        _check_timestamp(created_at, line)  # Raises the error
+    if periodicities.setdefault(name, periodicity) != periodicity:
+        raise ValueError(f"Row {line}: habit '{name}' is both "
+                         f"{periodicities[name]} and {periodicity}")
+    return name, periodicity, created_at, timestamp
+
+
+def import_rows(storage, rows, chunk_size=CHUNK_SIZE, skip_invalid=False):
+    """
+    Validates rows and writes them to the database in batched transactions.
+
+    Args:
+        storage (StorageHandler): The database to import into.
+        rows (iterable): Tuples with the values of FIELDS, as yielded by read_csv().
+        chunk_size (int, optional): Rows per transaction.
+        skip_invalid (bool, optional): Skip invalid rows instead of stopping at the first one.
+
+    Returns:
+        dict: Counts of imported 'habits', 'completions' and 'skipped' rows.
+        Habits and completions the database already had are not counted.
+
+    Raises:
+        ValueError: If a row is invalid and skip_invalid is False. Chunks
+            before the invalid row have already been written.
+    """
+    periodicities = {}  # Periodicity of each habit, to catch conflicting rows
+    touched = set()     # Ids of habits that received completions
+    stats = {"habits": 0, "completions": 0, "skipped": 0}
+    rows = enumerate(rows, start=1)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        habits = {}
+        completions = []
+        for line, row in chunk:
+            try:
+                name, periodicity, created_at, timestamp = _validate(row, line, periodicities)
+            except ValueError:
+                if not skip_invalid:
+                    raise
+                stats["skipped"] += 1
+                continue
+            if name not in habits:
+                # New habits are created at their first completion unless a date is given
+                habits[name] = (name, periodicity,
+                                created_at or timestamp or datetime.now().isoformat())
+            if timestamp is not None:
+                completions.append((name, timestamp))
+
+        ids, added_habits, added_completions = storage.bulk_insert(list(habits.values()), completions)
+        touched |= ids
+        stats["habits"] += added_habits
+        stats["completions"] += added_completions
+
+    storage.refresh_streaks(touched)
+    return stats
+
+
+def import_file(storage, path, file_format=None, chunk_size=CHUNK_SIZE, skip_invalid=False):
+    """
+    Imports a CSV or NDJSON file into the database (see import_rows()).
+
+    Args:
+        storage (StorageHandler): The database to import into.
+        path (str): The file to read.
+        file_format (str, optional): 'csv' or 'ndjson'. Detected from the extension by default.
+        chunk_size (int, optional): Rows per transaction.
+        skip_invalid (bool, optional): Skip invalid rows instead of stopping.
+
+    Returns:
+        dict: Counts of imported 'habits', 'completions' and 'skipped' rows.
+    """
+    file_format = file_format or detect_format(path)
+    reader = read_csv if file_format == "csv" else read_ndjson
+    with open(path, newline="", encoding="utf-8") as file:
+        return import_rows(storage, reader(file), chunk_size, skip_invalid)
+
+
+def export_rows(storage):
+    """
+    Streams all habits and completions from the database as dictionaries,
+    without loading Habit objects.
+
+    Yields:
+        dict: A row with the keys in FIELDS.
+    """
+    for _, name, periodicity, created_at, ts in storage.iter_completion_rows():
+        yield {"habit": name, "periodicity": periodicity,
+               "created_at": created_at, "timestamp": ts or ""}
+
+
+def export_file(storage, path, file_format=None):
+    """
+    Exports all habits and completions to a CSV or NDJSON file.
+
+    Args:
+        storage (StorageHandler): The database to export from.
+        path (str): The file to write.
+        file_format (str, optional): 'csv' or 'ndjson'. Detected from the extension by default.
+
+    Returns:
+        int: The number of rows written.
+    """
+    file_format = file_format or detect_format(path)
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            writer = csv.DictWriter(file, fieldnames=FIELDS)
+            writer.writeheader()
+            for row in export_rows(storage):
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in export_rows(storage):
+                file.write(json.dumps(row) + "\n")
+                count += 1
+    return count
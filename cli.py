@@ -0,0 +1,266 @@
+# cli.py
+
+# This file contains a non-interactive command-line interface for scripts and
+# automation. Every command prints one line of JSON. Many commands can be run
+# in one process with 'batch', which reads one command per line from a file
+# (or stdin) and saves all habit changes of the batch in a single transaction.
+#
+#   python cli.py add "Read Book" daily
+#   python cli.py complete "Read Book"
+#   python cli.py list --periodicity daily
+#   python cli.py stats --top 3
+#   python cli.py import history.csv
+#   python cli.py batch commands.txt        # or: ... | python cli.py batch -
+#
+# Only argparse and json are imported up front; the storage and bulk modules
+# are imported by the commands that need them, so the CLI starts quickly.
+
+import argparse
+import json
+import shlex
+import sys
+
+
+class _Session:
+    """
+    The state shared by the commands of one run: the database and the habits,
+    which are only read when a command needs them. Habit changes are collected
+    in a HabitManager and written together by save().
+    """
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._storage = None
+        self._manager = None
+
+    @property
+    def storage(self):
+        """
+        StorageHandler: The database, opened on first use.
+        """
+        if self._storage is None:
+            from storage import StorageHandler
+            self._storage = StorageHandler(db_name=self.db_name)
+        return self._storage
+
+    @property
+    def manager(self):
+        """
+        HabitManager: The stored habits, loaded lazily (completions are read on first use).
+        """
+        if self._manager is None:
+            from habit_manager import HabitManager
+            self._manager = HabitManager()
+            self._manager.habits = self.storage.load(lazy=True)
+        return self._manager
+
+    def save(self):
+        """
+        Writes the pending habit changes in one transaction.
+        """
+        if self._manager is not None:
+            self.storage.save_changes(*self._manager.get_changes())
+            self._manager.clear_changes()
+
+    def reload(self):
+        """
+        Saves pending changes and forgets the loaded habits, after commands that
+        change the database directly (e.g. an import).
+        """
+        self.save()
+        self._manager = None
+
+    def close(self):
+        """
+        Closes the database, if it was opened.
+        """
+        if self._storage is not None:
+            self._storage.close()
+
+
+def cmd_add(session, args):
+    """
+    Adds a habit; it is saved with the rest of the batch.
+    """
+    session.manager.add_habit(args.name, args.periodicity)  # ValueError if invalid
+    return {"name": args.name, "periodicity": session.manager.get_habit(args.name).periodicity}
+
+
+def cmd_complete(session, args):
+    """
+    Completes a habit now and reports its new streak, without reading its history.
+    """
+    if not session.manager.complete_habit(args.name):
+        raise ValueError(f"Habit '{args.name}' not found.")
+    return {"name": args.name, "streak": session.manager.get_habit(args.name).get_streak()}
+
+
+def cmd_delete(session, args):
+    """
+    Deletes a habit and its completions.
+    """
+    if session.manager.get_habit(args.name) is None:
+        raise ValueError(f"Habit '{args.name}' not found.")
+    session.manager.delete_habit(args.name)
+    return {"name": args.name}
+
+
+def cmd_list(session, args):
+    """
+    Lists habits with their streaks, without reading their completions.
+    """
+    habits = session.manager.habits
+    if args.periodicity:
+        from periods import normalize_periodicity
+        periodicity = normalize_periodicity(args.periodicity)
+        habits = [habit for habit in habits if habit.periodicity == periodicity]
+    return {"habits": [
+        {"name": habit.name, "periodicity": habit.periodicity, "created_at": habit.created_at,
+         "streak": habit.get_streak(), "longest_streak": habit.get_longest_streak()}
+        for habit in habits
+    ]}
+
+
+def cmd_stats(session, args):
+    """
+    Reports completion counts, the habits completed on a day and the top streaks.
+    They are answered in SQL (see StorageHandler), so the history is never loaded.
+    """
+    session.save()
+    storage = session.storage
+    return {
+        "completions": dict(storage.completion_counts()),
+        "completed_today": storage.habits_completed_on(args.day),
+        "top_streaks": [{"rank": rank, "name": name, "streak": streak}
+                        for rank, name, streak in storage.top_streaks(args.top)],
+    }
+
+
+def cmd_import(session, args):
+    """
+    Imports a file with bulk.import_file().
+    """
+    import bulk
+    session.save()
+    stats = bulk.import_file(session.storage, args.path, args.format, skip_invalid=args.skip_invalid)
+    session.reload()
+    return stats
+
+
+def cmd_export(session, args):
+    """
+    Exports all habits with bulk.export_file().
+    """
+    import bulk
+    session.save()
+    return {"rows": bulk.export_file(session.storage, args.path, args.format)}
+
+
+def build_parser(batch=True):
+    """
+    Creates the argument parser. Inside a batch the global options and the
+    'batch' command itself are left out.
+    """
+    parser = argparse.ArgumentParser(prog="cli.py", description="Habit tracker command-line interface")
+    if batch:
+        parser.add_argument("--db", default="habits.db", help="Database file (default: habits.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("add", help="Add a habit")
+    command.add_argument("name")
+    command.add_argument("periodicity", help="daily, weekly, monthly or 'every N days'")
+    command.set_defaults(handler=cmd_add)
+
+    command = commands.add_parser("complete", help="Mark a habit as completed now")
+    command.add_argument("name")
+    command.set_defaults(handler=cmd_complete)
+
+    command = commands.add_parser("delete", help="Delete a habit")
+    command.add_argument("name")
+    command.set_defaults(handler=cmd_delete)
+
+    command = commands.add_parser("list", help="List habits with their streaks")
+    command.add_argument("--periodicity", help="Only habits with this periodicity")
+    command.set_defaults(handler=cmd_list)
+
+    command = commands.add_parser("stats", help="Completion counts and top streaks")
+    command.add_argument("--top", type=int, default=5, help="Number of streak ranks (default: 5)")
+    command.add_argument("--day", help="Day for 'completed_today' as YYYY-MM-DD (default: today)")
+    command.set_defaults(handler=cmd_stats)
+
+    for name, help_text in [("import", "Import a CSV or NDJSON file"),
+                            ("export", "Export all habits to a CSV or NDJSON file")]:
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("path")
+        command.add_argument("--format", choices=["csv", "ndjson"],
+                             help="File format (default: from the file extension)")
+        if name == "import":
+            command.add_argument("--skip-invalid", action="store_true", help="Skip invalid rows")
+        command.set_defaults(handler=cmd_import if name == "import" else cmd_export)
+
+    if batch:
+        command = commands.add_parser(
+            "batch", help="Run one command per line from a file ('-' for stdin), saving once")
+        command.add_argument("file", nargs="?", default="-")
+    return parser
+
+
+def run_command(session, args):
+    """
+    Runs one parsed command and returns its JSON-ready result.
+    """
+    try:
+        result = args.handler(session, args)
+    except (ValueError, OSError) as error:
+        return {"command": args.command, "ok": False, "error": str(error)}
+    return {"command": args.command, "ok": True, **result}
+
+
+def run_batch(session, lines):
+    """
+    Runs one command per line (blank lines and '#' comments are skipped).
+
+    Yields:
+        dict: The result of each command, including commands that couldn't be parsed.
+    """
+    parser = build_parser(batch=False)
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+        except (SystemExit, ValueError):  # argparse exits on invalid arguments
+            yield {"command": line, "ok": False, "error": f"Line {number}: invalid command"}
+            continue
+        yield run_command(session, args)
+
+
+def main(argv=None):
+    """
+    Runs the CLI and returns the exit status: 0 if every command succeeded, 1 otherwise.
+    """
+    args = build_parser().parse_args(argv)
+    session = _Session(args.db)
+    ok = True
+    try:
+        if args.command == "batch":
+            file = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+            try:
+                for result in run_batch(session, file):
+                    ok = ok and result["ok"]
+                    print(json.dumps(result))
+            finally:
+                if file is not sys.stdin:
+                    file.close()
+        else:
+            result = run_command(session, args)
+            ok = result["ok"]
+            print(json.dumps(result))
+        session.save()  # Everything changed by this run, in one transaction
+    finally:
+        session.close()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
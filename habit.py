@@ -1,63 +1,424 @@
-from datetime import datetime, timedelta
+import re
+from array import array
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from zoneinfo import ZoneInfo
+
+from periods import make_bucketer, period_indices
+
+# Reference point used to turn timestamps into plain integers (microseconds),
+# which are much cheaper to compare and subtract than datetime objects.
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+# Source of version numbers: every change to a habit (or to the habits of a
+# HabitManager) takes the next one, so a version number is never reused
+_versions = count(1)
+
+
+def next_version():
+    """
+    Returns a new version number, unique within the process.
+    """
+    return next(_versions)
+
+
+def to_micros(timestamp, tz=None):
+    """
+    Converts an ISO timestamp string to microseconds since 1970-01-01, in
+    local (wall-clock) time. Timestamps without a UTC offset are taken as they
+    are; timestamps with an offset are first converted to the given timezone.
+
+    Args:
+        timestamp (str): ISO timestamp, as produced by datetime.isoformat().
+        tz (tzinfo, optional): Timezone for timestamps with an offset. Defaults
+            to the system's local timezone.
+
+    Returns:
+        int: The timestamp as an integer number of microseconds.
+    """
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(tz).replace(tzinfo=None)
+    return (moment - _EPOCH) // _MICROSECOND
+
+
+def from_micros(stamp):
+    """
+    Converts microseconds since 1970-01-01 back to an ISO timestamp string.
+
+    Args:
+        stamp (int): The timestamp as returned by to_micros().
+
+    Returns:
+        str: The ISO timestamp, in the same format as datetime.isoformat().
+    """
+    return (_EPOCH + timedelta(microseconds=stamp)).isoformat()
+
+
+# Fixed UTC offsets are stored as e.g. 'UTC+09:00', see tz_name()
+_FIXED_OFFSET = re.compile(r"UTC([+-])(\d\d):(\d\d)")
+
+
+def tz_name(tz):
+    """
+    Returns a name for a habit's timezone that tz_from_name() turns back into
+    it, so it can be stored: the key of a ZoneInfo (e.g. 'Europe/Berlin'),
+    or 'UTC+HH:MM' for a fixed offset. None (the system's local timezone)
+    stays None.
+
+    Raises:
+        ValueError: If the timezone has neither a key nor a fixed offset.
+    """
+    if tz is None:
+        return None
+    if isinstance(tz, ZoneInfo) and tz.key:
+        return tz.key
+    if isinstance(tz, timezone):
+        minutes = int(tz.utcoffset(None).total_seconds()) // 60
+        return f"UTC{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+    raise ValueError(f"Can't store timezone {tz!r} (use a ZoneInfo or a fixed offset)")
+
+
+def tz_from_name(name):
+    """
+    Returns the timezone stored under a name by tz_name().
+    """
+    if name is None:
+        return None
+    match = _FIXED_OFFSET.fullmatch(name)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        return timezone(-offset if sign == "-" else offset)
+    return ZoneInfo(name)
+
 
 class Habit:
     """
     Represents a single habit with its name, periodicity, creation date, and completions.
+
+    Besides the ISO strings in 'completions', a habit keeps its completions as a
+    sorted list of integer timestamps together with all of its streaks, so that
+    complete() and get_streak() don't have to re-parse and re-sort the whole history.
+
+    A compact habit keeps only the integer timestamps, packed into an array('q'),
+    and builds the ISO strings on demand. This needs a fraction of the memory for
+    long histories, at the cost of 'completions' being a sorted tuple built on each access.
     """
-    def __init__(self, name, periodicity, created_at=None, completions=None):
+    __slots__ = ('name', 'periodicity', 'created_at', 'tz', 'week_start', '_completions',
+                 '_stamps', '_runs', '_longest', '_saved_count', '_saved_runs', '_bucket', '_version',
+                 '_listener')
+
+    def __init__(self, name, periodicity, created_at=None, completions=None, compact=False,
+                 tz=None, week_start=0):
         """
         Initializes a new Habit instance.
 
         Args:
             name (str): The name of the habit.
-            periodicity (str): The frequency, either 'daily' or 'weekly'.
+            periodicity (str): The frequency: 'daily', 'weekly', 'monthly' or 'every N days'.
             created_at (str, optional): ISO timestamp of creation. Defaults to now.
             completions (list, optional): List of ISO timestamp strings for completions.
+            compact (bool, optional): Store completions only as packed integer timestamps.
+            tz (tzinfo, optional): Timezone whose calendar days count for streaks.
+                Defaults to the system's local timezone.
+            week_start (int, optional): First day of the week for weekly habits, Monday = 0.
         """
         self.name = name
         self.periodicity = periodicity
+        self.tz = tz
+        self.week_start = week_start
+        self._listener = None  # Called with the habit whenever it changes (see HabitManager)
         # Use current time if created_at is not provided, storing it as an ISO string
-        self.created_at = created_at or datetime.now().isoformat()
+        self.created_at = created_at or datetime.now(tz).isoformat()
+        self._bucket = None  # Cached (settings, bucketer), see bucketer()
+        # In compact mode there is no list of ISO strings, only the timestamp array
+        self._completions = None if compact else []
         # Initialize completions list, defaulting to an empty list
         self.completions = completions or []
 
-    def complete(self):
+    @property
+    def compact(self):
+        """
+        bool: Whether completions are stored only as packed integer timestamps.
+        """
+        return self._completions is None
+
+    @property
+    def version(self):
+        """
+        int: Changes whenever the completions change, so results calculated from
+        them (e.g. streaks) can be cached until the version moves on.
+        """
+        self._sync()
+        return self._version
+
+    @property
+    def completions(self):
+        """
+        list: The ISO timestamp strings of all completions, in the order they were added.
+        For a compact habit this is a tuple, in chronological order, built on each access;
+        being immutable, it can't be appended to in place like the list (use complete()).
+        """
+        if self.compact:
+            return tuple(self.iso_completions())
+        return self._completions
+
+    @completions.setter
+    def completions(self, completions):
+        # Assigning a whole new list means the streak state has to be rebuilt
+        if self.compact:
+            self._stamps = array('q', sorted(to_micros(ts, self.tz) for ts in completions))
+            self._count_runs()
+        else:
+            self._completions = completions
+            self._rebuild()
+        # Number of completions already written to the database; None means any
+        # stored completions are out of date and have to be rewritten on the next save
+        self._saved_count = None
+
+    @property
+    def stamps(self):
+        """
+        tuple: The completion timestamps as integer microseconds (see to_micros()),
+        sorted chronologically. A copy, so changes can't bypass complete().
+        """
+        self._sync()
+        return tuple(self._stamps)
+
+    @property
+    def completion_count(self):
+        """
+        int: The number of completions, without building the ISO strings of a compact habit.
+        """
+        self._sync()
+        return len(self._stamps)
+
+    def completions_between(self, start=None, end=None):
         """
-        Marks the habit as completed at the current time.
+        Returns the completions within a time range, found by binary search
+        instead of scanning all completions.
+
+        Args:
+            start (str, optional): ISO timestamp; completions at or after it are included.
+            end (str, optional): ISO timestamp; completions before it are included.
+
+        Returns:
+            list: ISO timestamp strings in local time, in chronological order.
+        """
+        first, last = self._range(start, end)
+        return [from_micros(stamp) for stamp in self._stamps[first:last]]
+
+    def count_between(self, start=None, end=None):
+        """
+        Counts the completions within a time range (see completions_between()).
+
+        Returns:
+            int: The number of completions at or after 'start' and before 'end'.
+        """
+        first, last = self._range(start, end)
+        return last - first
+
+    def _range(self, start, end):
+        """
+        Returns the positions in the sorted timestamps where a time range begins and ends.
+        """
+        self._sync()
+        stamps = self._stamps
+        first = bisect_left(stamps, to_micros(start, self.tz)) if start else 0
+        last = bisect_left(stamps, to_micros(end, self.tz)) if end else len(stamps)
+        return first, max(first, last)
+
+    def iso_completions(self, start=0):
+        """
+        Returns the ISO timestamp strings of the completions from a given position on.
+
+        Args:
+            start (int, optional): Index of the first completion to return.
+
+        Returns:
+            list: ISO timestamp strings, in the same order as 'completions'.
+        """
+        if self.compact:
+            return [from_micros(stamp) for stamp in self._stamps[start:]]
+        return self._completions[start:]
+
+    def complete(self, timestamp=None):
+        """
+        Marks the habit as completed at the current time (or at the given time).
         Appends the current timestamp (as an ISO string) to the completions list.
+
+        Args:
+            timestamp (str, optional): ISO timestamp of the completion, if not now.
         """
-        timestamp = datetime.now().isoformat()
-        self.completions.append(timestamp)
+        timestamp = timestamp or datetime.now(self.tz).isoformat()
+        self._sync()
+        if not self.compact:
+            self._completions.append(timestamp)
+        self._add_stamp(to_micros(timestamp, self.tz))
 
     def get_streak(self):
         """
         Calculates the current consecutive completion streak based on the habit's periodicity.
 
         Returns:
-            int: The number of consecutive days or weeks the habit was completed.
-        """
-        if not self.completions:
-            return 0  # A streak of 0 if there are no completions
-
-        # Convert timestamp strings to datetime objects and sort them chronologically
-        sorted_dates = sorted(datetime.fromisoformat(ts) for ts in self.completions)
-        streak = 1  # The most recent completion always counts as a streak of 1
-
-        # Iterate backwards from the second-to-last completion to find consecutive periods
-        for i in range(len(sorted_dates) - 1, 0, -1):
-            current_date = sorted_dates[i]
-            previous_date = sorted_dates[i - 1]
-            delta = current_date - previous_date
-
-            # Check if the time difference is within the period for a daily or weekly habit
-            if self.periodicity == 'daily' and delta <= timedelta(days=1.5):
-                # A small buffer (0.5 days) is used to account for completions on the same day
-                # or for slightly more than 24 hours between completions
-                streak += 1
-            elif self.periodicity == 'weekly' and delta <= timedelta(days=7.5):
-                # A small buffer (0.5 weeks) is used for weekly streaks
-                streak += 1
+            int: The number of consecutive periods (days, weeks, ...) the habit was completed.
+        """
+        self._sync()
+        return self._runs[-1][2] if self._runs else 0  # A streak of 0 if there are no completions
+
+    def get_longest_streak(self):
+        """
+        Returns the longest streak the habit has ever reached.
+
+        Returns:
+            int: The length of the longest run of consecutive completions.
+        """
+        self._sync()
+        return self._longest
+
+    def get_streak_runs(self):
+        """
+        Returns every streak of the habit, from the oldest to the current one.
+
+        Returns:
+            list: (start, end, length) tuples, where start and end are the ISO
+            timestamps of the first and last completion of the streak.
+        """
+        self._sync()
+        return [(from_micros(start), from_micros(end), length) for start, end, length in self._runs]
+
+    def due_times(self):
+        """
+        Works out when the habit is next due and when its current streak breaks,
+        from its periodicity and its last completion. The habit is due from the
+        start of the first period after the one of its last completion (or of
+        its creation, if it was never completed), and the streak breaks when
+        that period ends without a completion.
+
+        Returns:
+            tuple or None: (due, deadline) as integer timestamps in the habit's
+            local time (see to_micros()); the deadline is None for a habit that
+            has no streak yet. None for an unsupported periodicity.
+        """
+        bucket = self.bucketer()
+        if bucket is None:
+            return None
+        last = self._last_stamp()
+        if last is None:
+            return bucket.start(bucket(to_micros(self.created_at, self.tz))), None
+        period = bucket(last)
+        return bucket.start(period + 1), bucket.start(period + 2)
+
+    def _last_stamp(self):
+        """
+        Returns the timestamp of the latest completion, or None if there is none.
+        """
+        self._sync()
+        return self._stamps[-1] if self._stamps else None
+
+    def _sync(self):
+        """
+        Rebuilds the streak state if the completions list was changed in place
+        (e.g. appended to directly) instead of through complete().
+        """
+        if self._completions is not None and len(self._stamps) != len(self._completions):
+            self._rebuild()
+
+    def _rebuild(self):
+        """
+        Re-parses and sorts all completions and recalculates the streaks from scratch.
+        """
+        self._stamps = sorted(to_micros(ts, self.tz) for ts in self._completions)
+        self._count_runs()
+
+    def _moved_on(self):
+        """
+        Gives the habit a new version after its completions changed, and tells
+        the listener (the HabitManager holding the habit), if there is one.
+        """
+        self._version = next_version()
+        if self._listener is not None:
+            self._listener(self)
+
+    def bucketer(self):
+        """
+        Returns the function mapping this habit's timestamps to period indices
+        (see periods.make_bucketer()), or None for an unsupported periodicity.
+        """
+        # Parsing the periodicity and creation date is kept out of complete() by
+        # caching the bucketer until one of the settings it depends on changes
+        settings = (self.periodicity, self.week_start, self.tz, self.created_at)
+        cached = self._bucket
+        if cached is None or cached[0] != settings:
+            bucket = make_bucketer(self.periodicity, self.week_start,
+                                   to_micros(self.created_at, self.tz))
+            cached = self._bucket = (settings, bucket)
+        return cached[1]
+
+    def _add_stamp(self, stamp):
+        """
+        Adds a single integer timestamp to the sorted list and updates the streaks.
+
+        Completions normally arrive in chronological order, in which case the current
+        streak is extended (or a new one started) in constant time. An older timestamp
+        is inserted at its sorted position and the streaks are recounted.
+        """
+        stamps = self._stamps
+        if not stamps or stamp >= stamps[-1]:
+            runs = self._runs
+            bucket = self.bucketer()
+            step = bucket(stamp) - bucket(stamps[-1]) if stamps and bucket else None
+            if step == 0:
+                runs[-1][1] = stamp  # Another completion in the same period
+            elif step == 1:
+                run = runs[-1]
+                run[1] = stamp
+                run[2] += 1
+                if run[2] > self._longest:
+                    self._longest = run[2]
             else:
-                break  # If the gap is too large, the streak is broken
+                runs.append([stamp, stamp, 1])  # The most recent completion always counts as a streak of 1
+                self._longest = max(self._longest, 1)
+            stamps.append(stamp)
+        else:
+            insort(stamps, stamp)
+            self._count_runs()
+            if self.compact:
+                # The stored order of a compact habit is chronological, so
+                # saving by position no longer works and a rewrite is needed
+                self._saved_count = None
+        self._moved_on()
 
-        return streak
+    def _count_runs(self):
+        """
+        Splits the sorted timestamps into streaks in a single pass. Every timestamp is
+        mapped to its period once; completions in the same period count only once,
+        and a streak continues as long as each period directly follows the previous one.
+        Each streak is stored as a [start, end, length] list, so the current one can
+        be extended in place.
+        """
+        runs = []
+        longest = 0
+        run = None
+        previous = None
+        for stamp, index in zip(self._stamps, period_indices(self._stamps, self.bucketer())):
+            if run is not None and index == previous:
+                run[1] = stamp
+            elif run is not None and index == previous + 1:
+                run[1] = stamp
+                run[2] += 1
+            else:
+                run = [stamp, stamp, 1]
+                runs.append(run)
+            longest = max(longest, run[2])
+            previous = index
+        self._runs = runs
+        self._longest = longest
+        self._moved_on()
+        # Number of streaks already written to the database; None means the
+        # stored streaks are out of date and have to be rewritten on the next save
+        self._saved_runs = None
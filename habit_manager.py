@@ -1,21 +1,141 @@
-from habit import Habit
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from habit import Habit, from_micros, next_version, to_micros
+from periods import normalize_periodicity
+
+HOUR = 3_600_000_000  # One hour in microseconds
 
 class HabitManager:
-    def __init__(self):
+    def __init__(self, journal=None):
         """
         Initializes a new HabitManager with an empty list of habits.
+
+        Args:
+            journal (CompletionJournal, optional): Records every change as it is
+                made, so it survives a crash before the next save (see journal.py).
         """
+        self.journal = journal
         self.habits = []  # List to store Habit objects
 
+    @property
+    def habits(self):
+        """
+        tuple: The Habit objects managed by this manager, in the order they were added.
+        It can't be changed; use add_habit() and delete_habit(), or assign a new list.
+        The same tuple is returned until habits are added, deleted or replaced.
+        """
+        if self._habits is None:
+            self._habits = tuple(self._index.values())
+        return self._habits
+
+    @property
+    def version(self):
+        """
+        int: Changes whenever habits are added, deleted or replaced, or one of
+        them changes, whether through this manager or directly on the Habit.
+        """
+        return self._version
+
+    @property
+    def names_version(self):
+        """
+        int: Changes only when habits are added, deleted or replaced, i.e. when
+        the set of habits (and so their names and periodicities) changes.
+        """
+        return self._names_version
+
+    def changed_since(self, version):
+        """
+        Returns the names of the habits added, deleted or changed since the
+        manager had a given version, so results derived from all habits can be
+        updated for just those. The cost depends on the number of changed
+        habits, not on the number of habits.
+
+        Args:
+            version (int): A version the manager had (see 'version').
+
+        Returns:
+            list or None: The names, the most recently changed first, or None if
+            all habits were replaced since then.
+        """
+        if version < self._replaced_version:
+            return None
+        names = []
+        for name, changed in reversed(self._change_log.items()):
+            if changed <= version:
+                break
+            names.append(name)
+        return names
+
+    def _changed(self, names=False, name=None):
+        """
+        Moves the version on after a change, and the names_version too if 'names' is set.
+        'name' is the habit that was added, deleted or changed, for changed_since().
+        """
+        self._version = next_version()
+        if names:
+            self._names_version = self._version
+            self._habits = None  # Rebuilt by the next read of 'habits'
+        if name is not None:
+            self._change_log[name] = self._version
+            self._change_log.move_to_end(name)
+
+    def _habit_changed(self, habit):
+        """
+        Called by a habit of this manager whenever its completions change (see
+        Habit._moved_on()), including completions made directly on the Habit.
+        """
+        self._reschedule(habit)
+        self._changed(name=habit.name)
+
+    @habits.setter
+    def habits(self, habits):
+        # Habits are kept in a dict keyed by name, which also remembers the
+        # insertion order, so lookups and deletions don't have to scan a list
+        index = {}
+        for habit in habits:
+            if habit.name in index:
+                raise ValueError(f"Duplicate habit name: '{habit.name}'")
+            index[habit.name] = habit
+        for habit in getattr(self, "_index", {}).values():
+            habit._listener = None
+        for habit in index.values():
+            habit._listener = self._habit_changed
+        self._index = index
+        self._schedule = None  # Deadline index, built by the first query (see _scheduled())
+        self._changed(names=True)
+        # Habits changed since the last replacement, by name, the most recent last
+        self._change_log = OrderedDict()
+        self._replaced_version = self._version
+        # A freshly assigned list (e.g. just loaded from the database) has no pending changes
+        self.clear_changes()
+
     def add_habit(self, name, periodicity):
         """
         Adds a new habit to the manager.
 
         Args:
             name (str): Name of the habit (e.g., 'Read Book').
-            periodicity (str): Frequency of the habit, either 'daily' or 'weekly'.
+            periodicity (str): Frequency of the habit: 'daily', 'weekly', 'monthly'
+                or 'every N days'. It is stored in its canonical spelling.
+
+        Raises:
+            ValueError: If a habit with the same name already exists, or the
+                periodicity is not supported.
         """
-        self.habits.append(Habit(name, periodicity))
+        if name in self._index:
+            raise ValueError(f"Habit '{name}' already exists.")
+        habit = Habit(name, normalize_periodicity(periodicity))
+        habit._listener = self._habit_changed
+        self._index[name] = habit
+        self._added[name] = habit
+        self._reschedule(habit)
+        self._changed(names=True, name=name)
+        if self.journal is not None:
+            self.journal.append("add", name=name, periodicity=habit.periodicity,
+                                created_at=habit.created_at)
 
     def delete_habit(self, name):
         """
@@ -24,8 +144,19 @@ class HabitManager:
         Args:
             name (str): Name of the habit to delete.
         """
-        # Create a new list with all habits except the one to delete
-        self.habits = [h for h in self.habits if h.name != name]
+        habit = self._index.pop(name, None)
+        if habit is None:
+            return  # Nothing to delete
+        habit._listener = None
+        self._unschedule(name)
+        self._changed(names=True, name=name)
+        if self.journal is not None:
+            self.journal.append("delete", name=name)
+
+        # A habit added since the last save never reached the database
+        if self._added.pop(name, None) is None:
+            self._deleted.add(name)
+        self._completed.pop(name, None)
 
     def complete_habit(self, name):
         """
@@ -37,11 +168,21 @@ class HabitManager:
         Returns:
             bool: True if the habit was found and completed, False otherwise.
         """
-        for habit in self.habits:
-            if habit.name == name:
-                habit.complete()
-                return True  # Habit found and completed
-        return False  # Habit not found
+        habit = self._index.get(name)
+        if habit is None:
+            return False  # Habit not found
+
+        if self.journal is None:
+            habit.complete()
+        else:
+            timestamp = datetime.now(habit.tz).isoformat()
+            habit.complete(timestamp)
+            self.journal.append("complete", name=name, ts=timestamp)
+        # The habit has told the manager about the change (see _habit_changed())
+        # New habits are saved with all their completions anyway
+        if name not in self._added:
+            self._completed[name] = habit
+        return True  # Habit found and completed
 
     def get_habit(self, name):
         """
@@ -53,7 +194,167 @@ class HabitManager:
         Returns:
             Habit or None: The matching Habit object, or None if not found.
         """
-        for habit in self.habits:
-            if habit.name == name:
-                return habit
-        return None  # Habit not found
+        return self._index.get(name)  # None if the habit is not found
+
+    def completions_between(self, name, start=None, end=None):
+        """
+        Retrieves the completions of a habit within a time range (see Habit.completions_between()).
+
+        Args:
+            name (str): Name of the habit.
+            start (str, optional): ISO timestamp; completions at or after it are included.
+            end (str, optional): ISO timestamp; completions before it are included.
+
+        Returns:
+            list or None: ISO timestamps in chronological order, or None if the habit is not found.
+        """
+        habit = self._index.get(name)
+        return habit.completions_between(start, end) if habit else None
+
+    def counts_between(self, start=None, end=None):
+        """
+        Counts the completions of every habit within a time range.
+
+        Returns:
+            dict: The number of completions per habit name.
+        """
+        return {name: habit.count_between(start, end) for name, habit in self._index.items()}
+
+    # --- Deadline index ---
+    # Reminders have to find the habits that are due or about to break their
+    # streak without asking every habit. The manager keeps each habit's due
+    # time and deadline (see Habit.due_times()) in two sorted lists, updated by
+    # add_habit(), delete_habit() and complete_habit(), so a query is a binary
+    # search plus the habits it returns. Habits completed directly on the Habit
+    # object report it to the manager too. Times are the system's local time.
+
+    def due_habits(self, now=None):
+        """
+        Finds the habits that still have to be done in their current period.
+
+        Args:
+            now (str, optional): ISO timestamp to check at. Defaults to now.
+
+        Returns:
+            list: (name, ISO timestamp since when it is due) tuples, longest overdue first.
+        """
+        due = self._scheduled()[1]
+        return [(name, from_micros(stamp)) for stamp, name in due[:bisect_left(due, (self._stamp(now) + 1,))]]
+
+    def at_risk(self, hours, now=None):
+        """
+        Finds the habits whose streak breaks within the next hours unless they are done.
+
+        Args:
+            hours (float): How far to look ahead.
+            now (str, optional): ISO timestamp to check at. Defaults to now.
+
+        Returns:
+            list: (name, ISO timestamp of the deadline) tuples, the most urgent first.
+        """
+        schedule, _, deadlines = self._scheduled()
+        now = self._stamp(now)
+        first = bisect_left(deadlines, (now + 1,))
+        last = bisect_left(deadlines, (now + int(hours * HOUR) + 1,))
+        # A habit already done this period has a deadline in the next one; it isn't due yet
+        return [(name, from_micros(stamp)) for stamp, name in deadlines[first:last]
+                if schedule[name][0] <= now]
+
+    def broken_habits(self, since=None, now=None):
+        """
+        Finds the habits whose streak has broken because a period passed without completion.
+
+        Args:
+            since (str, optional): ISO timestamp; only streaks broken at or after it.
+            now (str, optional): ISO timestamp to check at. Defaults to now.
+
+        Returns:
+            list: (name, ISO timestamp when the streak broke) tuples, in that order.
+        """
+        deadlines = self._scheduled()[2]
+        first = bisect_left(deadlines, (to_micros(since),)) if since else 0
+        last = bisect_left(deadlines, (self._stamp(now) + 1,))
+        return [(name, from_micros(stamp)) for stamp, name in deadlines[first:last]]
+
+    @staticmethod
+    def _stamp(moment):
+        """
+        Converts an ISO timestamp (or now, for None) to an integer timestamp.
+        """
+        return to_micros(moment or datetime.now().isoformat())
+
+    def _scheduled(self):
+        """
+        Returns the deadline index, building it on first use: a dict of habit
+        name -> (due, deadline), and sorted lists of (due, name) and (deadline, name).
+        """
+        if self._schedule is None:
+            schedule = {}
+            for habit in self._index.values():
+                times = self._due_times(habit)
+                if times is not None:
+                    schedule[habit.name] = times
+            self._due = sorted((due, name) for name, (due, _) in schedule.items())
+            self._deadlines = sorted((deadline, name) for name, (_, deadline) in schedule.items()
+                                     if deadline is not None)
+            self._schedule = schedule
+        return self._schedule, self._due, self._deadlines
+
+    @staticmethod
+    def _due_times(habit):
+        """
+        Returns a habit's (due, deadline) in the system's local time, or None.
+        """
+        times = habit.due_times()
+        if times is None or habit.tz is None:
+            return times
+        # Habits in another timezone count their periods in that timezone's wall time
+        epoch = datetime(1970, 1, 1, tzinfo=habit.tz)
+        return tuple(None if stamp is None else
+                     to_micros((epoch + timedelta(microseconds=stamp)).isoformat())
+                     for stamp in times)
+
+    def _reschedule(self, habit):
+        """
+        Updates the deadline index after a habit was added or completed.
+        """
+        if self._schedule is None:
+            return  # Not built yet; the first query builds it from scratch
+        self._unschedule(habit.name)
+        times = self._due_times(habit)
+        if times is None:
+            return  # No schedule for an unsupported periodicity
+        self._schedule[habit.name] = times
+        insort(self._due, (times[0], habit.name))
+        if times[1] is not None:
+            insort(self._deadlines, (times[1], habit.name))
+
+    def _unschedule(self, name):
+        """
+        Removes a habit from the deadline index.
+        """
+        times = self._schedule.pop(name, None) if self._schedule is not None else None
+        if times is None:
+            return
+        due, deadline = times
+        del self._due[bisect_left(self._due, (due, name))]
+        if deadline is not None:
+            del self._deadlines[bisect_left(self._deadlines, (deadline, name))]
+
+    def get_changes(self):
+        """
+        Returns the changes made since the habits were loaded or last saved,
+        in the form expected by StorageHandler.save_changes().
+
+        Returns:
+            tuple: (added habits, deleted habit names, completed habits).
+        """
+        return list(self._added.values()), list(self._deleted), list(self._completed.values())
+
+    def clear_changes(self):
+        """
+        Forgets all tracked changes, e.g. after they have been saved.
+        """
+        self._added = {}       # Habits added since the last save, by name
+        self._deleted = set()  # Names of stored habits that were deleted
+        self._completed = {}   # Stored habits completed since the last save, by name
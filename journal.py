@@ -0,0 +1,153 @@
+# journal.py
+
+# This file contains the completion journal: an append-only file that makes
+# every change made through a HabitManager (adding, deleting and completing
+# habits) durable as soon as it happens, without saving to the database.
+# Each change is one line of JSON with an increasing sequence number:
+#
+#   {"seq": 12, "op": "complete", "name": "Read Book", "ts": "2024-01-02T21:15:00"}
+#
+# StorageHandler.checkpoint() saves the changes to the database together with
+# the sequence number they reach, then drops them from the journal. After a
+# crash, StorageHandler.load() replays the entries the database doesn't have
+# yet, so nothing is lost and nothing is applied twice.
+
+import json
+import os
+
+# fdatasync() skips flushing file metadata that isn't needed to read the data
+# back; it is missing on some platforms (e.g. macOS), where fsync() is used
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+
+class CompletionJournal:
+    """
+    An append-only journal of habit changes, flushed to disk with fsync.
+    """
+    def __init__(self, path, sync_every=1):
+        """
+        Opens (or creates) a journal file.
+
+        Args:
+            path (str): The journal file, e.g. 'habits.db.journal'.
+            sync_every (int, optional): Flush to disk after this many entries.
+                1 makes every entry durable before append() returns; larger
+                values trade the last few entries on a power failure for speed.
+                0 leaves flushing to the operating system (or sync()).
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.seq = 0       # Sequence number of the last entry
+        self.pending = 0   # Entries not yet checkpointed into the database
+        self._unsynced = 0
+        self._repair()
+        for entry in self._read():
+            self.seq = max(self.seq, entry["seq"])
+            self.pending += entry["op"] != "checkpoint"
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _repair(self):
+        """
+        Cuts off a partly written last line, left behind if the process died while
+        appending, so new entries don't get glued to it.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as file:
+            data = file.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                file.truncate(end)
+
+    def _read(self):
+        """
+        Yields every entry in the file, including checkpoint markers.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+
+    def entries(self, after=0):
+        """
+        Returns the journaled changes with a sequence number above 'after', in order.
+
+        Returns:
+            list: Dictionaries with 'seq', 'op' ('add', 'delete' or 'complete'),
+            'name' and the fields of the operation.
+        """
+        return [entry for entry in self._read() if entry["op"] != "checkpoint" and entry["seq"] > after]
+
+    def append(self, op, **fields):
+        """
+        Writes one change to the journal.
+
+        Args:
+            op (str): 'add' (with 'periodicity' and 'created_at'), 'delete' or
+                'complete' (with 'ts').
+            **fields: The habit 'name' and the fields of the operation.
+
+        Returns:
+            int: The sequence number of the entry.
+        """
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "op": op, **fields}) + "\n"
+        os.write(self._fd, line.encode("utf-8"))  # O_APPEND: one write() per entry
+        self.pending += 1
+        self._unsynced += 1
+        if self.sync_every and self._unsynced >= self.sync_every:
+            self.sync()
+        return self.seq
+
+    def advance(self, seq):
+        """
+        Makes sure new entries are numbered after 'seq', the last entry the
+        database has stored. A journal file that was lost or deleted starts
+        counting at 1 again, and its entries would be taken as stored already.
+        """
+        if seq > self.seq:
+            self.seq = seq
+
+    def sync(self):
+        """
+        Flushes the entries written so far to disk.
+        """
+        if self._unsynced:
+            _datasync(self._fd)
+            self._unsynced = 0
+
+    def truncate(self, seq):
+        """
+        Drops the entries up to 'seq' once they are in the database. The file is
+        replaced atomically, starting with a marker that keeps the sequence
+        numbers increasing after a restart.
+        """
+        remaining = self.entries(after=seq)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(json.dumps({"seq": self.seq, "op": "checkpoint"}) + "\n")
+            for entry in remaining:
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.pending = len(remaining)
+        self._unsynced = 0
+
+    def close(self):
+        """
+        Flushes and closes the journal file.
+        """
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,8 +1,16 @@
 # Import necessary classes and modules
+import argparse
+import cProfile
+import pstats
 from habit import Habit
 from habit_manager import HabitManager
+from journal import CompletionJournal
 from storage import StorageHandler
 import analytics
+import metrics
+
+# Journaled changes that are moved into the database in one go
+CHECKPOINT_EVERY = 50
 
 # Function to display the menu to the user
 def menu():
@@ -16,7 +24,7 @@ def menu():
     print("4. View All Habits")                    # Show all current habits
     print("5. Filter Habits")                      # Show habits filtered by periodicity
     print("6. Longest Streak")                     # Show the longest streak across all habits
-    print("7. Longest Streak for a Habit")         # Show the streak of a specific habit
+    print("7. Longest Streak for a Habit")         # Show the longest streak of a specific habit
     print("8. Save & Exit")                        # Save habits and exit the app
 
 # Main function that runs the habit tracker loop
@@ -25,9 +33,13 @@ def run():
     The main loop of the application. It initializes the HabitManager and
     StorageHandler, loads existing habits, and presents the menu to the user.
     """
-    manager = HabitManager()                       # Create a new HabitManager instance
     storage = StorageHandler()                     # Create a new StorageHandler instance
-    manager.habits = storage.load()                # Load saved habits from the database
+    journal = CompletionJournal(storage.db_name + ".journal")  # Every change is on disk right away
+    manager = HabitManager(journal=journal)        # Create a new HabitManager instance
+    # Replays changes a crash left unsaved, then loads the habits lazily: their
+    # completions are only read from the database when they are needed
+    manager.habits = storage.load(lazy=True, journal=journal)
+    cache = analytics.CachedAnalytics(manager)     # Repeated analytics are answered from a cache
 
     # If no habits were loaded from the database, add the predefined ones.
     if not manager.habits:
@@ -40,15 +52,21 @@ def run():
 
     # Infinite loop to keep the menu running until the user chooses to exit
     while True:
+        if journal.pending >= CHECKPOINT_EVERY:
+            storage.checkpoint(journal, *manager.get_changes())  # Keeps the journal short
+            manager.clear_changes()
         menu()                                     # Display menu options
         choice = input("Choose an option: ")       # Get user choice
 
         if choice == "1":
             # Add a new habit
             name = input("Habit name: ")
-            period = input("Periodicity (daily/weekly): ")
-            manager.add_habit(name, period)
-            print(f"Habit '{name}' added.")
+            period = input("Periodicity (daily/weekly/monthly/every N days): ")
+            try:
+                manager.add_habit(name, period)
+                print(f"Habit '{name}' added.")
+            except ValueError as error:
+                print(error)                       # Duplicate name or unknown periodicity
 
         elif choice == "2":
             # Delete an existing habit
@@ -71,32 +89,66 @@ def run():
                 print(f"{habit.name} ({habit.periodicity}) - Streak: {habit.get_streak()}")
 
         elif choice == "5":
-            # Filter habits by periodicity (daily/weekly)
-            period = input("Filter by (daily/weekly): ")
-            filtered = analytics.filter_by_periodicity(manager.habits, period)
+            # Filter habits by periodicity (daily/weekly/monthly/every N days)
+            period = input("Filter by (daily/weekly/monthly/every N days): ")
+            filtered = cache.filter_by_periodicity(period)
             print(f"\n--- {period.capitalize()} Habits ---")
             print(filtered)
 
         elif choice == "6":
-            # Show the longest streak among all habits
-            longest_streak = analytics.get_longest_streak_all(manager.habits)
+            # Show the longest streak ever reached among all habits
+            longest_streak = cache.get_longest_streak_all()
             print("Longest streak overall:", longest_streak)
 
         elif choice == "7":
             # Show the longest streak for a specific habit
             name = input("Enter habit name: ")
-            streak = analytics.get_longest_streak_for(manager.habits, name)
-            print("Streak for", name, ":", streak)
+            streak = cache.get_longest_streak_for(name)
+            print("Longest streak for", name, ":", streak)
 
         elif choice == "8":
-            # Save all habits to the database and exit the program
-            storage.save(manager.habits)
+            # Save the changes made during this session to the database and exit the program
+            storage.checkpoint(journal, *manager.get_changes())
+            manager.clear_changes()
+            journal.close()
+            storage.close()
             print("Data saved. Exiting...")
             break
 
         else:
             print("Invalid option.")               # Handle invalid input
 
+# Entry point with optional profiling of the whole session
+def main(argv=None):
+    """
+    Parses the command-line options and runs the habit tracker.
+    - '--profile FILE' records the session with cProfile, saves the statistics
+      to FILE (for pstats or snakeviz) and prints the most expensive functions.
+    - '--metrics FILE' collects call counts, latencies, database rows and cache
+      hits (see metrics.py) and writes them to FILE in the Prometheus text format.
+    """
+    parser = argparse.ArgumentParser(description="Habit tracker")
+    parser.add_argument("--profile", metavar="FILE", nargs="?", const="habit_tracker.prof",
+                        help="Profile the session and save the statistics (default: habit_tracker.prof)")
+    parser.add_argument("--metrics", metavar="FILE", help="Write metrics in the Prometheus text format")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable([metrics.PrometheusFileSink(args.metrics)])
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.runcall(run)
+        else:
+            run()
+    finally:
+        if args.metrics:
+            metrics.disable()                      # Writes the metrics file
+        if profiler:
+            profiler.dump_stats(args.profile)
+            print(f"\nProfile saved to {args.profile}. Most expensive functions:")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
 # Run the main function when the script is executed directly
 if __name__ == "__main__":
-    run()
+    main()
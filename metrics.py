@@ -0,0 +1,282 @@
+# metrics.py
+
+# This file contains opt-in instrumentation for the hot paths of the habit
+# tracker: call counts and latencies of streak, analytics and storage
+# functions, rows read from and written to the database, and cache hits.
+# Nothing is measured until enable() is called:
+#
+#   registry = metrics.enable([metrics.PrometheusFileSink("metrics.prom")])
+#   ...                                   # use the tracker as usual
+#   metrics.disable()                     # writes the metrics to the sinks
+#
+# Latencies are measured by wrapping the functions listed in TIMED while
+# metrics are enabled, so the functions run unchanged (and at full speed)
+# otherwise. Counters are reported with increment(), which does nothing
+# while metrics are disabled.
+
+import importlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+# Functions whose calls are timed, as (module, class or None, function)
+TIMED = [
+    ("habit", "Habit", "complete"),
+    ("habit", "Habit", "get_streak"),
+    ("habit", "Habit", "get_longest_streak"),
+    ("storage", "StorageHandler", "save"),
+    ("storage", "StorageHandler", "save_changes"),
+    ("storage", "StorageHandler", "load"),
+    ("storage", "StorageHandler", "record_completions"),
+    ("analytics", None, "filter_by_periodicity"),
+    ("analytics", None, "get_longest_streak_all"),
+    ("analytics", None, "get_longest_streak_for"),
+    ("analytics", None, "load_columns"),
+    ("analytics", None, "batch_current_streaks"),
+    ("analytics", None, "batch_longest_streaks"),
+    ("analytics", "CachedAnalytics", "filter_by_periodicity"),
+    ("analytics", "CachedAnalytics", "get_longest_streak_all"),
+    ("analytics", "CachedAnalytics", "get_longest_streak_for"),
+]
+
+# Latencies kept per function for the percentiles (the most recent calls)
+SAMPLE_SIZE = 10_000
+
+# The active registry, or None while metrics are disabled
+_registry = None
+_originals = []  # (owner, attribute, original function) replaced by enable()
+
+
+class Registry:
+    """
+    Collects counters and latencies in memory. It is safe to use from several threads.
+    """
+    def __init__(self, sinks=()):
+        """
+        Args:
+            sinks (iterable, optional): Objects with an emit(snapshot) method,
+                which receive the metrics on every flush().
+        """
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+        self._counters = {}  # Name -> value
+        self._timings = {}   # Name -> [call count, total seconds, deque of recent latencies]
+
+    def increment(self, name, value=1):
+        """
+        Adds 'value' to a counter, creating it at 0 if necessary.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+        Records the latency of one call.
+        """
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, deque(maxlen=SAMPLE_SIZE)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2].append(seconds)
+
+    def snapshot(self):
+        """
+        Returns the current metrics.
+
+        Returns:
+            dict: 'counters' (name -> value), 'timings' (name -> dict with 'count',
+            'total', 'mean', 'p50', 'p95' and 'p99', in seconds) and 'hit_rates'
+            (for every pair of 'X_hits' and 'X_misses' counters, 'X' -> hits / lookups).
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {name: (count, total, sorted(samples))
+                       for name, (count, total, samples) in self._timings.items()}
+
+        hit_rates = {}
+        for name, hits in counters.items():
+            if name.endswith("_hits"):
+                lookups = hits + counters.get(name[:-len("_hits")] + "_misses", 0)
+                hit_rates[name[:-len("_hits")]] = hits / lookups if lookups else 0.0
+        return {
+            "counters": counters,
+            "timings": {name: {"count": count, "total": total, "mean": total / count,
+                               "p50": _percentile(samples, 0.50), "p95": _percentile(samples, 0.95),
+                               "p99": _percentile(samples, 0.99)}
+                        for name, (count, total, samples) in timings.items()},
+            "hit_rates": hit_rates,
+        }
+
+    def flush(self):
+        """
+        Sends the current metrics to every sink.
+        """
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.emit(snapshot)
+
+
+def _percentile(sorted_values, fraction):
+    """
+    Returns the value at the given fraction (0..1) of a sorted list (nearest rank).
+    """
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+class MemorySink:
+    """
+    Keeps every snapshot it receives, e.g. for tests or an admin page.
+    """
+    def __init__(self):
+        self.snapshots = []
+
+    def emit(self, snapshot):
+        self.snapshots.append(snapshot)
+
+
+class LogSink:
+    """
+    Writes one log line per metric to a logger.
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        Args:
+            logger (logging.Logger, optional): Defaults to the 'habit_tracker.metrics' logger.
+            level (int, optional): The level of the log lines.
+        """
+        self.logger = logger or logging.getLogger("habit_tracker.metrics")
+        self.level = level
+
+    def emit(self, snapshot):
+        for name, value in sorted(snapshot["counters"].items()):
+            self.logger.log(self.level, "%s=%s", name, value)
+        for name, timing in sorted(snapshot["timings"].items()):
+            self.logger.log(self.level, "%s calls=%d total=%.6fs p50=%.6fs p95=%.6fs p99=%.6fs",
+                            name, timing["count"], timing["total"],
+                            timing["p50"], timing["p95"], timing["p99"])
+        for name, rate in sorted(snapshot["hit_rates"].items()):
+            self.logger.log(self.level, "%s hit_rate=%.3f", name, rate)
+
+
+class PrometheusFileSink:
+    """
+    Writes the metrics to a file in the Prometheus text format, e.g. for the
+    textfile collector of the node exporter. The file is replaced atomically.
+    """
+    def __init__(self, path, prefix="habit_tracker"):
+        """
+        Args:
+            path (str): The file to write.
+            prefix (str, optional): Prefix of every metric name.
+        """
+        self.path = path
+        self.prefix = prefix
+
+    def emit(self, snapshot):
+        prefix = self.prefix
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = f"{prefix}_{_metric_name(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        if snapshot["timings"]:
+            metric = f"{prefix}_call_duration_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for name, timing in sorted(snapshot["timings"].items()):
+                for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                    lines.append(f'{metric}{{function="{name}",quantile="{quantile}"}} {timing[key]}')
+                lines.append(f'{metric}_sum{{function="{name}"}} {timing["total"]}')
+                lines.append(f'{metric}_count{{function="{name}"}} {timing["count"]}')
+        for name, rate in sorted(snapshot["hit_rates"].items()):
+            metric = f"{prefix}_{_metric_name(name)}_hit_rate"
+            lines += [f"# TYPE {metric} gauge", f"{metric} {rate}"]
+
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary, self.path)
+
+
+def _metric_name(name):
+    """
+    Turns a metric name like 'storage.rows_read' into a valid Prometheus name.
+    """
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def increment(name, value=1):
+    """
+    Adds 'value' to a counter of the active registry; does nothing while metrics are disabled.
+    """
+    if _registry is not None:
+        _registry.increment(name, value)
+
+
+def _timed(name, function):
+    """
+    Wraps a function so every call's latency is recorded under 'name'.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            registry = _registry
+            if registry is not None:
+                registry.observe(name, time.perf_counter() - start)
+    return wrapper
+
+
+def enable(sinks=()):
+    """
+    Starts collecting metrics: installs the timing wrappers on the functions in
+    TIMED and activates a new registry. Calling it again replaces the registry.
+
+    Args:
+        sinks (iterable, optional): Sinks that receive the metrics on flush() and disable().
+
+    Returns:
+        Registry: The active registry.
+    """
+    global _registry
+    _registry = Registry(sinks)
+    if not _originals:
+        for module_name, class_name, function_name in TIMED:
+            module = importlib.import_module(module_name)
+            owner = getattr(module, class_name) if class_name else module
+            original = vars(owner)[function_name]
+            name = f"{class_name or module_name}.{function_name}"
+            _originals.append((owner, function_name, original))
+            setattr(owner, function_name, _timed(name, original))
+    return _registry
+
+
+def disable():
+    """
+    Stops collecting metrics: sends them to the sinks one last time and restores
+    the original functions.
+
+    Returns:
+        Registry or None: The registry that was active, with the final metrics.
+    """
+    global _registry
+    registry, _registry = _registry, None
+    while _originals:
+        owner, function_name, original = _originals.pop()
+        setattr(owner, function_name, original)
+    if registry is not None:
+        registry.flush()
+    return registry
+
+
+def active():
+    """
+    Returns the active registry, or None while metrics are disabled.
+    """
+    return _registry
@@ -0,0 +1,207 @@
+# periods.py
+
+# This file maps completion timestamps to calendar periods. Every completion
+# gets an integer period index (day, week, month or block of N days), so
+# streaks can be found with integer arithmetic: two completions with the same
+# index fall into the same period, and consecutive indices are consecutive
+# periods.
+#
+# Timestamps are integer microseconds of local (wall-clock) time, as returned
+# by habit.to_micros().
+
+import re
+
+DAY = 86_400_000_000  # One day in microseconds
+
+# 1970-01-01 (day 0) was a Thursday; weekdays are counted from Monday = 0
+_EPOCH_WEEKDAY = 3
+
+# Supported periodicities besides 'every N days'
+_UNITS = {"daily": ("day", 1), "weekly": ("week", 1), "monthly": ("month", 1)}
+_EVERY_N_DAYS = re.compile(r"every[\s-]*(\d+)[\s-]*days?")
+
+
+def parse_periodicity(periodicity):
+    """
+    Splits a periodicity into its unit and length.
+
+    Args:
+        periodicity (str): 'daily', 'weekly', 'monthly' or 'every N days'
+            (also written 'every-N-days').
+
+    Returns:
+        tuple: (unit, length), where unit is 'day', 'week' or 'month'.
+
+    Raises:
+        ValueError: If the periodicity is not supported.
+    """
+    text = periodicity.strip().lower() if isinstance(periodicity, str) else ""
+    if text in _UNITS:
+        return _UNITS[text]
+    match = _EVERY_N_DAYS.fullmatch(text)
+    if match and int(match.group(1)) > 0:
+        return "day", int(match.group(1))
+    raise ValueError(f"Invalid periodicity '{periodicity}' "
+                     "(expected daily, weekly, monthly or 'every N days')")
+
+
+def normalize_periodicity(periodicity):
+    """
+    Returns the canonical spelling of a periodicity, e.g. 'Every 1 Day' -> 'daily'.
+
+    Raises:
+        ValueError: If the periodicity is not supported.
+    """
+    unit, length = parse_periodicity(periodicity)
+    if unit == "day" and length > 1:
+        return f"every {length} days"
+    return {"day": "daily", "week": "weekly", "month": "monthly"}[unit]
+
+
+def is_valid_periodicity(periodicity):
+    """
+    Checks whether a periodicity is supported.
+    """
+    try:
+        parse_periodicity(periodicity)
+    except ValueError:
+        return False
+    return True
+
+
+def month_index(day):
+    """
+    Returns year * 12 + month - 1 for a day number (days since 1970-01-01),
+    using integer arithmetic only (Howard Hinnant's civil-from-days algorithm).
+    """
+    z = day + 719468
+    era = z // 146097
+    day_of_era = z - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524
+                   - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153  # March = 0
+    month = shifted_month + 3 if shifted_month < 10 else shifted_month - 9
+    year = year_of_era + era * 400 + (month <= 2)
+    return year * 12 + month - 1
+
+
+def month_start(index):
+    """
+    Returns the day number of the first day of a month, given as
+    year * 12 + month - 1 (the inverse of month_index(), Hinnant's days-from-civil).
+    """
+    year, month = divmod(index, 12)
+    year -= month < 2  # Years start in March, so January and February belong to the previous one
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 10) % 12) + 2) // 5
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+class Bucketer:
+    """
+    Maps timestamps to period indices for one periodicity. Calling it maps a
+    single timestamp; indices() maps a whole sorted list in one go.
+    """
+    __slots__ = ('unit', 'length', '_offset', '_first_day')
+
+    def __init__(self, unit, length, week_start=0, anchor=0):
+        """
+        Args:
+            unit (str): 'day', 'week' or 'month'.
+            length (int): Number of days per period, for the 'day' unit.
+            week_start (int, optional): First day of the week, Monday = 0.
+            anchor (int, optional): Timestamp where blocks of several days start.
+        """
+        self.unit = unit
+        self.length = length
+        self._offset = _EPOCH_WEEKDAY - week_start
+        self._first_day = anchor // DAY if length > 1 else 0
+
+    def __call__(self, stamp):
+        day = stamp // DAY
+        if self.unit == "week":
+            return (day + self._offset) // 7
+        if self.unit == "month":
+            return month_index(day)
+        return (day - self._first_day) // self.length
+
+    def start(self, index):
+        """
+        Returns the timestamp where the period with the given index begins.
+        """
+        if self.unit == "week":
+            day = index * 7 - self._offset
+        elif self.unit == "month":
+            day = month_start(index)
+        else:
+            day = self._first_day + index * self.length
+        return day * DAY
+
+    def indices(self, stamps):
+        """
+        Maps sorted timestamps to their period indices.
+
+        Args:
+            stamps (iterable): Sorted integer timestamps.
+
+        Returns:
+            list: One period index per timestamp, in the same order.
+        """
+        days = [stamp // DAY for stamp in stamps]
+        if self.unit == "week":
+            offset = self._offset
+            return [(day + offset) // 7 for day in days]
+        if self.unit == "month":
+            # Sorted input repeats the same day a lot, so only convert new days
+            indices = []
+            last_day = last_index = None
+            for day in days:
+                if day != last_day:
+                    last_day, last_index = day, month_index(day)
+                indices.append(last_index)
+            return indices
+        if self.length == 1:
+            return days
+        first_day, length = self._first_day, self.length
+        return [(day - first_day) // length for day in days]
+
+
+def make_bucketer(periodicity, week_start=0, anchor=0):
+    """
+    Creates a Bucketer that maps timestamps to period indices.
+
+    Args:
+        periodicity (str): The habit's periodicity (see parse_periodicity()).
+        week_start (int, optional): First day of the week for weekly habits, Monday = 0.
+        anchor (int, optional): Timestamp where 'every N days' blocks start,
+            normally the habit's creation time.
+
+    Returns:
+        Bucketer or None: The bucketer, or None if the periodicity is not supported.
+    """
+    try:
+        unit, length = parse_periodicity(periodicity)
+    except ValueError:
+        return None
+    return Bucketer(unit, length, week_start, anchor)
+
+
+def period_indices(stamps, bucket):
+    """
+    Maps sorted timestamps to their period indices. Without a bucketer (an
+    unsupported periodicity) every completion gets its own, non-consecutive
+    period, so each one is a separate streak of 1.
+
+    Args:
+        stamps (iterable): Sorted integer timestamps.
+        bucket (Bucketer or None): A bucketer returned by make_bucketer().
+
+    Returns:
+        list: One period index per timestamp, in the same order.
+    """
+    if bucket is None:
+        return list(range(0, 2 * len(stamps), 2))
+    return bucket.indices(stamps)
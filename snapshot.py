@@ -0,0 +1,153 @@
+# snapshot.py
+
+# This file contains the snapshot format: a binary copy of all habits that
+# is written next to the database ('habits.db.snapshot') and read back with
+# mmap, so startup doesn't have to go through every completion row and parse
+# its ISO timestamp. The file is laid out as
+#
+#   header      format, schema version, generation, UTC offset, habit count
+#   directory   per habit: first stamp, stamp count, first streak, streak count, longest streak
+#   stamps      the completion timestamps of all habits, as one int64 array
+#   runs        the streaks of all habits, as (start, end, length) int64 triples
+#   names       one JSON list of [name, periodicity, created_at, tz, week_start] per habit
+#
+# Numbers are stored in the machine's own byte order; the snapshot is a cache
+# of the database on the same machine, never a file to exchange. Every write
+# to the database moves its generation on (see StorageHandler), so a snapshot
+# whose generation doesn't match is out of date and the database is used.
+
+import json
+import mmap
+import os
+import struct
+import time
+from array import array
+
+from habit import Habit, next_version, tz_from_name
+
+FORMAT_VERSION = 2
+_MAGIC = b"HABITSNP"
+# magic, format version, schema version, generation, UTC offset (s), habit count
+_HEADER = struct.Struct("=8sIIqqq")
+_ENTRY_SIZE = 5  # int64 values per directory entry
+
+
+def write_snapshot(path, habits, generation, schema_version):
+    """
+    Writes a snapshot file, replacing any previous one atomically.
+
+    Args:
+        path (str): The snapshot file.
+        habits (list): (name, periodicity, created_at, tz, week_start, stamps, runs,
+            longest) per habit, with the timezone by name (see tz_name()), the
+            stamps sorted and the runs as (start, end, length).
+        generation (int): The generation of the database the habits were read from.
+        schema_version (int): The schema version of that database.
+    """
+    directory = array("q")
+    stamps = array("q")
+    runs = array("q")
+    names = []
+    for name, periodicity, created_at, tz, week_start, habit_stamps, habit_runs, longest in habits:
+        directory.extend((len(stamps), len(habit_stamps), len(runs) // 3, len(habit_runs), longest))
+        stamps.extend(habit_stamps)
+        for run in habit_runs:
+            runs.extend(run)
+        names.append([name, periodicity, created_at, tz, week_start])
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(_HEADER.pack(_MAGIC, FORMAT_VERSION, schema_version, generation,
+                                time.timezone, len(names)))
+        for part in (directory, stamps, runs):
+            part.tofile(file)
+        file.write(json.dumps(names).encode("utf-8"))
+    os.replace(temporary, path)
+
+
+def read_generation(path):
+    """
+    Returns the (schema version, generation) a snapshot was written at, or None
+    if the file is missing or not a snapshot this version can read.
+    """
+    try:
+        with open(path, "rb") as file:
+            header = file.read(_HEADER.size)
+    except OSError:
+        return None
+    if len(header) < _HEADER.size:
+        return None
+    magic, version, schema_version, generation, offset, _ = _HEADER.unpack(header)
+    if magic != _MAGIC or version != FORMAT_VERSION or offset != time.timezone:
+        return None  # Another format, byte order or timezone
+    return schema_version, generation
+
+
+def load_snapshot(path, generation, schema_version):
+    """
+    Creates compact habits (see Habit) from a snapshot, if it is up to date.
+    The file is mapped into memory rather than read, and each habit's
+    timestamps are copied out of the map in one piece, since complete() has
+    to be able to append to them.
+
+    Args:
+        path (str): The snapshot file.
+        generation (int): The current generation of the database.
+        schema_version (int): The schema version of the database.
+
+    Returns:
+        list or None: The habits with their completions and streaks, or None if
+        the snapshot is missing, unreadable or out of date.
+    """
+    if read_generation(path) != (schema_version, generation):
+        return None
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            return _read_habits(view)
+        except (ValueError, TypeError, struct.error):
+            return None  # A damaged file; the database has everything
+        finally:
+            view.release()
+
+
+def _read_habits(view):
+    """
+    Does the work of load_snapshot() on the mapped file.
+    """
+    parts = []  # Views into the map, which must be released before it is closed
+
+    def part(start, size, format="B"):
+        parts.append(view[start:start + size])
+        if parts[-1].nbytes != size:
+            raise ValueError("Truncated snapshot")
+        parts[-1] = parts[-1].cast(format)
+        return parts[-1]
+
+    try:
+        count = _HEADER.unpack_from(view)[5]
+        directory = part(_HEADER.size, 8 * _ENTRY_SIZE * count, "q")
+        stamp_total = sum(directory[1::_ENTRY_SIZE])
+        run_total = sum(directory[3::_ENTRY_SIZE])
+        stamps = part(_HEADER.size + directory.nbytes, 8 * stamp_total)  # Raw bytes, for array.frombytes()
+        runs = part(_HEADER.size + directory.nbytes + stamps.nbytes, 24 * run_total, "q")
+        names = json.loads(bytes(view[_HEADER.size + directory.nbytes + stamps.nbytes + runs.nbytes:]))
+        if len(names) != count:
+            raise ValueError("Truncated snapshot")
+
+        habits = []
+        for index, (name, periodicity, created_at, tz, week_start) in enumerate(names):
+            first, length, first_run, run_count, longest = directory[
+                index * _ENTRY_SIZE:(index + 1) * _ENTRY_SIZE].tolist()
+            habit = Habit(name, periodicity, created_at=created_at, compact=True,
+                          tz=tz_from_name(tz), week_start=week_start)
+            habit._stamps.frombytes(stamps[8 * first:8 * (first + length)])
+            flat = runs[3 * first_run:3 * (first_run + run_count)].tolist()
+            habit._runs = [flat[start:start + 3] for start in range(0, len(flat), 3)]
+            habit._longest = longest
+            habit._version = next_version()
+            habits.append(habit)
+        return habits
+    finally:
+        for part_view in parts:
+            part_view.release()
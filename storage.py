@@ -1,6 +1,273 @@
 import sqlite3
 import json
-from habit import Habit
+import threading
+import weakref
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+import metrics
+import snapshot
+from habit import Habit, next_version, to_micros, tz_from_name, tz_name
+from periods import is_valid_periodicity, normalize_periodicity
+
+# Version of the database layout written by this module (stored in PRAGMA user_version).
+# Version 1 kept each habit's completions as a JSON list in 'habits.completions';
+# version 2 stores one row per completion in a separate 'completions' table;
+# version 3 adds the persisted streaks ('streak_runs' and the habits' streak columns);
+# version 4 counts streaks by calendar period, so the stored streaks are recalculated;
+# version 5 stores periodicities in their canonical spelling and indexes them and the
+# longest streaks, for the analytics queries answered in SQL;
+# version 6 adds 'compacted_completions', the counts of completions removed by compact();
+# version 7 adds the 'meta' table, which records how far the journal has been checkpointed
+# and the generation of the database (see snapshot.py);
+# version 8 stores each habit's timezone and first day of the week, which its streaks depend on.
+SCHEMA_VERSION = 8
+
+
+class LazyHabit(Habit):
+    """
+    A Habit whose completions are read from the database the first time they are needed.
+    Until then only the name, periodicity, creation date, the stored current and
+    longest streak and the latest stored streak are held in memory, so showing
+    streaks doesn't load any completions, and neither does completing the habit:
+    a new completion can only extend or follow the latest streak, so it is kept
+    aside with the streaks it changed, until it is saved or the history is loaded.
+    """
+    __slots__ = ('_loader', '_load_compact', '_stored_streak', '_stored_longest', '_tail_runs', '_pending')
+
+    def __init__(self, name, periodicity, created_at, loader, compact=False,
+                 current_streak=0, longest_streak=0, last_run=None, tz=None, week_start=0):
+        """
+        Initializes a lazy habit without touching its completions.
+
+        Args:
+            name (str): The name of the habit.
+            periodicity (str): The frequency of the habit.
+            created_at (str): ISO timestamp of creation.
+            loader (callable): Returns the habit's list of ISO completion timestamps.
+            compact (bool, optional): Become a compact habit once loaded.
+            current_streak (int, optional): The current streak stored in the database.
+            longest_streak (int, optional): The longest streak stored in the database.
+            last_run (tuple, optional): The latest stored streak as (start, end, length),
+                with timestamps as returned by to_micros(), or None if there is none.
+            tz (tzinfo, optional): Timezone whose calendar days count for streaks.
+            week_start (int, optional): First day of the week for weekly habits, Monday = 0.
+        """
+        self.name = name
+        self.periodicity = periodicity
+        self.created_at = created_at
+        self.tz = tz
+        self.week_start = week_start
+        self._bucket = None
+        self._version = next_version()
+        self._listener = None
+        self._loader = loader
+        self._load_compact = compact
+        self._stored_streak = current_streak
+        self._stored_longest = longest_streak
+        # The latest stored streak and any started since, as [start, end, length] lists
+        self._tail_runs = [list(last_run)] if last_run is not None else []
+        self._pending = []  # ISO timestamps of completions that aren't stored yet
+
+    @property
+    def loaded(self):
+        """
+        bool: Whether the completions have been read from the database yet.
+        """
+        return self._loader is None
+
+    @property
+    def version(self):
+        """
+        int: See Habit.version. Reading it doesn't load the completions.
+        """
+        if self._loader is not None:
+            return self._version
+        return super().version
+
+    def complete(self, timestamp=None):
+        """
+        Marks the habit as completed, see Habit.complete(). While the completions
+        aren't loaded, a completion after the latest one only updates the latest
+        streaks; an older one loads the history, since it can change any streak.
+        """
+        if self._loader is None:
+            return super().complete(timestamp)
+        timestamp = timestamp or datetime.now(self.tz).isoformat()
+        stamp = to_micros(timestamp, self.tz)
+        runs = self._tail_runs
+        if runs and stamp < runs[-1][1]:
+            return super().complete(timestamp)
+
+        # A habit holding just the latest streak applies the same rules as
+        # Habit.complete(), as in StorageHandler.record_completion()
+        tail = Habit(self.name, self.periodicity, created_at=self.created_at, compact=True,
+                     tz=self.tz, week_start=self.week_start)
+        if runs:
+            tail._stamps.append(runs[-1][1])
+            tail._runs = [runs[-1]]
+            tail._longest = self._stored_longest
+        tail._add_stamp(stamp)
+        runs[-1:] = tail._runs  # The latest streak grew, or a new one follows it
+        self._stored_streak = tail.get_streak()
+        self._stored_longest = tail.get_longest_streak()
+        self._pending.append(timestamp)
+        self._moved_on()
+
+    def get_streak(self):
+        """
+        Returns the current streak, using the stored value while the completions aren't loaded.
+        """
+        if self._loader is not None:
+            return self._stored_streak
+        return super().get_streak()
+
+    def get_longest_streak(self):
+        """
+        Returns the longest streak, using the stored value while the completions aren't loaded.
+        """
+        if self._loader is not None:
+            return self._stored_longest
+        return super().get_longest_streak()
+
+    def _last_stamp(self):
+        # The end of the latest streak, so due_times() needs no completions
+        if self._loader is not None:
+            return self._tail_runs[-1][1] if self._tail_runs else None
+        return super()._last_stamp()
+
+    def __getattr__(self, attribute):
+        # Only called for attributes that are not set yet, i.e. the completion
+        # state of a habit that hasn't been loaded: load it and try again
+        if attribute in Habit.__slots__ and self._loader is not None:
+            loader, self._loader = self._loader, None
+            self._completions = None if self._load_compact else []
+            self.completions = loader()
+            _mark_loaded(self)  # Everything loaded is already stored
+            pending, self._pending = self._pending, []
+            for timestamp in pending:  # Completed before the history was loaded, not stored yet
+                Habit.complete(self, timestamp)
+            return getattr(self, attribute)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attribute}'")
+
+
+class _SaveBatch:
+    """
+    Collects everything a save has to write, so it reaches the database in a
+    few executemany() calls. Only what changed since a habit was loaded or last
+    saved is included: new completions, the streaks they extended (the last
+    stored streak may have grown, older ones never change) and the habit's
+    current and longest streak. A habit whose completions were replaced or
+    reordered has its stored completions or streaks rewritten instead.
+    """
+    def __init__(self):
+        self.rewritten_completions = []  # (habit_id,) rows whose completions are replaced
+        self.rewritten_runs = []         # (habit_id,) rows whose streaks are replaced
+        self.completions = []            # (habit_id, ts) rows to insert
+        self.runs = []                   # (habit_id, start_ts, end_ts, length) rows to upsert
+        self.streaks = []                # (current, longest, habit_id) rows to update
+        self.saved = []                  # (habit, completion count, streak count) once committed
+        self.pending = []                # (lazy habit, number of its pending completions written)
+
+    def add(self, habit_id, habit, new=False):
+        """
+        Adds the unsaved data of one habit to the batch.
+
+        Args:
+            habit_id (int): The habit's id in the database being written.
+            habit (Habit): The habit.
+            new (bool, optional): The habit's row was just created (or may belong
+                to another database), so everything it holds is written. What the
+                habit remembers as saved refers to where it was loaded from.
+        """
+        if not new and not getattr(habit, "loaded", True):
+            # A lazy habit whose completions were never loaded only has the
+            # completions made since, and the latest streaks they changed
+            if habit._pending:
+                self.completions.extend((habit_id, ts) for ts in habit._pending)
+                self.runs.extend((habit_id, *run) for run in habit._tail_runs)
+                self.streaks.append((habit.get_streak(), habit.get_longest_streak(), habit_id))
+                self.pending.append((habit, len(habit._pending)))
+            return
+
+        count = habit.completion_count  # Loads a lazy habit
+        saved = None if new else habit._saved_count
+        if saved is None or saved > count:
+            self.rewritten_completions.append((habit_id,))
+            saved = 0
+        saved_runs = None if new else habit._saved_runs
+        if saved == count and saved_runs is not None:
+            return  # Nothing changed since the last save
+
+        self.completions.extend((habit_id, ts) for ts in habit.iso_completions(saved))
+        runs = habit._runs
+        if saved_runs is None:
+            self.rewritten_runs.append((habit_id,))
+            saved_runs = 0
+        self.runs.extend((habit_id, *run) for run in runs[max(saved_runs - 1, 0):])
+        self.streaks.append((habit.get_streak(), habit.get_longest_streak(), habit_id))
+        self.saved.append((habit, count, len(runs)))
+
+    def write(self, cursor):
+        """
+        Executes the collected statements; the caller commits the transaction.
+        """
+        cursor.executemany("DELETE FROM completions WHERE habit_id = ?", self.rewritten_completions)
+        # What compact() removed from the replaced history isn't part of the new one
+        cursor.executemany("DELETE FROM compacted_completions WHERE habit_id = ?", self.rewritten_completions)
+        cursor.executemany("DELETE FROM streak_runs WHERE habit_id = ?", self.rewritten_runs)
+        cursor.executemany("INSERT INTO completions (habit_id, ts) VALUES (?, ?)", self.completions)
+        cursor.executemany("""
+            INSERT INTO streak_runs (habit_id, start_ts, end_ts, length)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (habit_id, start_ts) DO UPDATE SET
+                end_ts = excluded.end_ts,
+                length = excluded.length
+        """, self.runs)
+        cursor.executemany(
+            "UPDATE habits SET current_streak = ?, longest_streak = ? WHERE id = ?", self.streaks)
+        metrics.increment("storage.rows_written",
+                          len(self.completions) + len(self.runs) + len(self.streaks))
+
+    def mark_saved(self):
+        """
+        Records what is stored for each habit, once the transaction has been committed.
+        """
+        for habit, count, runs in self.saved:
+            habit._saved_count = count
+            habit._saved_runs = runs
+        for habit, count in self.pending:
+            del habit._pending[:count]
+            del habit._tail_runs[:-1]  # Only the latest streak can still change
+
+
+def _mark_loaded(habit):
+    """
+    Records that everything a freshly loaded habit holds is already stored.
+    """
+    habit._saved_count = habit.completion_count
+    habit._saved_runs = len(habit._runs)
+
+
+class _ThreadConnection:
+    """
+    A thread's connection and cursor, kept in the StorageHandler's thread-local
+    state. When the thread ends, this object is released with the rest of
+    that state, which closes the connection (see _release_connection()).
+    """
+    __slots__ = ('conn', 'cursor', '__weakref__')
+
+
+def _release_connection(connections, lock, conn):
+    """
+    Closes the connection of a thread that has ended, unless close() got to it first.
+    """
+    with lock:
+        if conn not in connections:
+            return
+        connections.remove(conn)
+    conn.close()
+
 
 class StorageHandler:
     """
@@ -8,25 +275,110 @@ class StorageHandler:
     It connects to the SQLite database, creates the necessary tables,
     and provides methods for saving and loading habit data.
     """
-    def __init__(self, db_name="habits.db"):
+    def __init__(self, db_name="habits.db", timeout=5.0):
         """
-        Initializes the database connection.
+        Initializes the database and creates or migrates the tables.
         - 'db_name' is the file name for the database.
-        - 'self.conn' is the connection object to the database.
-        - 'self.cursor' is used to execute SQL commands.
+        - 'timeout' is how many seconds a connection waits for another
+          process's write lock before giving up.
+
+        A StorageHandler can be shared between threads: every thread gets its
+        own connection (see 'conn'), the database runs in WAL mode so readers
+        don't block the writer, and writes from different threads are
+        serialized by a lock. Close it with close(), or use it as a context
+        manager. Note that an in-memory database (':memory:') is not shared
+        between the connections of different threads.
         """
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
-        self.cursor = self.conn.cursor()
-        self._create_table()
+        self.timeout = timeout
+        self._local = threading.local()      # The calling thread's connection and cursor
+        self._connections = set()            # The open connections, for close()
+        self._pool_lock = threading.Lock()   # Guards '_connections' and '_closed'
+        self._write_lock = threading.RLock() # Only one thread writes at a time
+        self._closed = False
+        self._habit_ids = {}  # Database ids of known habits, by name
+        with self._write_lock:
+            self._create_table()
+
+    def _connection(self):
+        """
+        Returns the _ThreadConnection holding the calling thread's connection
+        and cursor, opening the connection on the thread's first use.
+        """
+        state = getattr(self._local, "state", None)
+        if state is None:
+            with self._pool_lock:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+                # close() and the finalizer below may run on another thread, hence
+                # check_same_thread=False; otherwise a connection is only ever used
+                # by the thread that opened it
+                conn = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False)
+                self._connections.add(conn)
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA journal_mode = WAL")     # Readers work alongside a writer
+            conn.execute("PRAGMA synchronous = NORMAL")   # Safe with WAL, fewer fsyncs per commit
+            state = _ThreadConnection()
+            state.conn, state.cursor = conn, conn.cursor()
+            # Close the connection once its thread has ended. The finalizer must
+            # not refer to self, or it would keep the StorageHandler alive.
+            weakref.finalize(state, _release_connection, self._connections, self._pool_lock, conn)
+            self._local.state = state
+        return state
+
+    @property
+    def conn(self):
+        """
+        sqlite3.Connection: The calling thread's connection to the database.
+        """
+        return self._connection().conn
+
+    @property
+    def cursor(self):
+        """
+        sqlite3.Cursor: The calling thread's cursor, used to execute SQL commands.
+        """
+        return self._connection().cursor
 
     def _create_table(self):
         """
-        Creates the 'habits' table in the database if it doesn't already exist.
+        Creates the 'habits', 'completions' and 'streak_runs' tables in the database
+        if they don't already exist, migrating an older database layout if necessary.
         - 'id' is a unique key for each habit.
         - 'name' is the name of the habit, and it must be unique.
-        - 'completions' is stored as a JSON string because SQLite doesn't
-          have a native list type.
+        - Each completion is a separate row in 'completions', indexed by habit
+          and timestamp, so new completions can be appended without rewriting
+          the habit's whole history.
+        - Each streak of a habit is a row in 'streak_runs', and the current and
+          longest streak are kept on the habit, so they can be read without
+          going through the completions.
+        """
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        self.cursor.execute("BEGIN")
+        if self._has_json_completions():
+            self._migrate_v1()
+        elif version < 2:
+            self._create_tables()
+        else:
+            # Rebuilding streaks rewrites completions, which also clears this table,
+            # and reads the habits' settings
+            self._create_compacted_completions_table()
+            self._add_settings_columns()
+            if version == 2:
+                self._migrate_v2()
+            elif version == 3:
+                self._rebuild_streaks()
+        self._create_analytics_indexes()
+        self._create_meta_table()
+        self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()  # Commits the table creation to the database
+
+    def _create_tables(self):
+        """
+        Creates the tables of the current schema.
         """
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS habits (
@@ -34,59 +386,885 @@ class StorageHandler:
                 name TEXT NOT NULL UNIQUE,
                 periodicity TEXT NOT NULL,
                 created_at TEXT NOT NULL,
-                completions TEXT NOT NULL
+                current_streak INTEGER NOT NULL DEFAULT 0,
+                longest_streak INTEGER NOT NULL DEFAULT 0,
+                tz TEXT,
+                week_start INTEGER NOT NULL DEFAULT 0
             );
         """)
-        self.conn.commit()  # Commits the table creation to the database
+        self._create_completions_table()
+        self._create_streak_runs_table()
+        self._create_compacted_completions_table()
+
+    def _create_completions_table(self):
+        """
+        Creates the 'completions' table (added in version 2) and its index.
+        """
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
+                ts TEXT NOT NULL
+            );
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_completions_habit_ts
+            ON completions (habit_id, ts);
+        """)
+
+    def _create_streak_runs_table(self):
+        """
+        Creates the 'streak_runs' table (added in version 3). Start and end are the
+        first and last completion of the streak, in microseconds since 1970.
+        """
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS streak_runs (
+                habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
+                start_ts INTEGER NOT NULL,
+                end_ts INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                PRIMARY KEY (habit_id, start_ts)
+            );
+        """)
+
+    def _create_analytics_indexes(self):
+        """
+        Brings the periodicities into their canonical spelling, so they can be
+        matched in SQL, and creates the indexes used by the analytics queries
+        (added in version 5).
+        """
+        rows = self.cursor.execute("SELECT id, periodicity FROM habits").fetchall()
+        self.cursor.executemany(
+            "UPDATE habits SET periodicity = ? WHERE id = ?",
+            ((normalize_periodicity(periodicity), habit_id) for habit_id, periodicity in rows
+             if is_valid_periodicity(periodicity) and normalize_periodicity(periodicity) != periodicity),
+        )
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_habits_periodicity ON habits (periodicity)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_habits_longest_streak ON habits (longest_streak)")
+
+    def _create_compacted_completions_table(self):
+        """
+        Creates the 'compacted_completions' table (added in version 6). Each row
+        belongs to a completion that was kept by compact() and counts the
+        completions of the same period that were removed.
+        """
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS compacted_completions (
+                habit_id INTEGER NOT NULL REFERENCES habits(id) ON DELETE CASCADE,
+                ts TEXT NOT NULL,
+                removed INTEGER NOT NULL,
+                PRIMARY KEY (habit_id, ts)
+            );
+        """)
+
+    def _create_meta_table(self):
+        """
+        Creates the 'meta' table (added in version 7), which holds single values
+        about the database as a whole, like the last journal entry it contains
+        and its generation, which moves on with every write.
+        """
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+
+    def _has_json_completions(self):
+        """
+        Checks whether the database still uses the version 1 layout, where
+        completions are stored as a JSON string in the 'habits' table.
+        """
+        columns = self.cursor.execute("PRAGMA table_info(habits)").fetchall()
+        return any(column[1] == "completions" for column in columns)
+
+    def _migrate_v1(self):
+        """
+        Moves a version 1 database to the current layout: the JSON completion
+        lists are expanded into rows of the 'completions' table. Habit ids are
+        kept, and the old table is dropped once everything has been copied.
+        """
+        self.cursor.execute("ALTER TABLE habits RENAME TO habits_v1")
+        self._create_tables()
+        self.cursor.execute("""
+            INSERT INTO habits (id, name, periodicity, created_at)
+            SELECT id, name, periodicity, created_at FROM habits_v1
+        """)
+        rows = self.cursor.execute("SELECT id, completions FROM habits_v1").fetchall()
+        for habit_id, completions_json in rows:
+            self.cursor.executemany(
+                "INSERT INTO completions (habit_id, ts) VALUES (?, ?)",
+                ((habit_id, ts) for ts in json.loads(completions_json)),
+            )
+        self.cursor.execute("DROP TABLE habits_v1")
+        self._rebuild_streaks()
+
+    def _add_settings_columns(self):
+        """
+        Adds the habits' timezone and first day of the week (introduced in
+        version 8). Habits saved before had both settings lost on loading, so
+        they keep the defaults their stored streaks were read back with.
+        """
+        columns = {column[1] for column in self.cursor.execute("PRAGMA table_info(habits)")}
+        if "tz" not in columns:
+            self.cursor.execute("ALTER TABLE habits ADD COLUMN tz TEXT")
+            self.cursor.execute("ALTER TABLE habits ADD COLUMN week_start INTEGER NOT NULL DEFAULT 0")
+
+    def _migrate_v2(self):
+        """
+        Adds the persisted streaks (introduced in version 3) and calculates them
+        once from the stored completions.
+        """
+        self.cursor.execute("ALTER TABLE habits ADD COLUMN current_streak INTEGER NOT NULL DEFAULT 0")
+        self.cursor.execute("ALTER TABLE habits ADD COLUMN longest_streak INTEGER NOT NULL DEFAULT 0")
+        self._create_streak_runs_table()
+        self._rebuild_streaks()
 
     def save(self, habits):
         """
         Saves all habits from the HabitManager to the database.
         It checks if a habit already exists by its name. If it does,
         it updates the record. If not, it inserts a new record.
+        Only completions and streaks that changed since the last save or load are written.
         """
-        for habit in habits:
-            # Convert the list of completions to a JSON string for storage
-            completions_json = json.dumps(habit.completions)
+        with self._write_lock:
+            self._save(habits)
 
+    def _save(self, habits):
+        """
+        Does the work of save(); the caller holds the write lock.
+        """
+        batch = _SaveBatch()
+        habit_rows = 0
+        for habit in habits:
+            habit_rows += 1
+            settings = (tz_name(habit.tz), habit.week_start)
             # Check if the habit already exists in the database
-            self.cursor.execute("SELECT id FROM habits WHERE name = ?", (habit.name,))
+            self.cursor.execute("SELECT id, tz, week_start FROM habits WHERE name = ?", (habit.name,))
             existing_habit = self.cursor.fetchone()
 
             if existing_habit:
-                # Update existing habit's completions and creation date
+                # Update existing habit's creation date and settings
+                habit_id = existing_habit[0]
                 self.cursor.execute("""
-                    UPDATE habits SET completions = ?, created_at = ?
-                    WHERE name = ?
-                """, (completions_json, habit.created_at, habit.name))
+                    UPDATE habits SET created_at = ?, tz = ?, week_start = ?
+                    WHERE id = ?
+                """, (habit.created_at, *settings, habit_id))
             else:
                 # Insert a new habit record into the table
                 self.cursor.execute("""
-                    INSERT INTO habits (name, periodicity, created_at, completions)
-                    VALUES (?, ?, ?, ?)
-                """, (habit.name, habit.periodicity, habit.created_at, completions_json))
+                    INSERT INTO habits (name, periodicity, created_at, tz, week_start)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (habit.name, habit.periodicity, habit.created_at, *settings))
+                habit_id = self.cursor.lastrowid
 
+            self._habit_ids[habit.name] = habit_id
+            # Other settings change the streaks, so they are rewritten too
+            batch.add(habit_id, habit, new=not existing_habit or tuple(existing_habit[1:]) != settings)
+
+        batch.write(self.cursor)
+        self._bump_generation()
         self.conn.commit()  # Save the changes to the database
+        batch.mark_saved()
+        metrics.increment("storage.rows_written", habit_rows)
+
+    def save_changes(self, added=(), deleted=(), completed=(), journal_seq=None):
+        """
+        Saves only what changed since the habits were loaded, in a single
+        transaction. The arguments match HabitManager.get_changes(), so a
+        save after completing one habit inserts just one completion row
+        (plus updating that habit's current streak).
+
+        Args:
+            added (list): Habit objects that are new (or were re-created).
+            deleted (list): Names of habits to remove, along with their completions.
+            completed (list): Stored Habit objects that have new completions.
+            journal_seq (int, optional): The journal entry these changes reach
+                (see checkpoint()), recorded in the same transaction.
+        """
+        if not (added or deleted or completed) and journal_seq in (None, self._journal_seq()):
+            return  # Nothing to write, so the generation (and a snapshot of it) stays current
+        with self._write_lock, self.conn:  # Commits on success, rolls back if anything fails
+            self._bump_generation()
+            if journal_seq is not None:
+                self._set_journal_seq(journal_seq)
+            self.cursor.executemany(
+                "DELETE FROM habits WHERE name = ?",  # Completions are removed by ON DELETE CASCADE
+                ((name,) for name in deleted),
+            )
+            for name in deleted:
+                self._habit_ids.pop(name, None)
 
-    def load(self):
+            self.cursor.executemany("""
+                INSERT INTO habits (name, periodicity, created_at, tz, week_start)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    periodicity = excluded.periodicity,
+                    created_at = excluded.created_at,
+                    tz = excluded.tz,
+                    week_start = excluded.week_start
+            """, [(habit.name, habit.periodicity, habit.created_at, tz_name(habit.tz), habit.week_start)
+                  for habit in added])
+            for habit in added:
+                self._habit_ids.pop(habit.name, None)  # The upsert may have assigned a new id
+
+            batch = _SaveBatch()
+            for habit in added:
+                batch.add(self._habit_id(habit.name), habit, new=True)
+            for habit in completed:
+                batch.add(self._habit_id(habit.name), habit)
+            batch.write(self.cursor)
+            batch.mark_saved()
+        metrics.increment("storage.rows_written", len(added) + len(deleted))
+
+    def checkpoint(self, journal, added=(), deleted=(), completed=()):
+        """
+        Saves the changes recorded in a journal (see journal.py) and drops them
+        from it. The changes themselves come from HabitManager.get_changes(),
+        which covers every journal entry made through that manager.
+
+        Args:
+            journal (CompletionJournal): The manager's journal.
+            added, deleted, completed: The changes, as for save_changes().
+        """
+        stored = self._journal_seq()
+        journal.advance(stored)
+        seq = journal.seq
+        if seq == stored and not (added or deleted or completed):
+            return  # Nothing journaled or changed since the last checkpoint
+        self.save_changes(added, deleted, completed, journal_seq=seq)
+        journal.truncate(seq)
+
+    def replay(self, journal):
+        """
+        Applies the journal entries that are not in the database yet, e.g. after
+        a crash, in a single transaction, and drops them from the journal. New
+        entries are numbered after the last one the database has, so replay a
+        journal (or load() with it) before making changes.
+
+        Args:
+            journal (CompletionJournal): The journal to replay.
+
+        Returns:
+            int: The number of entries applied.
+        """
+        with self._write_lock, self.conn:
+            entries = journal.entries(after=self._journal_seq())
+            for entry in entries:
+                name = entry["name"]
+                if entry["op"] == "add":
+                    self.cursor.execute("""
+                        INSERT INTO habits (name, periodicity, created_at)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT (name) DO UPDATE SET
+                            periodicity = excluded.periodicity,
+                            created_at = excluded.created_at,
+                            tz = NULL,
+                            week_start = 0
+                    """, (name, entry["periodicity"], entry["created_at"]))
+                elif entry["op"] == "delete":
+                    self.cursor.execute("DELETE FROM habits WHERE name = ?", (name,))
+                    self._habit_ids.pop(name, None)
+                else:
+                    self._record_completion(name, entry["ts"])
+            if entries:
+                self._set_journal_seq(entries[-1]["seq"])
+                self._bump_generation()
+        stored = self._journal_seq()
+        journal.advance(stored)
+        journal.truncate(stored)
+        return len(entries)
+
+    def _journal_seq(self):
+        """
+        Returns the sequence number of the last journal entry stored in the database.
+        """
+        row = self.cursor.execute("SELECT value FROM meta WHERE key = 'journal_seq'").fetchone()
+        return row[0] if row else 0
+
+    def _set_journal_seq(self, seq):
+        """
+        Records the last journal entry stored in the database; the caller commits.
+        """
+        self.cursor.execute("""
+            INSERT INTO meta (key, value) VALUES ('journal_seq', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        """, (seq,))
+
+    def _generation(self):
+        """
+        Returns the generation of the database: the number of writes made to it
+        since it got the 'meta' table.
+        """
+        row = self.cursor.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def _bump_generation(self):
+        """
+        Moves the generation on, so snapshots written before this write are
+        recognized as out of date; the caller commits.
+        """
+        self.cursor.execute("""
+            INSERT INTO meta (key, value) VALUES ('generation', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1
+        """)
+
+    def _habit_id(self, name):
+        """
+        Returns the database id of the habit with the given name, using the
+        ids remembered from earlier loads and saves where possible.
+        """
+        habit_id = self._habit_ids.get(name)
+        if habit_id is None:
+            self.cursor.execute("SELECT id FROM habits WHERE name = ?", (name,))
+            habit_id = self._habit_ids[name] = self.cursor.fetchone()[0]
+        return habit_id
+
+    def _rebuild_streaks(self, habit_ids=None):
+        """
+        Recalculates and stores the streaks of habits from their completions,
+        one habit at a time. The caller is responsible for the transaction.
+
+        Args:
+            habit_ids (iterable, optional): Ids of the habits to update. Defaults to all habits.
+        """
+        if habit_ids is None:
+            habit_ids = [habit_id for (habit_id,) in self.cursor.execute("SELECT id FROM habits")]
+
+        batch = _SaveBatch()
+        for habit_id in habit_ids:
+            name, periodicity, created_at, tz, week_start = self.conn.execute(
+                "SELECT name, periodicity, created_at, tz, week_start FROM habits WHERE id = ?",
+                (habit_id,)).fetchone()
+            completions = [ts for (ts,) in self.conn.execute(
+                "SELECT ts FROM completions WHERE habit_id = ? ORDER BY ts", (habit_id,))]
+            habit = Habit(name, periodicity, created_at=created_at, completions=completions, compact=True,
+                          tz=tz_from_name(tz), week_start=week_start)
+            _mark_loaded(habit)
+            habit._saved_runs = None  # Replace whatever streaks are stored
+            batch.add(habit_id, habit)
+            if len(batch.runs) >= 50_000:
+                batch.write(self.cursor)  # Keep memory bounded for large rebuilds
+                batch = _SaveBatch()
+        batch.write(self.cursor)
+
+    def bulk_insert(self, habits, completions):
+        """
+        Inserts a batch of imported habits and completions in one transaction,
+        using executemany. Habits that already exist are kept as they are, and
+        a completion the habit already has at the same timestamp is skipped, so
+        importing a file twice (or an export into its own database) changes
+        nothing. The streaks of the affected habits are not updated; call
+        refresh_streaks() once the whole import is done.
+
+        Args:
+            habits (list): (name, periodicity, created_at) tuples.
+            completions (list): (habit name, ISO timestamp) tuples.
+
+        Returns:
+            tuple: (ids of the habits that received new completions, number of new
+            habits, number of new completions).
+        """
+        with self._write_lock, self.conn:
+            self._bump_generation()
+            self.cursor.executemany("""
+                INSERT INTO habits (name, periodicity, created_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (name) DO NOTHING
+            """, habits)
+            added_habits = max(self.cursor.rowcount, 0)
+            ids = {name: self._habit_id(name) for name in {name for name, _ in completions}}
+            # The batch goes into a temporary table first, so the completions that
+            # already exist can be dropped in one statement, using idx_completions_habit_ts;
+            # that is twice as fast as checking each row on its own
+            self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_batch (habit_id INTEGER, ts TEXT)")
+            self.cursor.executemany("INSERT INTO import_batch (habit_id, ts) VALUES (?, ?)",
+                                    dict.fromkeys((ids[name], ts) for name, ts in completions))
+            self.cursor.execute("""
+                DELETE FROM import_batch
+                WHERE EXISTS (SELECT 1 FROM completions
+                              WHERE habit_id = import_batch.habit_id AND ts = import_batch.ts)
+            """)
+            self.cursor.execute("INSERT INTO completions (habit_id, ts) "
+                                "SELECT habit_id, ts FROM import_batch ORDER BY rowid")
+            added_completions = self.cursor.rowcount
+            # Only these habits need their streaks recalculated
+            changed = {habit_id for (habit_id,) in
+                       self.cursor.execute("SELECT DISTINCT habit_id FROM import_batch")}
+            self.cursor.execute("DELETE FROM import_batch")
+        metrics.increment("storage.rows_written", added_habits + added_completions)
+        return changed, added_habits, added_completions
+
+    def refresh_streaks(self, habit_ids):
+        """
+        Recalculates the stored streaks of the given habits, e.g. after a bulk import.
+
+        Args:
+            habit_ids (iterable): Ids of the habits to update.
+        """
+        if not habit_ids:
+            return  # Nothing to write, so the generation stays current
+        with self._write_lock, self.conn:
+            self._bump_generation()
+            self._rebuild_streaks(habit_ids)
+
+    def record_completion(self, name, timestamp=None):
+        """
+        Stores one completion of a habit directly in the database and updates
+        its stored streaks, without loading the habit. Meant for recording
+        completions from several threads (e.g. the requests of a web front end).
+
+        Args:
+            name (str): The name of the habit.
+            timestamp (str, optional): ISO timestamp of the completion. Defaults to now.
+
+        Returns:
+            bool: True if the habit was found and completed, False otherwise.
+        """
+        return self.record_completions([(name, timestamp)])[0]
+
+    def record_completions(self, completions):
+        """
+        Stores several completions like record_completion(), in a single transaction.
+
+        Args:
+            completions (list): (habit name, ISO timestamp or None for now) tuples.
+
+        Returns:
+            list: For each completion, True if its habit was found, False otherwise.
+        """
+        with self._write_lock, self.conn:
+            self._bump_generation()
+            results = [self._record_completion(name, timestamp) for name, timestamp in completions]
+        # A completion row, its streak and the habit's streak columns
+        metrics.increment("storage.rows_written", 3 * sum(results))
+        return results
+
+    def _record_completion(self, name, timestamp):
+        """
+        Does the work of record_completions() for one completion; the caller
+        holds the write lock and commits. Without a timestamp, the completion
+        is recorded at the current time in the habit's timezone.
+        """
+        row = self.cursor.execute(
+            "SELECT id, periodicity, created_at, longest_streak, tz, week_start FROM habits WHERE name = ?",
+            (name,)).fetchone()
+        if row is None:
+            return False  # Habit not found
+        habit_id, periodicity, created_at, longest, tz, week_start = row
+        tz = tz_from_name(tz)
+        timestamp = timestamp or datetime.now(tz).isoformat()  # Like Habit.complete()
+        stamp = to_micros(timestamp, tz)
+
+        self.cursor.execute(
+            "INSERT INTO completions (habit_id, ts) VALUES (?, ?)", (habit_id, timestamp))
+        last_run = self.cursor.execute("""
+            SELECT start_ts, end_ts, length FROM streak_runs
+            WHERE habit_id = ? ORDER BY start_ts DESC LIMIT 1
+        """, (habit_id,)).fetchone()
+        if last_run is not None and stamp < last_run[1]:
+            self._rebuild_streaks([habit_id])  # An older completion can change any streak
+            return True
+
+        # Only the latest streak can grow, so a habit holding just that streak
+        # is enough to apply the same rules as Habit.complete()
+        habit = Habit(name, periodicity, created_at=created_at, compact=True, tz=tz, week_start=week_start)
+        if last_run is not None:
+            habit._stamps.append(last_run[1])
+            habit._runs = [list(last_run)]
+            habit._longest = longest
+        habit._add_stamp(stamp)
+        self.cursor.execute("""
+            INSERT INTO streak_runs (habit_id, start_ts, end_ts, length)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (habit_id, start_ts) DO UPDATE SET
+                end_ts = excluded.end_ts,
+                length = excluded.length
+        """, (habit_id, *habit._runs[-1]))
+        self.cursor.execute(
+            "UPDATE habits SET current_streak = ?, longest_streak = ? WHERE id = ?",
+            (habit.get_streak(), habit.get_longest_streak(), habit_id))
+        return True
+
+    # --- Analytics queries ---
+    # The methods below answer common analytics questions inside SQLite, so a
+    # report doesn't have to load every habit and completion into memory.
+    # Periods are taken from the date as written in each ISO timestamp.
+
+    def habits_by_periodicity(self, periodicity):
+        """
+        Finds the habits with a given periodicity, like analytics.filter_by_periodicity().
+
+        Args:
+            periodicity (str): The periodicity to filter by, in any supported spelling.
+
+        Returns:
+            list: The names of the matching habits, ordered by id.
+        """
+        if is_valid_periodicity(periodicity):
+            periodicity = normalize_periodicity(periodicity)
+        rows = self.cursor.execute(
+            "SELECT name FROM habits WHERE periodicity = ? ORDER BY id", (periodicity,))
+        return [name for (name,) in rows]
+
+    def completion_counts(self, period=None, start=None, end=None):
+        """
+        Counts the completions of every habit, in total or per day, week or month.
+
+        Args:
+            period (str, optional): 'day', 'week' or 'month' to count per period.
+                Weeks start on Monday and are named by the date of their Monday.
+            start (str, optional): Only count completions at or after this ISO timestamp.
+            end (str, optional): Only count completions before this ISO timestamp.
+
+        Returns:
+            list: (name, count) tuples for every habit, ordered by id, or
+            (name, period, count) tuples ordered by id and period, where period
+            is e.g. '2024-01-15' (day or week) or '2024-01' (month).
+
+        Raises:
+            ValueError: If the period is not supported.
+        """
+        keys = {
+            "day": "substr(c.ts, 1, 10)",
+            "week": "date(substr(c.ts, 1, 10), '-' || ((strftime('%w', substr(c.ts, 1, 10)) + 6) % 7) || ' days')",
+            "month": "substr(c.ts, 1, 7)",
+        }
+        if period is not None and period not in keys:
+            raise ValueError(f"Invalid period '{period}' (expected day, week or month)")
+        # The range conditions go into the join, so habits without completions still count 0
+        conditions = "".join([" AND c.ts >= :start" if start else "", " AND c.ts < :end" if end else ""])
+        # Completions removed by compact() are counted at the completion kept for their period
+        completions = """(
+            SELECT habit_id, ts, 1 AS n FROM completions
+            UNION ALL SELECT habit_id, ts, removed FROM compacted_completions
+        )"""
+        if period is None:
+            return self.cursor.execute(f"""
+                SELECT h.name, COALESCE(SUM(c.n), 0)
+                FROM habits h LEFT JOIN {completions} c ON c.habit_id = h.id{conditions}
+                GROUP BY h.id ORDER BY h.id
+            """, {"start": start, "end": end}).fetchall()
+        return self.cursor.execute(f"""
+            SELECT h.name, {keys[period]} AS period, SUM(c.n)
+            FROM habits h JOIN {completions} c ON c.habit_id = h.id{conditions}
+            GROUP BY h.id, period ORDER BY h.id, period
+        """, {"start": start, "end": end}).fetchall()
+
+    def habits_completed_on(self, day=None):
+        """
+        Finds the habits completed at least once on a given day.
+
+        Args:
+            day (str, optional): The date as 'YYYY-MM-DD'. Defaults to today.
+
+        Returns:
+            list: The names of the habits completed that day, ordered by id.
+        """
+        day = day or datetime.now().date().isoformat()
+        # A range on the (habit_id, ts) index finds each habit's completions without a scan
+        rows = self.cursor.execute("""
+            SELECT name FROM habits h
+            WHERE EXISTS (
+                SELECT 1 FROM completions c
+                WHERE c.habit_id = h.id AND c.ts >= :day AND c.ts < date(:day, '+1 day')
+            )
+            ORDER BY id
+        """, {"day": day})
+        return [name for (name,) in rows]
+
+    def top_streaks(self, n=10, current=False):
+        """
+        Ranks the habits by their stored longest (or current) streak.
+
+        Args:
+            n (int, optional): Number of ranks to return. Habits with equal
+                streaks share a rank, so more than n habits may be returned.
+            current (bool, optional): Rank by the current instead of the longest streak.
+
+        Returns:
+            list: (rank, name, streak) tuples, from the longest streak down.
+        """
+        column = "current_streak" if current else "longest_streak"
+        return self.cursor.execute(f"""
+            SELECT rank, name, streak FROM (
+                SELECT RANK() OVER (ORDER BY {column} DESC) AS rank, name, {column} AS streak, id
+                FROM habits
+            )
+            WHERE rank <= ? ORDER BY rank, id
+        """, (n,)).fetchall()
+
+    def compact(self, retain_days=365):
+        """
+        Shrinks the history older than a retention window. Of the completions
+        of a habit within one of its periods (a day for daily habits, a week
+        for weekly ones, ...), only the first is kept; the others are deleted
+        and counted in 'compacted_completions'. Streaks only depend on which
+        periods have a completion, so they stay exactly the same, however
+        often they are recalculated, while the history shrinks to at most one
+        row per period. completion_counts() includes the removed completions;
+        loaded habits (and exports) only see the completions that were kept.
+
+        Args:
+            retain_days (int, optional): Completions from the last 'retain_days'
+                days are kept as they are.
+
+        Returns:
+            int: The number of completion rows removed.
+        """
+        cutoff = (datetime.now() - timedelta(days=retain_days)).isoformat()
+        removed = 0
+        with self._write_lock, self.conn:
+            self._bump_generation()
+            habits = self.cursor.execute(
+                "SELECT id, name, periodicity, created_at, tz, week_start FROM habits").fetchall()
+            for habit_id, name, periodicity, created_at, tz, week_start in habits:
+                removed += self._compact_habit(habit_id, Habit(
+                    name, periodicity, created_at=created_at, compact=True,
+                    tz=tz_from_name(tz), week_start=week_start), cutoff)
+        metrics.increment("storage.rows_compacted", removed)
+        return removed
+
+    def _compact_habit(self, habit_id, habit, cutoff):
+        """
+        Does the work of compact() for one habit, given as a Habit with its
+        settings; the caller holds the write lock and commits.
+        """
+        bucket = habit.bucketer()
+        if bucket is None:
+            return 0  # Without known periods, every completion may matter for the streaks
+        periods = {}  # Period index -> [(timestamp, rowid, ts), ...] of the old completions
+        for rowid, ts in self.conn.execute(
+                "SELECT rowid, ts FROM completions WHERE habit_id = ? AND ts < ?", (habit_id, cutoff)):
+            stamp = to_micros(ts, habit.tz)
+            periods.setdefault(bucket(stamp), []).append((stamp, rowid, ts))
+        removed_before = dict(self.conn.execute(
+            "SELECT ts, removed FROM compacted_completions WHERE habit_id = ?", (habit_id,)))
+
+        deleted_rows = []
+        stale = []   # (habit_id, ts) counts kept at completions that are now deleted
+        counts = []  # (habit_id, kept ts, removed count) for the compacted periods
+        for completions in periods.values():
+            if len(completions) < 2:
+                continue
+            completions.sort()
+            kept_ts = completions[0][2]
+            # Earlier compactions may have counted removed completions at any of these rows
+            timestamps = {ts for _, _, ts in completions}
+            count = len(completions) - 1 + sum(removed_before.get(ts, 0) for ts in timestamps)
+            deleted_rows += [(rowid,) for _, rowid, _ in completions[1:]]
+            stale += [(habit_id, ts) for ts in timestamps - {kept_ts} if ts in removed_before]
+            counts.append((habit_id, kept_ts, count))
+
+        self.cursor.executemany("DELETE FROM completions WHERE rowid = ?", deleted_rows)
+        self.cursor.executemany(
+            "DELETE FROM compacted_completions WHERE habit_id = ? AND ts = ?", stale)
+        self.cursor.executemany("""
+            INSERT INTO compacted_completions (habit_id, ts, removed) VALUES (?, ?, ?)
+            ON CONFLICT (habit_id, ts) DO UPDATE SET removed = excluded.removed
+        """, counts)
+        return len(deleted_rows)
+
+    def iter_completion_rows(self):
+        """
+        Streams every completion straight from the database, without creating
+        Habit objects. Habits without completions appear once with a ts of None.
+
+        Yields:
+            tuple: (id, name, periodicity, created_at, ts), ordered by habit id and time.
+        """
+        # A separate cursor keeps the stream independent of other queries
+        yield from self.conn.execute("""
+            SELECT h.id, h.name, h.periodicity, h.created_at, c.ts
+            FROM habits h LEFT JOIN completions c ON c.habit_id = h.id
+            ORDER BY h.id, c.ts
+        """)
+
+    def save_snapshot(self):
+        """
+        Writes a snapshot of all habits next to the database (see snapshot.py),
+        which load(snapshot=True) reads until the database is written again.
+        The completions and stored streaks are read in one transaction, so the
+        snapshot matches the generation it is labeled with. Nothing is written
+        if the snapshot on disk is already up to date.
+
+        Returns:
+            int or None: The number of habits in the snapshot, or None if it was up to date.
+        """
+        with self._write_lock:  # No writes from this process in between
+            self.cursor.execute("BEGIN")  # A consistent view, even with other processes writing
+            try:
+                generation = self._generation()
+                if snapshot.read_generation(self.snapshot_path) == (SCHEMA_VERSION, generation):
+                    return None
+                habits = self.cursor.execute("""
+                    SELECT id, name, periodicity, created_at, tz, week_start, longest_streak
+                    FROM habits ORDER BY id
+                """).fetchall()
+                zones = {habit[0]: tz_from_name(habit[4]) for habit in habits}
+                stamps = {}
+                for habit_id, ts in self.cursor.execute("SELECT habit_id, ts FROM completions"):
+                    stamps.setdefault(habit_id, []).append(to_micros(ts, zones[habit_id]))
+                runs = {}
+                for habit_id, start, end, length in self.cursor.execute("""
+                    SELECT habit_id, start_ts, end_ts, length FROM streak_runs ORDER BY habit_id, start_ts
+                """):
+                    runs.setdefault(habit_id, []).append((start, end, length))
+            finally:
+                self.conn.commit()  # Ends the read transaction
+        snapshot.write_snapshot(
+            self.snapshot_path,
+            [(name, periodicity, created_at, tz, week_start, sorted(stamps.get(habit_id, ())),
+              runs.get(habit_id, ()), longest)
+             for habit_id, name, periodicity, created_at, tz, week_start, longest in habits],
+            generation, SCHEMA_VERSION)
+        metrics.increment("storage.rows_read", len(habits) + sum(map(len, stamps.values())))
+        return len(habits)
+
+    @property
+    def snapshot_path(self):
+        """
+        str: The snapshot file of this database, e.g. 'habits.db.snapshot'.
+        """
+        return self.db_name + ".snapshot"
+
+    def load(self, compact=False, lazy=False, journal=None, snapshot=False):
         """
         Loads all habits from the database and returns them as a list
         of Habit objects.
+
+        Args:
+            compact (bool, optional): Create compact habits, which keep their
+                completions as packed integer timestamps (see Habit).
+            lazy (bool, optional): Only read the habits themselves and return
+                LazyHabit objects, which fetch their completions on first use.
+            journal (CompletionJournal, optional): A journal whose unsaved
+                changes are replayed into the database first (see replay()).
+            snapshot (bool, optional): Read the habits from the snapshot written
+                by save_snapshot() if it is up to date. They are compact habits
+                with all completions loaded, whatever 'compact' and 'lazy' say.
+                An outdated or missing snapshot falls back to the database.
         """
-        self.cursor.execute("SELECT name, periodicity, created_at, completions FROM habits")
+        if journal is not None:
+            self.replay(journal)
+        if snapshot:
+            habits = self._load_snapshot()
+            if habits is not None:
+                return habits
+        if lazy:
+            self.cursor.execute("""
+                SELECT h.id, h.name, h.periodicity, h.created_at, h.current_streak, h.longest_streak,
+                       r.start_ts, r.end_ts, r.length, h.tz, h.week_start
+                FROM habits h LEFT JOIN streak_runs r ON r.habit_id = h.id
+                    AND r.start_ts = (SELECT max(start_ts) FROM streak_runs WHERE habit_id = h.id)
+                ORDER BY h.id
+            """)
+            habits = []
+            for (habit_id, name, periodicity, created_at, current, longest, *last_run,
+                 tz, week_start) in self.cursor.fetchall():
+                self._habit_ids[name] = habit_id
+                habits.append(LazyHabit(name, periodicity, created_at,
+                                        self._completion_loader(habit_id), compact=compact,
+                                        current_streak=current, longest_streak=longest,
+                                        last_run=last_run if last_run[0] is not None else None,
+                                        tz=tz_from_name(tz), week_start=week_start))
+            metrics.increment("storage.rows_read", len(habits))
+            return habits
+
+        # Group all completions by habit, keeping the order they were saved in
+        completions = {}
+        rows_read = 0
+        self.cursor.execute("SELECT habit_id, ts FROM completions ORDER BY habit_id, rowid")
+        for habit_id, ts in self.cursor:
+            completions.setdefault(habit_id, []).append(ts)
+            rows_read += 1
+
+        self.cursor.execute("SELECT id, name, periodicity, created_at, tz, week_start FROM habits ORDER BY id")
         rows = self.cursor.fetchall()  # Fetches all rows from the query
         habits = []
         for row in rows:
-            name, periodicity, created_at, completions_json = row
-            # Convert the JSON string back into a Python list
-            completions = json.loads(completions_json)
+            habit_id, name, periodicity, created_at, tz, week_start = row
             # Create a new Habit object from the loaded data
-            habits.append(Habit(name, periodicity, created_at=created_at, completions=completions))
+            habit = Habit(name, periodicity, created_at=created_at,
+                          completions=completions.pop(habit_id, []), compact=compact,
+                          tz=tz_from_name(tz), week_start=week_start)
+            _mark_loaded(habit)  # Everything loaded is already stored
+            self._habit_ids[name] = habit_id
+            habits.append(habit)
+        metrics.increment("storage.rows_read", rows_read + len(rows))
         return habits
 
+    def _load_snapshot(self):
+        """
+        Returns the habits of an up-to-date snapshot, or None (see load()).
+        """
+        habits = snapshot.load_snapshot(self.snapshot_path, self._generation(), SCHEMA_VERSION)
+        if habits is None:
+            metrics.increment("storage.snapshot_misses")
+            return None
+        metrics.increment("storage.snapshot_hits")
+        ids = self.cursor.execute("SELECT name, id FROM habits").fetchall()
+        self._habit_ids.update(ids)
+        for habit in habits:
+            _mark_loaded(habit)  # Everything loaded is already stored
+        return habits
+
+    def iter_habits(self, compact=False):
+        """
+        Yields the habits in the database one at a time, each with its completions
+        in chronological order. Only a single habit is held in memory at once,
+        which suits analytics that stream over all habits.
+
+        Args:
+            compact (bool, optional): Create compact habits (see Habit).
+
+        Yields:
+            Habit: The next habit, ordered by id.
+        """
+        settings = {habit_id: (tz_from_name(tz), week_start) for habit_id, tz, week_start
+                    in self.conn.execute("SELECT id, tz, week_start FROM habits").fetchall()}
+        rows = self.iter_completion_rows()
+        for (habit_id, name, periodicity, created_at), group in groupby(rows, key=itemgetter(0, 1, 2, 3)):
+            completions = [row[4] for row in group if row[4] is not None]
+            metrics.increment("storage.rows_read", len(completions) + 1)
+            tz, week_start = settings[habit_id]
+            habit = Habit(name, periodicity, created_at=created_at,
+                          completions=completions, compact=compact, tz=tz, week_start=week_start)
+            _mark_loaded(habit)
+            yield habit
+
+    def _completion_loader(self, habit_id):
+        """
+        Returns a function that reads the completions of one habit, in the order they were saved.
+        """
+        def load_completions():
+            rows = self.conn.execute(
+                "SELECT ts FROM completions WHERE habit_id = ? ORDER BY rowid", (habit_id,))
+            completions = [ts for (ts,) in rows]
+            metrics.increment("storage.rows_read", len(completions))
+            return completions
+        return load_completions
+
+    def close(self):
+        """
+        Closes the connections of all threads. The StorageHandler can't be used afterwards.
+        """
+        with self._pool_lock:
+            self._closed = True
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __del__(self):
         """
-        Destructor to ensure the database connection is closed when the
+        Destructor to ensure the database connections are closed when the
         StorageHandler object is no longer in use. This prevents file locking issues.
         """
-        self.conn.close()
+        if hasattr(self, "_pool_lock"):  # __init__ may have failed before creating it
+            self.close()
@@ -1,13 +1,25 @@
 import pytest
 import os
 import sqlite3
-from datetime import datetime, timedelta
+import json
+import random
+import threading
+import asyncio
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
 
 # Import all classes and functions from your project files
 from habit import Habit
 from habit_manager import HabitManager
 from storage import StorageHandler
+from journal import CompletionJournal
 import analytics
+from async_api import AsyncHabitManager, AsyncStorageHandler
+import aggregate
+import bulk
+import cli
+import metrics
 import main  # Import the main module to test the CLI
 
 
@@ -54,6 +66,118 @@ def test_weekly_streak_calculation():
     assert habit.get_streak() == 3
 
 
+def test_streak_updates_incrementally_on_complete():
+    """Verify that complete() extends the cached streak without a full rebuild."""
+    habit = Habit("Exercise", "daily")
+    now = datetime.now()
+    habit.completions = [(now - timedelta(days=1)).isoformat()]
+    habit.complete()
+    assert habit.get_streak() == 2
+    assert habit._stamps == sorted(habit._stamps)
+
+
+def test_streak_rebuilds_after_out_of_order_changes():
+    """Verify the streak is recalculated after in-place or out-of-order changes."""
+    habit = Habit("Exercise", "daily")
+    now = datetime.now()
+    habit.completions = [now.isoformat(), (now - timedelta(days=5)).isoformat()]
+    assert habit.get_streak() == 1
+
+    # Appending directly to the list fills the gap and is picked up on the next call
+    habit.completions.append((now - timedelta(days=1)).isoformat())
+    assert habit.get_streak() == 2
+
+
+def test_longest_streak_and_streak_runs():
+    """Verify all streaks are found and the longest one is kept apart from the current one."""
+    habit = Habit("Exercise", "daily")
+    start = datetime(2024, 3, 1, 8)
+    days = [0, 1, 2, 3, 6, 7]
+    habit.completions = [(start + timedelta(days=d)).isoformat() for d in days]
+    assert habit.get_streak() == 2
+    assert habit.get_longest_streak() == 4
+    assert [run[2] for run in habit.get_streak_runs()] == [4, 2]
+    assert habit.get_streak_runs()[0][:2] == (start.isoformat(), (start + timedelta(days=3)).isoformat())
+
+
+def test_compact_habit_matches_regular_habit():
+    """Verify a compact habit gives the same completions and streaks as a regular one."""
+    now = datetime.now()
+    stamps = [(now - timedelta(days=d)).isoformat() for d in (3, 1, 2, 0)]
+    regular = Habit("Exercise", "daily", completions=list(stamps))
+    compact = Habit("Exercise", "daily", completions=list(stamps), compact=True)
+
+    assert compact.compact and not hasattr(compact, "__dict__")
+    assert compact.completions == tuple(sorted(stamps))
+    with pytest.raises(AttributeError):  # Appending would be silently lost, so it fails instead
+        compact.completions.append(now.isoformat())
+    assert compact.completion_count == 4
+    assert compact.get_streak() == regular.get_streak() == 4
+    compact.complete()  # A second completion today doesn't extend the streak
+    assert compact.get_streak() == 4
+    assert compact.completion_count == 5
+    assert compact.completions[-1] > stamps[-1]
+
+
+def test_streaks_count_calendar_periods():
+    """Verify streaks follow calendar periods: same-day completions count once, weeks and months align."""
+    daily = Habit("Read", "daily", completions=[
+        "2024-03-01T23:50:00", "2024-03-02T00:10:00", "2024-03-02T22:00:00", "2024-03-03T07:00:00"])
+    assert daily.get_streak() == 3
+
+    # Sunday to the following Monday is the next ISO week, even though it is only a day later
+    weekly = Habit("Plan", "weekly", completions=["2024-03-03T10:00:00", "2024-03-04T10:00:00"])
+    assert weekly.get_streak() == 2
+    # With weeks starting on Sunday both completions fall into the same week
+    sunday_weeks = Habit("Plan", "weekly", week_start=6,
+                         completions=["2024-03-03T10:00:00", "2024-03-04T10:00:00"])
+    assert sunday_weeks.get_streak() == 1
+
+    monthly = Habit("Budget", "monthly", completions=[
+        "2023-11-30T10:00:00", "2023-12-01T10:00:00", "2024-01-31T10:00:00"])
+    assert monthly.get_streak() == 3
+
+    # Blocks of three days start on the creation day
+    every_3 = Habit("Water Plants", "every 3 days", created_at="2024-03-01T09:00:00",
+                    completions=["2024-03-01T09:00:00", "2024-03-06T09:00:00", "2024-03-07T09:00:00"])
+    assert every_3.get_streak() == 3
+
+
+def test_streaks_use_the_habit_timezone():
+    """Verify timestamps with a UTC offset are bucketed by the habit's timezone."""
+    tokyo = timezone(timedelta(hours=9))
+    completions = ["2024-03-01T20:00:00+00:00", "2024-03-02T10:00:00+00:00"]
+    # In UTC these are two days in a row; in Tokyo both fall on March 2nd
+    assert Habit("Run", "daily", completions=completions, tz=timezone.utc).get_streak() == 2
+    assert Habit("Run", "daily", completions=completions, tz=tokyo).get_streak() == 1
+
+
+def test_invalid_periodicity_is_rejected():
+    """Ensure the manager only accepts supported periodicities, stored in canonical form."""
+    manager = HabitManager()
+    with pytest.raises(ValueError):
+        manager.add_habit("Nap", "hourly")
+    manager.add_habit("Water Plants", "Every 3 Days")
+    manager.add_habit("Walk", "every 1 day")
+    assert [habit.periodicity for habit in manager.habits] == ["every 3 days", "daily"]
+
+
+def test_completions_between_uses_time_ranges():
+    """
+    Test range queries on a habit, for regular and compact habits.
+    """
+    completions = ["2024-01-03T08:00:00", "2024-01-01T08:00:00", "2024-01-02T08:00:00",
+                   "2024-01-02T20:00:00"]
+    for compact in (False, True):
+        habit = Habit("Read", "daily", completions=completions, compact=compact)
+        assert habit.completions_between("2024-01-02", "2024-01-03") == [
+            "2024-01-02T08:00:00", "2024-01-02T20:00:00"]
+        assert habit.count_between(start="2024-01-02T12:00:00") == 2
+        assert habit.count_between(end="2024-01-01T08:00:00") == 0
+        assert habit.count_between("2024-01-05", "2024-01-01") == 0
+        assert habit.count_between() == 4
+
+
 # --- HabitManager Class Tests ---
 # This section tests the logic for managing a collection of habits.
 def test_add_habit():
@@ -72,6 +196,108 @@ def test_delete_habit():
     assert len(manager.habits) == 0
 
 
+def test_habits_are_read_only():
+    """Ensure the habits can't be changed behind the manager's back, and aren't copied on every read."""
+    manager = HabitManager()
+    manager.add_habit("Read", "daily")
+    with pytest.raises(AttributeError):
+        manager.habits.append(Habit("Run", "daily"))
+    assert manager.habits is manager.habits
+    manager.add_habit("Run", "daily")
+    assert [habit.name for habit in manager.habits] == ["Read", "Run"]
+
+
+def test_habit_manager_tracks_changes():
+    """Verify that adding, completing and deleting habits is tracked until cleared."""
+    manager = HabitManager()
+    manager.habits = [Habit("Stored", "daily"), Habit("Old", "weekly")]
+    manager.add_habit("New", "daily")
+    manager.complete_habit("Stored")
+    manager.complete_habit("New")
+    manager.delete_habit("Old")
+
+    added, deleted, completed = manager.get_changes()
+    assert [habit.name for habit in added] == ["New"]
+    assert deleted == ["Old"]
+    assert [habit.name for habit in completed] == ["Stored"]
+
+    # A habit added and deleted before saving never has to reach the database
+    manager.delete_habit("New")
+    assert manager.get_changes()[0] == []
+
+    manager.clear_changes()
+    assert manager.get_changes() == ([], [], [])
+
+
+def test_habit_names_are_unique():
+    """Ensure adding or loading a duplicate habit name raises an error."""
+    manager = HabitManager()
+    manager.add_habit("Write Code", "daily")
+    with pytest.raises(ValueError):
+        manager.add_habit("Write Code", "weekly")
+    with pytest.raises(ValueError):
+        manager.habits = [Habit("Twice", "daily"), Habit("Twice", "weekly")]
+    assert manager.get_habit("Write Code").periodicity == "daily"
+
+
+def test_habit_index_keeps_order():
+    """Verify lookups go through the name index and the display order is kept."""
+    manager = HabitManager()
+    for name in ["A", "B", "C"]:
+        manager.add_habit(name, "daily")
+    manager.delete_habit("B")
+    manager.add_habit("B", "weekly")
+    assert [habit.name for habit in manager.habits] == ["A", "C", "B"]
+    assert manager.complete_habit("C")
+    assert not manager.complete_habit("Missing")
+    assert analytics.get_longest_streak_for(manager, "C") == 1
+
+
+def test_habit_manager_range_queries():
+    """
+    Test range queries across the habits of a manager.
+    """
+    manager = HabitManager()
+    manager.habits = [Habit("Read", "daily", completions=["2024-01-01T08:00:00", "2024-02-01T08:00:00"]),
+                      Habit("Run", "weekly", completions=["2024-01-15T08:00:00"])]
+    assert manager.completions_between("Read", "2024-01-01", "2024-01-31") == ["2024-01-01T08:00:00"]
+    assert manager.completions_between("Missing") is None
+    assert manager.counts_between("2024-01-10", "2024-02-01") == {"Read": 0, "Run": 1}
+
+
+def test_habit_manager_deadline_queries():
+    """
+    Test the due, at-risk and broken-streak queries and their updates on
+    add, complete and delete.
+    """
+    manager = HabitManager()
+    manager.habits = [
+        Habit("Read", "daily", created_at="2024-01-01T08:00:00",
+              completions=["2024-01-01T08:00:00", "2024-01-02T21:00:00"]),
+        Habit("Run", "weekly", created_at="2024-01-01T08:00:00", completions=["2024-01-01T08:00:00"]),
+        Habit("Bills", "monthly", created_at="2023-12-01T08:00:00", completions=["2023-12-05T08:00:00"]),
+        Habit("Yoga", "every 3 days", created_at="2024-01-03T07:00:00"),
+    ]
+    now = "2024-01-03T18:00:00"
+    assert manager.due_habits(now) == [("Bills", "2024-01-01T00:00:00"), ("Read", "2024-01-03T00:00:00"),
+                                       ("Yoga", "2024-01-03T00:00:00")]
+    assert manager.at_risk(6, now) == [("Read", "2024-01-04T00:00:00")]
+    assert manager.at_risk(24 * 30, now) == [("Read", "2024-01-04T00:00:00"), ("Bills", "2024-02-01T00:00:00")]
+    assert manager.broken_habits(now=now) == []
+    assert manager.broken_habits(now="2024-01-15T00:00:00") == [("Read", "2024-01-04T00:00:00"),
+                                                               ("Run", "2024-01-15T00:00:00")]
+    assert manager.broken_habits(since="2024-01-10", now="2024-01-15T00:00:00") == [
+        ("Run", "2024-01-15T00:00:00")]
+
+    # The index follows the changes made through the manager
+    manager.complete_habit("Read")
+    manager.add_habit("Walk", "daily")
+    manager.delete_habit("Bills")
+    due = dict(manager.due_habits())
+    assert "Read" not in due and "Bills" not in due and "Walk" in due
+    assert [name for name, _ in manager.broken_habits()] == ["Run"]
+
+
 # --- Analytics Module Tests ---
 # This section tests the functions for filtering and analyzing habits.
 def test_get_all_habits():
@@ -92,6 +318,14 @@ def test_filter_by_periodicity():
     assert daily_habits == ["Daily Habit"]
 
 
+def test_filter_by_new_periodicities():
+    """Verify filtering works with monthly and every-N-days habits in any spelling."""
+    habits = [Habit("A", "monthly"), Habit("B", "every 3 days"), Habit("C", "daily")]
+    assert analytics.filter_by_periodicity(habits, "Monthly") == ["A"]
+    assert analytics.filter_by_periodicity(habits, "every-3-days") == ["B"]
+    assert analytics.filter_by_periodicity(habits, "every 1 day") == ["C"]
+
+
 def test_get_longest_streak_overall():
     """Verify the function finds the longest streak among all habits."""
     habit1 = Habit("Daily", "daily")
@@ -103,6 +337,153 @@ def test_get_longest_streak_overall():
     assert longest == 2
 
 
+def test_cached_analytics_recalculate_only_after_changes(monkeypatch):
+    """
+    Test that cached analytics answer repeated queries without recalculating,
+    and pick up completions, additions and deletions.
+    """
+    manager = HabitManager()
+    manager.add_habit("Read", "daily")
+    manager.add_habit("Run", "weekly")
+    cache = analytics.CachedAnalytics(manager)
+    assert cache.get_longest_streak_all() == 0
+
+    calls = []
+    get_longest_streak = Habit.get_longest_streak
+    monkeypatch.setattr(Habit, "get_longest_streak",
+                        lambda habit: calls.append(habit.name) or get_longest_streak(habit))
+    assert cache.get_longest_streak_all() == 0
+    assert cache.get_longest_streak_for("Read") == 0
+    assert calls == []  # Nothing changed, so nothing was recalculated
+
+    manager.complete_habit("Run")
+    assert cache.get_longest_streak_all() == 1
+    assert calls == ["Run"]  # Only the completed habit is recalculated
+
+    # Completing a habit directly still invalidates its own result and the overall one
+    calls.clear()
+    for day in (2, 1):
+        manager.get_habit("Read").complete((datetime.now() - timedelta(days=day)).isoformat())
+    assert cache.get_longest_streak_all() == 2
+    assert calls == ["Read"]
+    assert cache.get_longest_streak_for("Read") == 2
+
+    assert cache.filter_by_periodicity("every 1 day") == ["Read"]
+    manager.add_habit("Walk", "daily")
+    manager.delete_habit("Read")
+    assert cache.filter_by_periodicity("daily") == ["Walk"]
+    assert cache.get_all_habits() == ["Run", "Walk"]
+    assert cache.get_longest_streak_for("Read") == 0
+
+
+def test_cached_longest_streak_follows_every_change():
+    """
+    Test that the cached overall longest streak matches a fresh calculation
+    after random changes, recalculating only the habits that changed.
+    """
+    rng = random.Random(3)
+    manager = HabitManager()
+    manager.habits = make_random_habits(30)
+    cache = analytics.CachedAnalytics(manager)
+    assert cache.get_longest_streak_all() == analytics.get_longest_streak_all(manager.habits)
+    for step in range(200):
+        habit = rng.choice(manager.habits)
+        action = rng.randrange(4)
+        if action == 0:
+            habit.complete()
+        elif action == 1:
+            habit.completions = habit.completions[:rng.randrange(len(habit.completions) + 1)]
+        elif action == 2:
+            manager.delete_habit(habit.name)
+        else:
+            manager.add_habit(f"New {step}", "daily")
+        assert cache.get_longest_streak_all() == analytics.get_longest_streak_all(manager.habits)
+    assert manager.changed_since(manager.version) == []
+
+
+def test_cached_analytics_evict_least_recently_used():
+    """
+    Test that the per-habit cache keeps at most 'maxsize' results.
+    """
+    manager = HabitManager()
+    for i in range(5):
+        manager.add_habit(f"Habit {i}", "daily")
+        manager.complete_habit(f"Habit {i}")
+    cache = analytics.CachedAnalytics(manager, maxsize=2)
+    for i in range(5):
+        assert cache.get_longest_streak_for(f"Habit {i}") == 1
+    assert list(cache._longest) == ["Habit 3", "Habit 4"]
+    # The overall result doesn't depend on the bounded cache
+    manager.get_habit("Habit 0").completions = []
+    assert cache.get_longest_streak_all() == 1
+    assert len(cache._all_longest) == 5
+
+
+# --- Batch Analytics Parity Tests ---
+# These tests check the incrementally kept streaks and the NumPy batch functions against the per-habit logic.
+def make_random_habits(count, seed=42):
+    """Creates habits with random completion histories, including gaps and same-day completions."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    habits = []
+    for i in range(count):
+        habit = Habit(f"Habit {i}", rng.choice(["daily", "weekly", "monthly", "every 2 days", "yearly"]),
+                      week_start=rng.randrange(7))
+        moment = start
+        completions = []
+        for _ in range(rng.randint(0, 40)):
+            moment += timedelta(hours=rng.choice([2, 20, 24, 30, 40, 24 * 7, 24 * 9]))
+            completions.append(moment.isoformat())
+        rng.shuffle(completions)  # Histories are not necessarily stored in order
+        habit.completions = completions
+        habits.append(habit)
+    return habits
+
+
+def longest_streak_reference(habit):
+    """Computes the longest-ever streak via get_streak() on every prefix of the history."""
+    ordered = sorted(habit.completions, key=datetime.fromisoformat)
+    prefix = Habit(habit.name, habit.periodicity, created_at=habit.created_at, week_start=habit.week_start)
+    return max((prefix_streak(prefix, ordered[:k]) for k in range(1, len(ordered) + 1)), default=0)
+
+
+def prefix_streak(habit, completions):
+    """Returns the current streak of a habit after replacing its completions."""
+    habit.completions = completions
+    return habit.get_streak()
+
+
+def test_batch_current_streaks_match_get_streak():
+    """Verify batch current streaks and counts match the per-habit results."""
+    pytest.importorskip("numpy")
+    habits = make_random_habits(200)
+    habits.append(Habit("Never", "daily"))
+    columns = analytics.load_columns(habits)
+    assert analytics.batch_current_streaks(columns) == [habit.get_streak() for habit in habits]
+    assert analytics.batch_completion_counts(columns) == [len(habit.completions) for habit in habits]
+
+
+def test_batch_longest_streaks_match_reference():
+    """Verify batch longest-ever streaks match the longest streak over every prefix."""
+    pytest.importorskip("numpy")
+    habits = make_random_habits(60, seed=7)
+    columns = analytics.load_columns(habits)
+    assert analytics.batch_longest_streaks(columns) == [longest_streak_reference(h) for h in habits]
+    assert analytics.batch_longest_streaks(columns) == [h.get_longest_streak() for h in habits]
+    empty = analytics.load_columns([])
+    assert analytics.batch_longest_streaks(empty) == analytics.batch_current_streaks(empty) == []
+
+
+def test_batch_filter_by_periodicity_matches():
+    """Verify the batch filter returns the same names as filter_by_periodicity()."""
+    pytest.importorskip("numpy")
+    habits = make_random_habits(50)
+    columns = analytics.load_columns(habits)
+    for periodicity in ["daily", "weekly", "monthly", "every-2-days", "yearly"]:
+        assert (analytics.batch_filter_by_periodicity(columns, periodicity)
+                == analytics.filter_by_periodicity(habits, periodicity))
+
+
 # --- StorageHandler (Database) Tests ---
 # This section tests the save and load functionality with a temporary database.
 
@@ -113,11 +494,16 @@ def db_session():
     ensuring tests are isolated and don't affect each other.
     """
     db_file = "test_habits.db"
-    if os.path.exists(db_file):
-        os.remove(db_file)
+    # WAL mode keeps two extra files next to the database, main.py a journal and a snapshot
+    files = [db_file, db_file + "-wal", db_file + "-shm"]
+    files += [db_file + suffix + tmp for suffix in (".journal", ".snapshot") for tmp in ("", ".tmp")]
+    for file in files:
+        if os.path.exists(file):
+            os.remove(file)
     yield db_file
-    if os.path.exists(db_file):
-        os.remove(db_file)
+    for file in files:
+        if os.path.exists(file):
+            os.remove(file)
 
 
 def test_save_and_load_habits(db_session):
@@ -165,6 +551,860 @@ def test_update_existing_habit(db_session):
     assert len(loaded_habits[0].completions) == 1
 
 
+def test_save_appends_only_new_completions(db_session):
+    """
+    Test that saving again only inserts the completions added since the
+    last save, and that a replaced completions list is rewritten.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    habit = Habit("Append Me", "daily")
+    habit.complete()
+    storage_handler.save([habit])
+    habit.complete()
+    storage_handler.save([habit])
+
+    count = storage_handler.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+    assert count == 2
+
+    # Replacing the list discards the previously stored completions
+    habit.completions = [datetime.now().isoformat()]
+    storage_handler.save([habit])
+    assert storage_handler.load()[0].completions == habit.completions
+
+
+def test_save_copies_habits_to_another_database(db_session, tmp_path):
+    """
+    Test that habits loaded from one database are saved with their whole
+    history into another one, whether they were loaded eagerly or lazily.
+    """
+    source = StorageHandler(db_name=db_session)
+    base = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+    source.save([Habit("Read", "daily", completions=[(base - timedelta(days=day)).isoformat()
+                                                     for day in (2, 1, 0)])])
+    for lazy in (False, True):
+        copy = StorageHandler(db_name=str(tmp_path / f"copy_{lazy}.db"))
+        copy.save(source.load(lazy=lazy))
+        assert [(habit.completion_count, habit.get_streak()) for habit in copy.load()] == [(3, 3)]
+        assert copy.top_streaks(1) == [(1, "Read", 3)]
+        copy.close()
+
+
+def test_habit_settings_are_persisted(db_session):
+    """
+    Test that a habit's first day of the week and timezone are stored, so its
+    streaks agree however it is loaded or completed.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    tokyo = timezone(timedelta(hours=9))
+    # A Sunday and the following Monday: one week from Sunday, two ISO weeks
+    storage_handler.save([
+        Habit("Plan", "weekly", week_start=6, completions=["2024-03-03T10:00:00", "2024-03-04T10:00:00"]),
+        Habit("Run", "daily", tz=tokyo, completions=["2024-03-01T20:00:00+00:00"]),
+    ])
+    # In Tokyo this falls on March 2nd as well
+    storage_handler.record_completion("Run", "2024-03-02T10:00:00+00:00")
+
+    loads = [storage_handler.load(), storage_handler.load(lazy=True), list(storage_handler.iter_habits())]
+    storage_handler.save_snapshot()
+    loads.append(storage_handler.load(snapshot=True))
+    for habits in loads:
+        assert [(habit.week_start, habit.tz, habit.get_streak()) for habit in habits] == [
+            (6, None, 1), (0, tokyo, 1)]
+    assert storage_handler.top_streaks(1) == [(1, "Plan", 1), (1, "Run", 1)]
+
+
+def test_recorded_completions_default_to_now_in_the_habits_timezone(db_session):
+    """
+    Test that a completion recorded without a timestamp, directly or through
+    AsyncStorageHandler, is taken at the current time in the habit's timezone,
+    like Habit.complete(), not at the system's local time.
+    """
+    kiritimati = timezone(timedelta(hours=14))  # Whatever the host's timezone is, this differs
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([Habit("Swim", "daily", tz=kiritimati)])
+    assert storage_handler.record_completion("Swim")
+
+    async def scenario():
+        async with AsyncStorageHandler(db_name=db_session) as storage:
+            return await storage.record_completion("Swim")
+    assert asyncio.run(scenario())
+
+    reference = Habit("Swim", "daily", tz=kiritimati)
+    reference.complete()
+    habit = storage_handler.load()[0]
+    assert habit.completion_count == 2
+    for ts in habit.completions + reference.completions:
+        assert datetime.fromisoformat(ts).utcoffset() == timedelta(hours=14)
+    assert habit.stamps[-1] // 86_400_000_000 == reference.stamps[0] // 86_400_000_000  # Same day
+    assert habit.get_streak() == 1
+
+
+def test_save_and_load_compact_habits(db_session):
+    """
+    Test that compact habits are saved incrementally and can be loaded back in compact form.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    habit = Habit("Compact", "daily", compact=True)
+    habit.complete()
+    storage_handler.save([habit])
+
+    loaded_habit = storage_handler.load(compact=True)[0]
+    assert loaded_habit.compact
+    loaded_habit.complete()
+    storage_handler.save([loaded_habit])
+    assert storage_handler.load()[0].completions == list(loaded_habit.completions)
+
+
+def test_streaks_are_persisted_incrementally(db_session):
+    """
+    Test that saving extends the stored current streak instead of rewriting all streaks.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    habit = Habit("Streaky", "daily")
+    now = datetime.now()
+    habit.completions = [(now - timedelta(days=d)).isoformat() for d in (5, 4, 3, 1)]
+    storage_handler.save([habit])
+    habit.complete()
+    storage_handler.save([habit])
+
+    runs = storage_handler.conn.execute(
+        "SELECT length FROM streak_runs ORDER BY start_ts").fetchall()
+    assert runs == [(3,), (2,)]
+    streaks = storage_handler.conn.execute(
+        "SELECT current_streak, longest_streak FROM habits").fetchone()
+    assert streaks == (2, 3)
+
+
+def test_lazy_load_fetches_completions_on_first_use(db_session):
+    """
+    Test that lazily loaded habits read their completions only when needed,
+    and that untouched lazy habits are saved without loading them.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    habits = [Habit("Lazy 1", "daily"), Habit("Lazy 2", "weekly")]
+    habits[0].complete()
+    storage_handler.save(habits)
+
+    lazy_habits = storage_handler.load(lazy=True)
+    assert [habit.name for habit in lazy_habits] == ["Lazy 1", "Lazy 2"]
+    assert not any(habit.loaded for habit in lazy_habits)
+
+    # Streaks and due times come from the stored values, without loading any completions
+    assert lazy_habits[0].get_streak() == 1
+    assert lazy_habits[0].get_longest_streak() == 1
+    assert [habit.due_times() for habit in lazy_habits] == [habit.due_times() for habit in habits]
+    assert not any(habit.loaded for habit in lazy_habits)
+
+    # Completing a habit doesn't load it either, and neither does saving the completion
+    lazy_habits[0].complete()
+    assert lazy_habits[0].get_streak() == 1
+    storage_handler.save(lazy_habits)
+    assert not any(habit.loaded for habit in lazy_habits)
+    assert len(storage_handler.load()[0].completions) == 2
+
+
+def test_lazy_habit_completes_without_loading(db_session):
+    """
+    Test that completing a lazy habit updates its streaks from the latest stored
+    streak alone, and that the completions are stored and merged into the history
+    once, whether they are saved first or the habit is loaded first.
+    """
+    days = [f"2024-03-0{day}T08:00:00" for day in range(1, 10)]
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([Habit("Read", "daily", completions=days[:3]),
+                          Habit("Run", "daily", completions=days[:3])])
+    read, run = storage_handler.load(lazy=True)
+
+    read.complete(days[3])  # Extends the streak
+    run.complete(days[4])   # Starts a new one after a gap
+    run.complete(days[5])
+    assert (read.get_streak(), read.get_longest_streak()) == (4, 4)
+    assert (run.get_streak(), run.get_longest_streak()) == (2, 3)
+    storage_handler.save([read, run])
+    assert not read.loaded and not run.loaded
+
+    read.complete(days[4])
+    assert read.completions == days[:5]  # Loads the stored history and adds the new completion
+    assert read.loaded and read.get_streak() == 5
+    run.complete(days[2])  # An older completion than the latest loads the habit
+    assert run.loaded and run.completion_count == 6
+    storage_handler.save([read, run])
+
+    for habit in (storage_handler.load(), storage_handler.load(lazy=True)):
+        assert [(h.completion_count, h.get_streak(), h.get_longest_streak()) for h in habit] == [
+            (5, 5, 5), (6, 2, 3)]
+    assert storage_handler.top_streaks(2, current=True) == [(1, "Read", 5), (2, "Run", 2)]
+
+
+def test_iter_habits_streams_habits_in_order(db_session):
+    """
+    Test that iter_habits() yields every habit with its completions sorted by time.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    now = datetime.now()
+    habit = Habit("Streamed", "daily")
+    habit.completions = [now.isoformat(), (now - timedelta(days=1)).isoformat()]
+    storage_handler.save([habit, Habit("Empty", "weekly")])
+
+    streamed = list(storage_handler.iter_habits())
+    assert [h.name for h in streamed] == ["Streamed", "Empty"]
+    assert streamed[0].completions == sorted(habit.completions)
+    assert streamed[0].get_streak() == 2
+    assert streamed[1].completions == []
+
+
+def test_migrate_json_completions_schema(db_session):
+    """
+    Test that a database using the old JSON-blob layout is migrated to the
+    'completions' table when it is opened.
+    """
+    conn = sqlite3.connect(db_session)
+    conn.execute("""
+        CREATE TABLE habits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            periodicity TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            completions TEXT NOT NULL
+        )
+    """)
+    stamps = [(datetime.now() - timedelta(days=1)).isoformat(), datetime.now().isoformat()]
+    conn.execute(
+        "INSERT INTO habits (name, periodicity, created_at, completions) VALUES (?, ?, ?, ?)",
+        ("Old Habit", "Daily", stamps[0], json.dumps(stamps)),
+    )
+    conn.commit()
+    conn.close()
+
+    storage_handler = StorageHandler(db_name=db_session)
+    loaded_habits = storage_handler.load()
+    assert loaded_habits[0].name == "Old Habit"
+    assert loaded_habits[0].periodicity == "daily"  # Stored in its canonical spelling
+    assert loaded_habits[0].completions == stamps
+    assert loaded_habits[0].get_streak() == 2
+    assert storage_handler.load(lazy=True)[0].get_longest_streak() == 2
+
+    columns = storage_handler.conn.execute("PRAGMA table_info(habits)").fetchall()
+    assert "completions" not in [column[1] for column in columns]
+
+
+def test_save_changes_writes_only_the_delta(db_session):
+    """
+    Test that save_changes() writes just the tracked changes: one completion
+    touches one row, and deleted habits are removed from the database.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    manager = HabitManager()
+    for i in range(50):
+        manager.add_habit(f"Habit {i}", "daily")
+    storage_handler.save_changes(*manager.get_changes())
+
+    manager.habits = storage_handler.load()
+    manager.complete_habit("Habit 7")
+    before = storage_handler.conn.total_changes
+    storage_handler.save_changes(*manager.get_changes())
+    # One completion row, the streak it started, that habit's streak columns
+    # and the database generation
+    assert storage_handler.conn.total_changes - before == 4
+    manager.clear_changes()
+
+    manager.delete_habit("Habit 7")
+    storage_handler.save_changes(*manager.get_changes())
+    loaded_habits = storage_handler.load()
+    assert len(loaded_habits) == 49
+    assert "Habit 7" not in [habit.name for habit in loaded_habits]
+    count = storage_handler.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+    assert count == 0
+
+
+def test_storage_is_shared_safely_between_threads(db_session):
+    """
+    Test many threads recording completions at the same time, while other threads
+    read: no completion may be lost, and the stored streaks must match the ones
+    calculated from all completions.
+    """
+    threads_count, per_thread = 16, 25
+    with StorageHandler(db_name=db_session) as storage_handler:
+        storage_handler.save([Habit("Read", "daily", created_at="2024-01-01T00:00:00"),
+                              Habit("Run", "weekly", created_at="2024-01-01T00:00:00")])
+        start = datetime(2024, 1, 1, 12, 0)
+        errors = []
+
+        def writer(number):
+            try:
+                for i in range(per_thread):
+                    # Spread completions over consecutive days, in no particular order
+                    day = start + timedelta(days=i * threads_count + number)
+                    assert storage_handler.record_completion("Read", day.isoformat())
+                    assert storage_handler.record_completion("Run", day.isoformat())
+            except Exception as error:  # Reported to the main thread below
+                errors.append(error)
+
+        def reader():
+            try:
+                for _ in range(per_thread):
+                    assert len(storage_handler.load(lazy=True)) == 2
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(threads_count)]
+        threads += [threading.Thread(target=reader) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert not storage_handler.record_completion("Missing")
+
+        total = threads_count * per_thread
+        stored = {habit.name: habit for habit in storage_handler.load(lazy=True)}
+        for habit in storage_handler.load():
+            assert habit.completion_count == total
+            assert stored[habit.name].get_streak() == habit.get_streak()
+            assert stored[habit.name].get_longest_streak() == habit.get_longest_streak()
+        assert stored["Read"].get_longest_streak() == total
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        storage_handler.load()  # Closed by the with block
+
+
+def test_connections_of_finished_threads_are_closed(db_session):
+    """
+    Test that the connection of a thread is closed when the thread ends, so
+    short-lived threads don't pile up open connections.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([Habit("Read", "daily")])
+    for _ in range(50):
+        thread = threading.Thread(target=storage_handler.load)
+        thread.start()
+        thread.join()
+    assert len(storage_handler._connections) == 1  # The main thread's
+    storage_handler.close()
+
+
+def test_analytics_queries_run_in_sql(db_session):
+    """
+    Test the analytics answered by StorageHandler without loading habits.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    read = Habit("Read", "daily", completions=[
+        "2024-01-01T08:00:00", "2024-01-02T08:00:00", "2024-01-02T20:00:00", "2024-02-05T08:00:00"])
+    run = Habit("Run", "weekly", completions=["2024-01-02T07:00:00", "2024-01-09T07:00:00"])
+    storage_handler.save([read, run, Habit("Swim", "every 2 days")])
+
+    assert storage_handler.habits_by_periodicity("Every 1 Day") == ["Read"]
+    assert storage_handler.habits_by_periodicity("every-2-days") == ["Swim"]
+
+    assert storage_handler.completion_counts() == [("Read", 4), ("Run", 2), ("Swim", 0)]
+    assert storage_handler.completion_counts(start="2024-01-02", end="2024-02-01") == [
+        ("Read", 2), ("Run", 2), ("Swim", 0)]
+    assert storage_handler.completion_counts("month") == [
+        ("Read", "2024-01", 3), ("Read", "2024-02", 1), ("Run", "2024-01", 2)]
+    # Weeks are named by their Monday: 2024-01-01 and 2024-02-05 are Mondays
+    assert storage_handler.completion_counts("week") == [
+        ("Read", "2024-01-01", 3), ("Read", "2024-02-05", 1),
+        ("Run", "2024-01-01", 1), ("Run", "2024-01-08", 1)]
+    assert ("Read", "2024-01-02", 2) in storage_handler.completion_counts("day")
+    with pytest.raises(ValueError):
+        storage_handler.completion_counts("year")
+
+    assert storage_handler.habits_completed_on("2024-01-02") == ["Read", "Run"]
+    assert storage_handler.habits_completed_on("2024-01-03") == []
+    assert storage_handler.record_completion("Swim")
+    assert storage_handler.habits_completed_on() == ["Swim"]  # Today
+
+    assert storage_handler.top_streaks(1) == [(1, "Read", 2), (1, "Run", 2)]  # A tie
+    assert storage_handler.top_streaks(3, current=True) == [(1, "Run", 2), (2, "Read", 1), (2, "Swim", 1)]
+
+
+def test_compact_keeps_streaks_and_counts(db_session):
+    """
+    Test that compaction leaves one completion per period of old history,
+    keeps the streaks and the completion counts, and can be repeated.
+    """
+    old = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=400)
+    daily = [(old + timedelta(days=day, hours=hour)).isoformat() for day in range(10) for hour in (0, 4, 8)]
+    weekly = [(old + timedelta(days=day)).isoformat() for day in range(21)]
+    recent = [(datetime.now() - timedelta(hours=hour)).isoformat() for hour in (1, 2)]
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([Habit("Read", "daily", completions=daily + recent),
+                          Habit("Run", "weekly", completions=weekly)])
+    before = {habit.name: (habit.get_streak(), habit.get_longest_streak())
+              for habit in storage_handler.load()}
+    counts = storage_handler.completion_counts()
+
+    removed = storage_handler.compact(retain_days=30)
+    # 'Read' keeps one completion per old day, 'Run' one per week it touches
+    run_weeks = len({(old + timedelta(days=day)).isocalendar()[:2] for day in range(21)})
+    assert removed == 20 + 21 - run_weeks
+    assert storage_handler.completion_counts() == counts
+    loaded = storage_handler.load()
+    assert [habit.completion_count for habit in loaded] == [12, run_weeks]
+    assert {habit.name: (habit.get_streak(), habit.get_longest_streak()) for habit in loaded} == before
+
+    # Streaks recalculated from the compacted history are still the same
+    with storage_handler.conn:
+        storage_handler._rebuild_streaks()
+    assert storage_handler.top_streaks(2) == [(1, "Read", before["Read"][1]), (2, "Run", before["Run"][1])]
+
+    assert storage_handler.compact(retain_days=30) == 0
+    assert storage_handler.completion_counts() == counts
+
+
+def test_rewriting_a_compacted_habit_drops_its_compaction_counts(db_session):
+    """
+    Test that saving a replaced completions list over a compacted habit counts
+    only the new completions.
+    """
+    old = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=100)
+    completions = [(old + timedelta(hours=hour)).isoformat() for hour in range(4)]
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([Habit("Read", "daily", completions=completions)])
+    assert storage_handler.compact(retain_days=30) == 3
+    assert sum(count for _, count in storage_handler.completion_counts()) == 4
+
+    storage_handler.save([Habit("Read", "daily", completions=completions)])
+    assert sum(count for _, count in storage_handler.completion_counts()) == 4
+
+
+def test_journal_replays_changes_after_a_crash(db_session):
+    """
+    Test that journaled changes that were never saved are replayed into the
+    database on the next load, exactly once.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([Habit("Old", "daily"), Habit("Read", "daily")])
+    journal = CompletionJournal(db_session + ".journal")
+    manager = HabitManager(journal=journal)
+    manager.habits = storage_handler.load(journal=journal)
+    manager.add_habit("Run", "weekly")
+    manager.complete_habit("Run")
+    manager.complete_habit("Read")
+    manager.delete_habit("Old")
+    assert journal.pending == 4
+    journal.close()  # The process dies here, nothing was saved
+    storage_handler.close()
+
+    for _ in range(2):  # A second load must not apply the changes again
+        storage_handler = StorageHandler(db_name=db_session)
+        with CompletionJournal(db_session + ".journal") as journal:
+            habits = {habit.name: habit for habit in storage_handler.load(journal=journal)}
+            assert journal.pending == 0
+        assert sorted(habits) == ["Read", "Run"]
+        assert habits["Run"].periodicity == "weekly"
+        assert [habit.completion_count for habit in habits.values()] == [1, 1]
+        assert habits["Read"].get_streak() == 1
+        storage_handler.close()
+
+
+def test_journal_numbering_survives_a_lost_journal(db_session):
+    """
+    Test that a journal recreated after the old file was deleted numbers its
+    entries after the ones the database has, so they are replayed after a crash.
+    """
+    path = db_session + ".journal"
+    storage_handler = StorageHandler(db_name=db_session)
+    journal = CompletionJournal(path)
+    manager = HabitManager(journal=journal)
+    manager.habits = storage_handler.load(journal=journal)
+    manager.add_habit("Read", "daily")
+    manager.add_habit("Run", "daily")
+    storage_handler.checkpoint(journal, *manager.get_changes())
+    journal.close()
+    os.remove(path)
+
+    journal = CompletionJournal(path)
+    manager = HabitManager(journal=journal)
+    manager.habits = storage_handler.load(journal=journal)
+    manager.complete_habit("Read")
+    journal.close()  # The process dies before saving
+    storage_handler.close()
+
+    storage_handler = StorageHandler(db_name=db_session)
+    with CompletionJournal(path) as journal:
+        assert [habit.completion_count for habit in storage_handler.load(journal=journal)] == [1, 0]
+    storage_handler.close()
+
+
+def test_journal_checkpoint_and_repair(db_session):
+    """
+    Test that a checkpoint saves the changes and empties the journal, that
+    sequence numbers keep increasing, and that a torn last line is dropped.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    path = db_session + ".journal"
+    journal = CompletionJournal(path)
+    manager = HabitManager(journal=journal)
+    manager.habits = storage_handler.load(journal=journal)
+    manager.add_habit("Read", "daily")
+    manager.complete_habit("Read")
+    storage_handler.checkpoint(journal, *manager.get_changes())
+    manager.clear_changes()
+    assert journal.pending == 0 and journal.entries() == []
+    assert storage_handler.load()[0].completion_count == 1
+
+    manager.complete_habit("Read")
+    journal.close()
+    with open(path, "a") as file:
+        file.write('{"seq": 4, "op": "comp')  # Cut off by a crash
+    journal = CompletionJournal(path)
+    assert journal.seq == 3 and [entry["op"] for entry in journal.entries()] == ["complete"]
+    assert journal.append("delete", name="Read") == 4
+    assert storage_handler.replay(journal) == 2
+    assert storage_handler.load() == []
+    journal.close()
+    storage_handler.close()
+
+
+def test_snapshot_round_trip_and_staleness(db_session):
+    """
+    Test that a snapshot loads the same habits as the database, that any write
+    makes it out of date, and that a damaged snapshot falls back to the database.
+    """
+    base = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0) - timedelta(days=30)
+    storage_handler = StorageHandler(db_name=db_session)
+    storage_handler.save([
+        Habit("Read", "daily", completions=[(base + timedelta(days=day)).isoformat() for day in (0, 1, 2, 5, 6)]),
+        Habit("Run", "weekly", completions=[(base + timedelta(weeks=week)).isoformat() for week in range(3)]),
+        Habit("New", "every 3 days"),
+    ])
+    assert storage_handler._load_snapshot() is None  # Nothing written yet
+    assert storage_handler.save_snapshot() == 3
+    # Without changes neither saving nor checkpointing moves the generation on,
+    # so the snapshot stays current and isn't written again
+    generation = storage_handler._generation()
+    storage_handler.save_changes()
+    journal = CompletionJournal(db_session + ".journal")
+    storage_handler.checkpoint(journal)
+    journal.close()
+    assert storage_handler._generation() == generation
+    assert storage_handler.save_snapshot() is None
+
+    expected = {habit.name: (habit.periodicity, habit.created_at, list(habit.stamps),
+                             habit.get_streak_runs(), habit.get_longest_streak())
+                for habit in storage_handler.load()}
+    habits = storage_handler.load(snapshot=True)
+    assert all(habit.compact for habit in habits)
+    assert {habit.name: (habit.periodicity, habit.created_at, list(habit.stamps),
+                         habit.get_streak_runs(), habit.get_longest_streak())
+            for habit in habits} == expected
+
+    # Habits from a snapshot can be completed and saved like loaded ones
+    manager = HabitManager()
+    manager.habits = habits
+    manager.complete_habit("Read")
+    storage_handler.save_changes(*manager.get_changes())
+    assert storage_handler._load_snapshot() is None  # The database moved on
+    assert storage_handler.load(snapshot=True)[0].completion_count == 6
+
+    storage_handler.save_snapshot()
+    assert storage_handler.load(snapshot=True)[0].get_streak() == 1
+    with open(storage_handler.snapshot_path, "r+b") as file:
+        file.truncate(os.path.getsize(storage_handler.snapshot_path) - 10)
+    assert storage_handler._load_snapshot() is None
+    assert [habit.name for habit in storage_handler.load(snapshot=True)] == ["Read", "Run", "New"]
+
+
+# --- Async API Tests ---
+# This section tests the asyncio wrappers around the storage and the manager.
+def test_async_storage_groups_concurrent_completions(db_session, monkeypatch):
+    """
+    Test that completions recorded concurrently through AsyncStorageHandler
+    are written in one transaction, and each caller gets its own result.
+    """
+    StorageHandler(db_name=db_session).save([Habit("Read", "daily")])
+    batches = []
+    record_completions = StorageHandler.record_completions
+
+    def counting_record_completions(storage_handler, completions):
+        batches.append(len(completions))
+        return record_completions(storage_handler, completions)
+    monkeypatch.setattr(StorageHandler, "record_completions", counting_record_completions)
+
+    async def scenario():
+        async with AsyncStorageHandler(db_name=db_session, batch_window=0.05) as storage:
+            results = await asyncio.gather(
+                *(storage.record_completion("Read") for _ in range(50)),
+                storage.record_completion("Missing"))
+            habits = await storage.load()
+        return results, habits
+
+    results, habits = asyncio.run(scenario())
+    assert results == [True] * 50 + [False]
+    assert batches == [51]
+    assert habits[0].completion_count == 50
+
+
+def test_async_habit_manager(db_session, monkeypatch):
+    """
+    Test the async manager: concurrent completions share one save, and
+    analytics are awaitable.
+    """
+    saves = []
+    save_changes = StorageHandler.save_changes
+
+    def counting_save_changes(storage_handler, added=(), deleted=(), completed=()):
+        saves.append(len(completed))
+        return save_changes(storage_handler, added, deleted, completed)
+    monkeypatch.setattr(StorageHandler, "save_changes", counting_save_changes)
+
+    async def scenario():
+        async with AsyncStorageHandler(db_name=db_session, batch_window=0.05) as storage:
+            manager = AsyncHabitManager(storage, batch_window=0.05)
+            await manager.load()
+            await manager.add_habit("Read", "daily")
+            await manager.add_habit("Meditate", "weekly")
+            await manager.save()
+            saves.clear()
+
+            results = await asyncio.gather(*(manager.complete_habit(name)
+                                             for name in ["Read", "Meditate"] * 10))
+            assert results == [True] * 20
+            assert not await manager.complete_habit("Missing")
+            assert saves == [2]  # One transaction for both habits
+
+            assert await manager.get_all_habits() == ["Read", "Meditate"]
+            assert await manager.filter_by_periodicity("weekly") == ["Meditate"]
+            assert await manager.get_longest_streak_all() == 1
+            assert await manager.get_longest_streak_for("Read") == 1
+
+    asyncio.run(scenario())
+    loaded = StorageHandler(db_name=db_session).load()
+    assert [habit.completion_count for habit in loaded] == [10, 10]
+
+
+# --- Bulk Import/Export Tests ---
+# This section tests streaming CSV and NDJSON files in and out of the database.
+def test_bulk_import_and_export_round_trip(db_session, tmp_path):
+    """
+    Test that a CSV import lands in the database with streaks, and that an
+    NDJSON export can be imported into a second database unchanged.
+    """
+    start = datetime(2024, 5, 1, 9)
+    csv_file = tmp_path / "import.csv"
+    lines = ["habit,periodicity,timestamp"]
+    lines += [f"Run,daily,{(start + timedelta(days=d)).isoformat()}" for d in range(5)]
+    lines += ["Stretch,weekly,"]
+    csv_file.write_text("\n".join(lines) + "\n")
+
+    storage_handler = StorageHandler(db_name=db_session)
+    stats = bulk.import_file(storage_handler, str(csv_file), chunk_size=2)
+    assert stats == {"habits": 2, "completions": 5, "skipped": 0}
+
+    loaded = {habit.name: habit for habit in storage_handler.load(lazy=True)}
+    assert loaded["Run"].get_longest_streak() == 5  # Streaks were refreshed after the import
+    assert loaded["Stretch"].completions == []
+
+    ndjson_file = tmp_path / "export.ndjson"
+    assert bulk.export_file(storage_handler, str(ndjson_file)) == 6
+    copy = StorageHandler(db_name=str(tmp_path / "copy.db"))
+    assert bulk.import_file(copy, str(ndjson_file))["completions"] == 5
+    assert [h.completions for h in copy.load()] == [h.completions for h in storage_handler.load()]
+    # A second import of the same file adds nothing
+    assert bulk.import_file(copy, str(ndjson_file)) == {"habits": 0, "completions": 0, "skipped": 0}
+    assert copy.completion_counts() == storage_handler.completion_counts()
+
+
+def test_bulk_import_validates_rows(db_session):
+    """
+    Test that invalid rows stop the import, or are counted when skipping is enabled.
+    """
+    storage_handler = StorageHandler(db_name=db_session)
+    rows = [
+        ("Read", "daily", None, "2024-01-01T10:00:00"),
+        ("Read", "daily", None, "not a date"),
+        ("Read", "weekly", None, "2024-01-02T10:00:00"),
+        ("Read", "hourly", None, "2024-01-03T10:00:00"),
+        ("", "daily", None, "2024-01-04T10:00:00"),
+    ]
+    with pytest.raises(ValueError, match="Row 2"):
+        bulk.import_rows(storage_handler, rows)
+
+    stats = bulk.import_rows(StorageHandler(db_name=db_session), rows, skip_invalid=True)
+    assert stats["skipped"] == 4
+
+
+# --- Multi-Database Aggregation Tests ---
+# This section tests summarizing many databases at once.
+def test_aggregate_merges_summaries_of_many_databases(tmp_path):
+    """
+    Test that summarizing databases in worker processes gives the same result as
+    summarizing them in-process, and that unreadable databases are reported.
+    """
+    today = datetime.now().replace(microsecond=0)
+    for user in range(6):
+        days = [(today - timedelta(days=day)).isoformat() for day in range(user + 1)]
+        habits = [Habit("Read", "daily", completions=days),
+                  Habit(f"Swim {user}", "weekly", completions=["2024-01-01T08:00:00"])]
+        with StorageHandler(db_name=str(tmp_path / f"user{user}.db")) as storage_handler:
+            storage_handler.save(habits)
+    (tmp_path / "broken.db").write_text("not a database")
+    other = sqlite3.connect(str(tmp_path / "other.db"))  # Some other application's database
+    other.execute("CREATE TABLE foo (x)")
+    other.commit()
+    other.close()
+
+    paths = list(aggregate.find_databases([str(tmp_path)]))
+    serial = aggregate.aggregate(paths, workers=0, chunk_size=2).to_dict()
+    parallel = aggregate.aggregate(paths, workers=2, chunk_size=2).to_dict()
+    parallel["failed"].sort(key=lambda failure: failure["database"])
+    assert parallel == serial
+
+    assert serial["databases"] == 6
+    assert [failure["database"] for failure in serial["failed"]] == [str(tmp_path / "broken.db"),
+                                                                     str(tmp_path / "other.db")]
+    assert serial["habits"] == 12
+    assert serial["completions"] == sum(range(1, 7)) + 6
+    assert serial["active_habits"] == 6  # Only 'Read' was completed recently
+    assert serial["periodicities"] == {"daily": 6, "weekly": 6}
+    assert serial["longest_streak"] == {"streak": 6, "database": str(tmp_path / "user5.db"),
+                                        "habit": "Read"}
+
+    # Reading never changes a database, not even one of another application
+    other = sqlite3.connect(str(tmp_path / "other.db"))
+    assert other.execute("SELECT name FROM sqlite_master").fetchall() == [("foo",)]
+    assert other.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert other.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    other.close()
+    assert not os.path.exists(tmp_path / "other.db-wal")
+    missing = aggregate.summarize_database(str(tmp_path / "missing.db"), "2024-01-01")
+    assert missing.databases == 0 and len(missing.failed) == 1
+    assert not os.path.exists(tmp_path / "missing.db")
+
+
+# --- Metrics Tests ---
+# This section tests the opt-in metrics of function calls, rows and cache hits.
+def test_metrics_record_calls_rows_and_cache_hits(db_session, tmp_path):
+    """
+    Test that enabled metrics count calls, rows and cache hits, reach the sinks,
+    and that disabling them restores the original functions.
+    """
+    original_get_streak = Habit.get_streak
+    sink = metrics.MemorySink()
+    prometheus = tmp_path / "metrics.prom"
+    registry = metrics.enable([sink, metrics.PrometheusFileSink(str(prometheus))])
+    try:
+        storage_handler = StorageHandler(db_name=db_session)
+        habit = Habit("Read", "daily", completions=["2024-01-01T08:00:00", "2024-01-02T08:00:00"])
+        storage_handler.save([habit])
+        storage_handler.load()
+        habit.get_streak()
+        manager = HabitManager()
+        manager.habits = [habit]
+        cache = analytics.CachedAnalytics(manager)
+        for _ in range(3):
+            cache.get_longest_streak_all()
+    finally:
+        metrics.disable()
+
+    assert Habit.get_streak is original_get_streak
+    assert metrics.active() is None
+    snapshot = sink.snapshots[-1]
+    assert snapshot == registry.snapshot()
+    assert snapshot["timings"]["StorageHandler.save"]["count"] == 1
+    assert snapshot["timings"]["Habit.get_streak"]["count"] >= 1
+    assert snapshot["counters"]["storage.rows_written"] == 5  # Habit, 2 completions, 1 streak, streak columns
+    assert snapshot["counters"]["storage.rows_read"] == 3     # 2 completions, 1 habit
+    assert snapshot["hit_rates"]["analytics.cache"] == 2 / 3  # 2 of 3 lookups
+    text = prometheus.read_text()
+    assert "habit_tracker_storage_rows_written_total 5" in text
+    assert 'habit_tracker_call_duration_seconds_count{function="StorageHandler.save"} 1' in text
+
+
+def test_main_profile_switch(db_session, tmp_path, monkeypatch, capsys):
+    """
+    Test that '--profile' saves cProfile statistics for the session.
+    """
+    inputs = iter(['8'])
+    monkeypatch.setattr('builtins.input', lambda _: next(inputs))
+    monkeypatch.setattr(main, "StorageHandler", lambda: StorageHandler(db_name=db_session))
+    profile = tmp_path / "session.prof"
+    main.main(["--profile", str(profile)])
+    assert profile.exists()
+    assert "Most expensive functions" in capsys.readouterr().out
+
+
+# --- Benchmark Suite Test ---
+# A quick smoke test so the benchmark runner keeps working as the code changes.
+def test_benchmark_cases_run_on_small_data():
+    """Verify the data generators and every benchmark case run on a tiny data set."""
+    from benchmarks.generators import make_habits
+    from benchmarks.run import CASES, run_case
+
+    habits = make_habits(200, per_habit=50)
+    assert len(habits) == 4
+    assert sum(habit.completion_count for habit in habits) == 200
+    for name in CASES:
+        result = run_case(name, 100, per_habit=50, repeat=1)
+        assert result["throughput"] > 0 and result["p99_ms"] >= result["p50_ms"]
+
+
+# --- Batch CLI Tests ---
+# This section tests the scriptable command-line interface in cli.py.
+def run_cli(capsys, *argv):
+    """
+    Runs cli.main() and returns its exit status and the JSON results it printed.
+    """
+    status = cli.main(["--db", *argv])
+    lines = capsys.readouterr().out.splitlines()
+    return status, [json.loads(line) for line in lines]
+
+
+def test_cli_batch_runs_commands_in_one_transaction(db_session, tmp_path, capsys, monkeypatch):
+    """
+    Test a batch of commands: each prints a JSON result, failures don't stop the
+    batch, and all habit changes are saved together at the end.
+    """
+    commands = tmp_path / "commands.txt"
+    commands.write_text("# Set up two habits\n"
+                        "add 'Read Book' daily\n"
+                        "add Run 'every 2 days'\n"
+                        "complete 'Read Book'\n"
+                        "complete Missing\n"
+                        "not-a-command\n"
+                        "list --periodicity daily\n")
+    saves = []
+    save_changes = StorageHandler.save_changes
+    monkeypatch.setattr(StorageHandler, "save_changes",
+                        lambda storage, *changes: saves.append(changes) or save_changes(storage, *changes))
+
+    status, results = run_cli(capsys, db_session, "batch", str(commands))
+    assert status == 1  # Some commands failed
+    assert [result["ok"] for result in results] == [True, True, True, False, False, True]
+    assert results[1]["periodicity"] == "every 2 days"
+    assert results[2]["streak"] == 1
+    assert results[5]["habits"][0]["name"] == "Read Book"
+    assert len([added for added, _, _ in saves if added]) == 1  # One save for the whole batch
+
+    status, results = run_cli(capsys, db_session, "stats")
+    assert status == 0
+    assert results[0]["completions"] == {"Read Book": 1, "Run": 0}
+    assert results[0]["completed_today"] == ["Read Book"]
+
+    export = tmp_path / "export.ndjson"
+    assert run_cli(capsys, db_session, "export", str(export))[1][0]["rows"] == 2
+    assert run_cli(capsys, db_session, "delete", "Run")[0] == 0
+    # Importing an export brings back what is missing and duplicates nothing
+    assert run_cli(capsys, db_session, "import", str(export))[1][0] == {
+        "command": "import", "ok": True, "habits": 1, "completions": 0, "skipped": 0}
+    assert run_cli(capsys, db_session, "import", str(export))[1][0] == {
+        "command": "import", "ok": True, "habits": 0, "completions": 0, "skipped": 0}
+    assert len(StorageHandler(db_name=db_session).load()) == 2
+    assert run_cli(capsys, db_session, "stats")[1][0]["completions"] == {"Read Book": 1, "Run": 0}
+
+
+def test_cli_imports_only_what_a_command_needs(db_session):
+    """
+    Test that simple commands don't import the analytics or bulk modules.
+    """
+    code = ("import sys, cli; cli.main(['--db', sys.argv[1], 'list']); "
+            "print(sorted({'analytics', 'bulk'} & set(sys.modules)))")
+    output = subprocess.run([sys.executable, "-c", code, db_session], capture_output=True,
+                            text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.stdout.splitlines()[-1] == "[]"
+
+
 # --- Command-Line Interface (CLI) Test ---
 # This section tests the main loop by simulating user input and capturing output.
 def test_cli_add_and_view_habit(monkeypatch, capsys, db_session):